@@ -3,6 +3,8 @@ ASGI config for gym_trainer_project project.
 
 It exposes the ASGI callable as a module-level variable named ``application``.
 
+It uses asgi_settings, which serves the async versions of the read views.
+
 For more information on this file, see
 https://docs.djangoproject.com/en/5.2/howto/deployment/asgi/
 """
@@ -11,6 +13,6 @@ import os
 
 from django.core.asgi import get_asgi_application
 
-os.environ.setdefault("DJANGO_SETTINGS_MODULE", "gym_trainer_project.settings")
+os.environ.setdefault("DJANGO_SETTINGS_MODULE", "gym_trainer_project.asgi_settings")
 
 application = get_asgi_application()
@@ -0,0 +1,18 @@
+"""
+Settings for serving the project under ASGI (gym_trainer_project/asgi.py),
+e.g. with ``uvicorn gym_trainer_project.asgi:application --workers 4``.
+
+Everything comes from settings.py, except that the trainer app's read views
+are the async ones, and database connections are closed at the end of each
+request: under ASGI every request runs its ORM calls on a thread of its own,
+which ends with the request, so a persistent connection would never be
+reused.
+"""
+
+from .settings import *  # noqa: F401,F403
+from .settings import DATABASES
+
+ROOT_URLCONF = "gym_trainer_project.asgi_urls"
+
+for database in DATABASES.values():
+    database["CONN_MAX_AGE"] = 0
@@ -0,0 +1,17 @@
+"""
+URL configuration under ASGI: the same URLs as urls.py, with the trainer
+app's read views served by their async versions (trainer/async_views.py).
+"""
+
+from django.contrib import admin
+from django.urls import path, include
+from django.conf import settings
+from django.conf.urls.static import static
+
+urlpatterns = [
+    path("admin/", admin.site.urls),
+    path("", include("trainer.async_urls")),
+]
+
+if settings.DEBUG:
+    urlpatterns += static(settings.MEDIA_URL, document_root=settings.MEDIA_ROOT)
@@ -10,6 +10,7 @@ For the full list of settings and their values, see
 https://docs.djangoproject.com/en/5.2/ref/settings/
 """
 
+import tempfile
 from pathlib import Path
 
 # Build paths inside the project like this: BASE_DIR / 'subdir'.
@@ -41,6 +42,8 @@ INSTALLED_APPS = [
 ]
 
 MIDDLEWARE = [
+    "trainer.monitoring.RequestMetricsMiddleware",
+    "trainer.db_routing.ReplicaRoutingMiddleware",
     "django.middleware.security.SecurityMiddleware",
     "django.contrib.sessions.middleware.SessionMiddleware",
     "django.middleware.common.CommonMiddleware",
@@ -54,7 +57,8 @@ ROOT_URLCONF = "gym_trainer_project.urls"
 
 TEMPLATES = [
     {
-        "BACKEND": "django.template.backends.django.DjangoTemplates",
+        # Times template rendering for the request metrics (trainer/monitoring.py)
+        "BACKEND": "trainer.monitoring.InstrumentedDjangoTemplates",
         "DIRS": [],
         "APP_DIRS": True,
         "OPTIONS": {
@@ -73,13 +77,76 @@ WSGI_APPLICATION = "gym_trainer_project.wsgi.application"
 # Database
 # https://docs.djangoproject.com/en/5.2/ref/settings/#databases
 
-DATABASES = {
-    "default": {
+# SQLite production profile. WAL lets requests read while another one
+# writes; busy_timeout makes a writer wait for the write lock instead of
+# failing; BEGIN IMMEDIATE takes that lock when a transaction starts, since a
+# transaction that reads first and then writes fails at once (whatever the
+# timeout) when another writer got in between. synchronous=NORMAL is safe with
+# WAL. Connections are kept between requests, so the pragmas run once per
+# connection. Writes that still hit the lock are retried (trainer/db_retry.py).
+SQLITE_OPTIONS = {
+    "init_command": (
+        "PRAGMA journal_mode = WAL;"
+        "PRAGMA synchronous = NORMAL;"
+        "PRAGMA busy_timeout = 5000;"
+        "PRAGMA cache_size = -20000;"  # 20 MB
+        "PRAGMA mmap_size = 134217728;"  # 128 MB
+        "PRAGMA temp_store = MEMORY;"
+    ),
+    "transaction_mode": "IMMEDIATE",
+}
+
+
+def sqlite_database(name):
+    return {
         "ENGINE": "django.db.backends.sqlite3",
-        "NAME": BASE_DIR / "db.sqlite3",
+        "NAME": BASE_DIR / name,
+        "OPTIONS": SQLITE_OPTIONS,
+        "CONN_MAX_AGE": 600,
+        "CONN_HEALTH_CHECKS": True,
+        # A file rather than Django's in-memory default, so tests run with
+        # WAL and real file locking; kept out of the checkout
+        "TEST": {"NAME": Path(tempfile.gettempdir()) / f"gym_trainer-test-{name}"},
     }
+
+
+DATABASES = {
+    "default": sqlite_database("db.sqlite3"),
+    # Second metrics shard, used once listed in TRAINER_METRICS_SHARDS
+    "shard2": sqlite_database("db-shard2.sqlite3"),
 }
 
+# Read replicas (see trainer/db_routing.py): reads in GET requests go to one of
+# these DATABASES aliases; writes, transactions and the requests in the
+# TRAINER_PRIMARY_PIN_SECONDS after a POST stay on "default". To try it locally
+# with two SQLite files:
+#
+#   DATABASES["replica"] = {
+#       "ENGINE": "django.db.backends.sqlite3",
+#       "NAME": BASE_DIR / "db-replica.sqlite3",
+#       "TEST": {"MIRROR": "default"},
+#   }
+#   TRAINER_READ_REPLICAS = ["replica"]
+#
+# and run `python manage.py replicate_sqlite` (optionally with --interval) to
+# copy the primary over the replica.
+#
+# Metrics shards (see trainer/sharding.py): the health metrics, renditions and
+# rollups of each member live on one of these aliases, e.g.
+#
+#   TRAINER_METRICS_SHARDS = ["default", "shard2"]
+#
+# The first shard keeps the rows of members who existed before sharding. Run
+# `python manage.py migrate_shards` after adding a shard and
+# `python manage.py rebalance_shards --even` to spread existing members.
+DATABASE_ROUTERS = ["trainer.sharding.ShardRouter", "trainer.db_routing.ReadReplicaRouter"]
+TRAINER_READ_REPLICAS = []
+TRAINER_PRIMARY_PIN_SECONDS = 5
+TRAINER_METRICS_SHARDS = []
+
+# Attempts after the first for writes that find the database locked
+TRAINER_WRITE_RETRIES = 5
+
 
 # Password validation
 # https://docs.djangoproject.com/en/5.2/ref/settings/#auth-password-validators
@@ -121,6 +188,17 @@ STATIC_URL = "static/"
 MEDIA_URL = "media/"
 MEDIA_ROOT = BASE_DIR / "media"
 
+# Cache
+# https://docs.djangoproject.com/en/5.2/topics/cache/
+# The local-memory cache is per process; use Redis or Memcached in production
+# so that invalidation reaches every worker.
+
+CACHES = {
+    "default": {
+        "BACKEND": "django.core.cache.backends.locmem.LocMemCache",
+    }
+}
+
 # Default primary key field type
 # https://docs.djangoproject.com/en/5.2/ref/settings/#default-auto-field
 
@@ -130,3 +208,31 @@ DEFAULT_AUTO_FIELD = "django.db.models.BigAutoField"
 LOGIN_URL = '/login/'
 LOGIN_REDIRECT_URL = '/dashboard/'
 LOGOUT_REDIRECT_URL = '/login/'
+
+# Progress photo processing
+# When enabled, uploads are stored as-is and compressed by a local worker pool
+# after the request has committed (see trainer/image_processing.py).
+TRAINER_ASYNC_IMAGE_PROCESSING = False
+TRAINER_IMAGE_WORKERS = 2
+# Uploads with more pixels are rejected before they are decoded (see trainer/image_decode.py)
+TRAINER_IMAGE_MAX_PIXELS = 50_000_000
+
+# Build a WebP copy of every progress photo rendition (see trainer/renditions.py)
+TRAINER_IMAGE_RENDITIONS_WEBP = True
+
+# Per-view request metrics, served in Prometheus format at /metrics to staff
+# users (see trainer/monitoring.py). A scraper gets in with
+# "Authorization: Bearer <TRAINER_METRICS_TOKEN>" or from an address in
+# TRAINER_METRICS_ALLOWED_IPS. Behind a reverse proxy every request comes from
+# the proxy, so do not list its address (e.g. 127.0.0.1) there: use the token.
+TRAINER_REQUEST_METRICS = True
+TRAINER_METRICS_TOKEN = ""
+TRAINER_METRICS_ALLOWED_IPS = []
+
+# Cache of the rendered dashboard fragments per user (see trainer/dashboard_cache.py)
+TRAINER_DASHBOARD_CACHE = "default"
+TRAINER_DASHBOARD_CACHE_TIMEOUT = 600
+
+# Short-lived cache of trainer search result pages (see trainer/trainer_search.py)
+TRAINER_SEARCH_CACHE = "default"
+TRAINER_SEARCH_CACHE_TIMEOUT = 60
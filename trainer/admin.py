@@ -1,5 +1,13 @@
+from django import forms
 from django.contrib import admin
-from .models import PersonalTrainer, UserHealthMetrics
+from django.contrib.admin.options import IncorrectLookupParameters
+from django.contrib.admin.widgets import AutocompleteSelect
+from django.contrib.auth.models import User
+from django.core.exceptions import ValidationError
+from django.core.paginator import Paginator
+from django.utils.functional import cached_property
+from .models import HealthMetricsRollup, ImageRendition, PersonalTrainer, UserHealthMetrics
+from .sharding import metric_shards, shard_for_pk, shard_for_user
 
 # Register your models here.
 @admin.register(PersonalTrainer)
@@ -10,15 +18,182 @@ class PersonalTrainerAdmin(admin.ModelAdmin):
 
 
 
+class CappedCountPaginator(Paginator):
+    """
+    Count at most max_pages pages of rows instead of running an exact COUNT(*)
+    over a huge table. ``count_capped`` tells the template to show "more than".
+    """
+    max_pages = 200
+
+    @cached_property
+    def count(self):
+        cap = self.per_page * self.max_pages
+        count = self.object_list[:cap + 1].count()
+        self.count_capped = count > cap
+        return min(count, cap)
+
+    count_capped = False
+
+
+class UserAutocompleteFilter(admin.SimpleListFilter):
+    """
+    Filter by user with an autocomplete box (backed by the User admin search)
+    instead of listing every user in the sidebar.
+    """
+    title = 'user'
+    parameter_name = 'user__id__exact'
+    template = 'admin/trainer/user_autocomplete_filter.html'
+
+    def lookups(self, request, model_admin):
+        return ()
+
+    def has_output(self):
+        return True
+
+    def queryset(self, request, queryset):
+        value = self.value()
+        if value:
+            if not value.isdigit():
+                raise IncorrectLookupParameters
+            return queryset.filter(user_id=value)
+        return queryset
+
+    def choices(self, changelist):
+        field = forms.ModelChoiceField(
+            queryset=User.objects.all(),
+            required=False,
+            widget=AutocompleteSelect(UserHealthMetrics._meta.get_field('user'), admin.site),
+        )
+        yield {
+            'widget': field.widget.render(self.parameter_name, self.value(), {'id': 'user-autocomplete-filter'}),
+            'query_string': changelist.get_query_string(remove=[self.parameter_name]),
+            'parameter_name': self.parameter_name,
+        }
+
+
+class ShardListFilter(admin.SimpleListFilter):
+    """
+    Pick the shard the change list shows: the filtered user's shard, or the
+    first one. Only shown when the metrics are sharded.
+    """
+    title = 'shard'
+    parameter_name = 'shard'
+
+    def lookups(self, request, model_admin):
+        return [(alias, alias) for alias in metric_shards()]
+
+    def has_output(self):
+        return bool(metric_shards())
+
+    def queryset(self, request, queryset):
+        shards = metric_shards()
+        if not shards:
+            return queryset
+        alias = self.value()
+        if alias is None:
+            user_id = request.GET.get(UserAutocompleteFilter.parameter_name, '')
+            alias = shard_for_user(int(user_id)) if user_id.isdigit() else shards[0]
+        elif alias not in shards:
+            raise IncorrectLookupParameters
+        return queryset.using(alias)
+
+    def choices(self, changelist):
+        # No "All": a change list reads one database
+        for lookup, title in self.lookup_choices:
+            yield {
+                'selected': self.value() == str(lookup),
+                'query_string': changelist.get_query_string({self.parameter_name: lookup}),
+                'display': title,
+            }
+
+
+class ShardedModelAdmin(admin.ModelAdmin):
+    """
+    Admin of a sharded model. With sharding on, the change list shows one
+    shard at a time (ShardListFilter), users are prefetched from default
+    instead of joined, searches on user fields look the users up first and
+    objects are loaded from the shard their id belongs to.
+    """
+    # Related users (or metrics) to prefetch instead of list_select_related
+    shard_prefetch = ['user']
+    # Users matched by a search on a sharded change list
+    max_search_users = 500
+
+    def get_list_filter(self, request):
+        return [ShardListFilter, *super().get_list_filter(request)]
+
+    def get_list_select_related(self, request):
+        return [] if metric_shards() else super().get_list_select_related(request)
+
+    def get_queryset(self, request):
+        queryset = super().get_queryset(request)
+        return queryset.prefetch_related(*self.shard_prefetch) if metric_shards() else queryset
+
+    def get_search_results(self, request, queryset, search_term):
+        if not metric_shards() or not search_term or not self.get_search_fields(request):
+            return super().get_search_results(request, queryset, search_term)
+        # Run the search on the users (on default), then filter the shard by their ids
+        user_admin = admin.ModelAdmin(User, self.admin_site)
+        user_admin.search_fields = [field.replace('user__', '', 1) for field in self.get_search_fields(request)]
+        users, _ = user_admin.get_search_results(request, User.objects.all(), search_term)
+        user_ids = list(users.values_list('pk', flat=True)[:self.max_search_users])
+        return queryset.filter(user_id__in=user_ids), False
+
+    def get_object(self, request, object_id, from_field=None):
+        if not metric_shards() or from_field is not None:
+            return super().get_object(request, object_id, from_field)
+        try:
+            return self.get_queryset(request).using(shard_for_pk(object_id)).get(pk=object_id)
+        except (self.model.DoesNotExist, ValidationError, ValueError):
+            return None
+
+
 @admin.register(UserHealthMetrics)
-class UserHealthMetricsAdmin(admin.ModelAdmin):
+class UserHealthMetricsAdmin(ShardedModelAdmin):
     list_display = ['user', 'recorded_date', 'weight', 'thigh_length', 'hip_length', 'has_image', 'wakeup_datetime', 'sleeping_datetime']
-    list_filter = ['recorded_date', 'user']
-    search_fields = ['user__username', 'user__first_name', 'user__last_name']
+    list_filter = [UserAutocompleteFilter, 'image_status']
+    list_select_related = ['user']
+    # Prefix searches use the auth_user prefix indexes (migration 0012)
+    search_fields = ['^user__username', '^user__first_name', '^user__last_name']
+    # Rendered by the indexed_date_hierarchy tag (see the change_list.html override)
     date_hierarchy = 'recorded_date'
+    autocomplete_fields = ['user']
     readonly_fields = ['created_at', 'updated_at']
+    paginator = CappedCountPaginator
+    show_full_result_count = False
     
     def has_image(self, obj):
         return bool(obj.image)
     has_image.boolean = True
     has_image.short_description = 'Image'
+
+    @property
+    def media(self):
+        # The user filter renders an autocomplete widget on the change list
+        return super().media + AutocompleteSelect(UserHealthMetrics._meta.get_field('user'), self.admin_site).media
+
+
+
+@admin.register(ImageRendition)
+class ImageRenditionAdmin(ShardedModelAdmin):
+    shard_prefetch = ['metric__user']
+    list_display = ['metric', 'kind', 'format', 'width', 'height', 'created_at']
+    list_filter = ['kind', 'format']
+    raw_id_fields = ['metric']
+    readonly_fields = ['source_name', 'created_at']
+
+
+
+@admin.register(HealthMetricsRollup)
+class HealthMetricsRollupAdmin(ShardedModelAdmin):
+    list_display = ['user', 'period', 'period_start', 'count', 'weight_avg', 'weight_min', 'weight_max', 'sleep_hours_avg']
+    list_filter = ['period']
+    search_fields = ['user__username']
+    raw_id_fields = ['user']
+    date_hierarchy = 'period_start'
+
+    def has_add_permission(self, request):
+        return False
+
+    def has_change_permission(self, request, obj=None):
+        return False
@@ -0,0 +1,47 @@
+"""
+Independent queries of async views, run at the same time.
+
+Django's async ORM methods (aget(), afirst(), aaggregate(), ...) run the
+sync ORM on the request's single worker thread, so awaiting several of them
+together still runs them one after another. gather_queries() runs the first
+of several sync callables on the request's thread and the others on threads
+of their own, each with its own database connections, as fan_out() does for
+shards. A thread only connects if its callable queries, so put the one most
+likely to query first. The calls keep the request's read routing and count
+towards its request metrics.
+"""
+import asyncio
+
+from asgiref.sync import sync_to_async
+from django.db import connections
+
+from .monitoring import counting_queries
+
+
+def _in_transaction():
+    return any(connection.in_atomic_block for connection in connections.all(initialized_only=True))
+
+
+def _run_in_thread(query):
+    try:
+        with counting_queries():
+            return query()
+    finally:
+        # Each thread opened its own connections
+        connections.close_all()
+
+
+async def gather_queries(*queries):
+    """
+    Call the sync callables queries at the same time and return their
+    results in order. They run one after another on the request's thread
+    when there is only one, or when a transaction is open (another
+    connection could not see its uncommitted writes).
+    """
+    if len(queries) < 2 or await sync_to_async(_in_transaction)():
+        return [await sync_to_async(query)() for query in queries]
+    first, *others = queries
+    return await asyncio.gather(
+        sync_to_async(first)(),
+        *(sync_to_async(_run_in_thread, thread_sensitive=False)(query) for query in others),
+    )
@@ -0,0 +1,4 @@
+from . import async_views
+from .urls import app_name, trainer_urlpatterns  # noqa: F401
+
+urlpatterns = trainer_urlpatterns(async_views)
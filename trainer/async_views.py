@@ -0,0 +1,145 @@
+"""
+Async versions of the read views, served under ASGI (see
+gym_trainer_project/asgi_urls.py).
+
+Each request's sync ORM calls run on a worker thread of its own, leaving the
+event loop free for other requests. The dashboard's independent lookups (its
+two cached fragments and the trainer profile, and the validators' metrics
+state and trainer profile) run at the same time with gather_queries();
+single lookups use the async ORM. Templates, whose context processors read
+the session and the user, are rendered on the worker thread.
+
+The sync views in views.py remain the ones served under WSGI; both share
+their query parsing and context building.
+"""
+from functools import partial, wraps
+
+from asgiref.sync import sync_to_async
+from django.contrib.auth.decorators import login_required
+from django.contrib.auth.models import User
+from django.db.models import Max, Min
+from django.http import HttpResponse, JsonResponse
+from django.shortcuts import render
+from django.views.decorators.gzip import gzip_page
+
+from .async_queries import gather_queries
+from .conditional import (
+    adashboard_validators, conditional_page, health_metrics_validators, trainer_profile_validators,
+)
+from .dashboard_cache import FRAGMENT_CHARTS, FRAGMENT_PHOTOS, cached_fragment, cached_trainer_profile
+from .models import PersonalTrainer, UserHealthMetrics
+from .series import metric_series
+from .user_search import search_users
+from .views import (
+    dashboard_context, dashboard_user, health_metrics_context, render_dashboard_charts, render_dashboard_photos,
+    series_params, series_window, trainer_list_context, user_search_params,
+)
+
+arender = sync_to_async(render)
+
+
+def user_loaded(view):
+    """
+    Load request.user with the async API before the view runs. Reading the
+    lazy request.user from the event loop would query synchronously, and from
+    a worker thread it would be loaded a second time.
+    """
+    @wraps(view)
+    async def wrapper(request, *args, **kwargs):
+        request.user = await request.auser()
+        return await view(request, *args, **kwargs)
+
+    return wrapper
+
+
+@login_required
+@user_loaded
+@gzip_page
+@conditional_page(adashboard_validators)
+async def dashboard(request):
+    viewing_user, selected_user = await sync_to_async(dashboard_user)(request)
+    charts_fragment, photos_fragment, trainer_profile = await gather_queries(
+        partial(cached_fragment, FRAGMENT_CHARTS, viewing_user.pk, partial(render_dashboard_charts, viewing_user)),
+        partial(cached_fragment, FRAGMENT_PHOTOS, viewing_user.pk, partial(render_dashboard_photos, viewing_user)),
+        partial(cached_trainer_profile, request.user),
+    )
+    context = dashboard_context(
+        request, viewing_user, selected_user, charts_fragment, photos_fragment, trainer_profile
+    )
+    return await arender(request, 'trainer/dashboard.html', context)
+
+
+@login_required
+@user_loaded
+@gzip_page
+async def metrics_series(request):
+    """Async metrics_series: chart data as columnar JSON."""
+    viewing_user = request.user
+    is_admin = request.user.is_superuser or request.user.is_staff
+    if is_admin and request.GET.get('user_id'):
+        try:
+            viewing_user = await User.objects.aget(id=int(request.GET.get('user_id')))
+        except (ValueError, User.DoesNotExist):
+            return JsonResponse({'error': 'Invalid user.'}, status=400)
+
+    try:
+        resolution, start_date, end_date, days = series_params(request)
+    except ValueError as e:
+        return JsonResponse({'error': str(e)}, status=400)
+
+    if start_date is None or end_date is None:
+        metrics = await sync_to_async(UserHealthMetrics.objects.for_user)(viewing_user)
+        bounds = await metrics.aaggregate(first=Min('recorded_date'), last=Max('recorded_date'))
+        start_date, end_date = series_window(bounds, start_date, end_date, days)
+
+    if start_date > end_date:
+        return JsonResponse({'error': 'start must not be after end.'}, status=400)
+
+    return JsonResponse(await sync_to_async(metric_series)(viewing_user, start_date, end_date, resolution))
+
+
+@login_required
+@user_loaded
+@gzip_page
+async def user_search(request):
+    """Async user_search: one page of the dashboard user picker. Admins only."""
+    if not (request.user.is_superuser or request.user.is_staff):
+        return JsonResponse({'error': 'Forbidden.'}, status=403)
+
+    try:
+        query, page, page_size = user_search_params(request)
+    except ValueError:
+        return JsonResponse({'error': 'Invalid page.'}, status=400)
+
+    results, has_more = await sync_to_async(search_users)(query, page, page_size)
+    return JsonResponse({'results': results, 'page': page, 'has_more': has_more})
+
+
+@login_required
+@user_loaded
+@gzip_page
+@conditional_page(health_metrics_validators)
+async def health_metrics(request):
+    """Async health_metrics: the member's history, newest first, paginated with cursors."""
+    context = await sync_to_async(health_metrics_context)(request)
+    return await arender(request, 'trainer/health_metrics.html', context)
+
+
+@user_loaded
+@gzip_page
+async def trainer_list(request):
+    """Async trainer_list: available trainers, filtered, sorted and paginated."""
+    # The filters are checked against the specializations, so the search has to wait for them
+    context = await sync_to_async(trainer_list_context)(request)
+    return await arender(request, 'trainer/trainer_list.html', context)
+
+
+@user_loaded
+@gzip_page
+@conditional_page(trainer_profile_validators)
+async def trainer_profile(request, trainer_id):
+    try:
+        trainer = await PersonalTrainer.objects.select_related('user').aget(id=trainer_id)
+    except PersonalTrainer.DoesNotExist:
+        return HttpResponse("Trainer not found.", status=404)
+    return await arender(request, 'trainer/trainer_profile.html', {'trainer': trainer})
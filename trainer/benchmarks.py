@@ -0,0 +1,227 @@
+"""
+Benchmarks of the trainer app's hot views.
+
+Each scenario is requested through the Django test client against a seeded
+database. After a warm-up request we record the SQL query count, wall time
+over repeated requests, and the number of bytes rendered. Results can be
+compared against the budgets in ``benchmark_budgets.json``; the test suite
+uses the same file to guard query counts. The latency budgets leave about
+three times the p50 measured on a developer laptop, as they depend on the
+machine.
+"""
+import json
+import statistics
+import time
+from datetime import date, timedelta
+from io import BytesIO, StringIO
+from pathlib import Path
+
+from django.contrib.auth.models import User
+from django.core.files.uploadedfile import SimpleUploadedFile
+from django.core.management import call_command
+from django.db import connection
+from django.test import Client
+from django.urls import reverse
+from PIL import Image
+
+from .models import PersonalTrainer
+
+BUDGETS_PATH = Path(__file__).resolve().parent / 'benchmark_budgets.json'
+
+ADMIN_USERNAME = 'bench_admin'
+MEMBER_USERNAME = 'user1'
+
+SAVEPOINT_STATEMENTS = ('SAVEPOINT', 'RELEASE SAVEPOINT', 'ROLLBACK TO SAVEPOINT')
+
+
+class Scenario:
+    """One request to benchmark, made as the member or as the admin."""
+
+    def __init__(self, name, url, as_admin=False, method='get', data=None):
+        self.name = name
+        self.url = url
+        self.as_admin = as_admin
+        self.method = method
+        # Callable returning fresh POST data (uploads cannot be reused)
+        self.data = data
+
+    def request(self, client, iteration):
+        if self.method == 'post':
+            return client.post(self.url(), self.data(iteration))
+        return client.get(self.url())
+
+
+def _health_metrics_post(with_image):
+    def data(iteration):
+        payload = {
+            'date': (date.today() - timedelta(days=iteration)).isoformat(),
+            'sleep_hour': '10', 'sleep_minute': '30', 'sleep_ampm': 'PM',
+            'wakeup_hour': '6', 'wakeup_minute': '45', 'wakeup_ampm': 'AM',
+            'weight': '72.50', 'thigh_length': '56.00', 'hip_length': '94.00',
+        }
+        if with_image:
+            payload['image'] = sample_photo()
+        return payload
+    return data
+
+
+def sample_photo(size=(3000, 4000)):
+    """Return a phone-sized JPEG upload."""
+    output = BytesIO()
+    Image.new('RGB', size, (180, 120, 90)).save(output, format='JPEG', quality=90)
+    return SimpleUploadedFile('progress.jpg', output.getvalue(), content_type='image/jpeg')
+
+
+def scenarios():
+    """Return the benchmarked scenarios. Call after seed_fixture()."""
+    member_id = User.objects.get(username=MEMBER_USERNAME).pk
+    return [
+        Scenario('dashboard', lambda: reverse('trainer:dashboard')),
+        Scenario(
+            'dashboard_admin',
+            lambda: f"{reverse('trainer:dashboard')}?user_id={member_id}",
+            as_admin=True,
+        ),
+        Scenario('health_metrics', lambda: reverse('trainer:health_metrics')),
+        Scenario(
+            'add_health_metrics',
+            lambda: reverse('trainer:add_health_metrics'),
+            method='post',
+            data=_health_metrics_post(with_image=False),
+        ),
+        Scenario(
+            'add_health_metrics_image',
+            lambda: reverse('trainer:add_health_metrics'),
+            method='post',
+            data=_health_metrics_post(with_image=True),
+        ),
+        Scenario('trainer_list', lambda: reverse('trainer:trainer_list')),
+        Scenario(
+            'admin_metrics_changelist',
+            lambda: reverse('admin:trainer_userhealthmetrics_changelist'),
+            as_admin=True,
+        ),
+    ]
+
+
+def seed_fixture(users=200, days=365, trainers=50, photo_ratio=0.05, seed=0):
+    """Fill the current database with the standard benchmark fixture."""
+    call_command(
+        'populate_health_data',
+        users=users, days=days, seed=seed, photo_ratio=photo_ratio,
+        start_date=date.today() - timedelta(days=days + 30),
+        workers=1, stdout=StringIO(),
+    )
+    User.objects.filter(username__in=[f'user{i}' for i in range(1, 11)]).update(
+        first_name='Bench', last_name='Member'
+    )
+    for user in User.objects.filter(username__startswith='user').order_by('id')[:trainers]:
+        PersonalTrainer.objects.get_or_create(
+            user=user,
+            defaults={
+                'specialization': ['Strength', 'Cardio', 'Yoga', 'Mobility'][user.pk % 4],
+                'experience_years': user.pk % 20,
+                'hourly_rate': 30 + user.pk % 70,
+                'bio': 'Certified personal trainer focused on sustainable progress. ' * 3,
+            },
+        )
+    if not User.objects.filter(username=ADMIN_USERNAME).exists():
+        User.objects.create_superuser(ADMIN_USERNAME, f'{ADMIN_USERNAME}@example.com', 'bench')
+
+
+def _response_bytes(response):
+    if response.streaming:
+        return sum(len(chunk) for chunk in response.streaming_content)
+    return len(response.content)
+
+
+class QueryCounter:
+    """
+    Count queries through a connection execute wrapper. Unlike
+    CaptureQueriesContext this does not depend on DEBUG or on the query log,
+    which is reset at the start of every request. Savepoint statements are
+    not counted: they only appear when a test wraps the request in a
+    transaction, so counting them would make tests and benchmarks disagree.
+    """
+
+    def __init__(self):
+        self.count = 0
+
+    def __call__(self, execute, sql, params, many, context):
+        if not sql.lstrip().upper().startswith(SAVEPOINT_STATEMENTS):
+            self.count += 1
+        return execute(sql, params, many, context)
+
+    def __len__(self):
+        return self.count
+
+
+def measure(scenario, client, repeat=10):
+    """Return the query count, timings (ms) and response size of one scenario."""
+    # Warm up caches and on-demand work (e.g. photo renditions) first
+    response = scenario.request(client, 0)
+    if response.status_code >= 400:
+        raise RuntimeError(f'{scenario.name} returned HTTP {response.status_code}')
+
+    queries = QueryCounter()
+    with connection.execute_wrapper(queries):
+        response = scenario.request(client, 1)
+    size = _response_bytes(response)
+
+    timings = []
+    for iteration in range(2, repeat + 2):
+        started = time.perf_counter()
+        response = scenario.request(client, iteration)
+        _response_bytes(response)
+        timings.append((time.perf_counter() - started) * 1000)
+
+    timings.sort()
+    return {
+        'status': response.status_code,
+        'queries': len(queries),
+        'bytes': size,
+        'p50_ms': round(statistics.median(timings), 2),
+        'p95_ms': round(timings[min(len(timings) - 1, int(len(timings) * 0.95))], 2),
+        'mean_ms': round(statistics.fmean(timings), 2),
+    }
+
+
+def run_benchmarks(repeat=10, only=None):
+    """Run every scenario (or those named in only) and return results keyed by name."""
+    member = User.objects.get(username=MEMBER_USERNAME)
+    admin = User.objects.get(username=ADMIN_USERNAME)
+    member_client = Client()
+    member_client.force_login(member)
+    admin_client = Client()
+    admin_client.force_login(admin)
+
+    results = {}
+    for scenario in scenarios():
+        if only and scenario.name not in only:
+            continue
+        client = admin_client if scenario.as_admin else member_client
+        results[scenario.name] = measure(scenario, client, repeat)
+    return results
+
+
+def load_budgets(path=BUDGETS_PATH):
+    with open(path) as f:
+        return json.load(f)
+
+
+def compare_with_budgets(results, budgets):
+    """
+    Return (query overruns, latency overruns) as lists of human-readable
+    messages. Query counts are deterministic; latency depends on the machine.
+    """
+    query_overruns = []
+    latency_overruns = []
+    for name, result in results.items():
+        budget = budgets.get(name)
+        if not budget:
+            continue
+        if 'queries' in budget and result['queries'] > budget['queries']:
+            query_overruns.append(f"{name}: {result['queries']} queries (budget {budget['queries']})")
+        if 'p50_ms' in budget and result['p50_ms'] > budget['p50_ms']:
+            latency_overruns.append(f"{name}: p50 {result['p50_ms']}ms (budget {budget['p50_ms']}ms)")
+    return query_overruns, latency_overruns
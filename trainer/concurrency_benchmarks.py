@@ -0,0 +1,246 @@
+"""
+Benchmark of the read views under concurrent load: the sync views behind
+Django's WSGI handler against the async views behind its ASGI handler.
+
+Requests are handed straight to the handlers, in process and without a
+network server: under WSGI by ``concurrency`` threads, as a threaded server
+(e.g. gunicorn's gthread workers) would, and under ASGI by ``concurrency``
+tasks on one event loop, as uvicorn would. The ASGI run uses the urlconf and
+per-request connections of gym_trainer_project/asgi_settings.py. Each
+scenario is warmed up in both modes first; throughput and latency
+percentiles are then recorded over the same number of requests.
+
+SQLite answers in microseconds, so overlapping queries gains little
+locally. ``db_latency`` adds a round trip to every query (a sleep, which
+like a network wait releases the GIL) to model a database server.
+"""
+import asyncio
+import statistics
+import sys
+import threading
+import time
+from contextlib import contextmanager
+from io import BytesIO
+
+from django.conf import settings
+from django.contrib.auth.models import User
+from django.core.handlers.asgi import ASGIHandler
+from django.core.handlers.wsgi import WSGIHandler
+from django.db import connections
+from django.db.backends.signals import connection_created
+from django.test import Client
+from django.test.utils import override_settings
+
+from .benchmarks import ADMIN_USERNAME, MEMBER_USERNAME, scenarios
+
+WSGI = 'wsgi'
+ASGI = 'asgi'
+MODES = (WSGI, ASGI)
+
+ASGI_URLCONF = 'gym_trainer_project.asgi_urls'
+
+# GET scenarios of benchmarks.scenarios() served by views with an async version
+READ_SCENARIOS = ('dashboard', 'dashboard_admin', 'health_metrics', 'trainer_list')
+
+
+@contextmanager
+def asgi_settings():
+    """What asgi_settings changes: the async read views, and no persistent connections."""
+    saved = {alias: connections.settings[alias]['CONN_MAX_AGE'] for alias in connections.settings}
+    for alias in saved:
+        connections.settings[alias]['CONN_MAX_AGE'] = 0
+    try:
+        with override_settings(ROOT_URLCONF=ASGI_URLCONF):
+            yield
+    finally:
+        for alias, max_age in saved.items():
+            connections.settings[alias]['CONN_MAX_AGE'] = max_age
+
+
+@contextmanager
+def simulated_latency(seconds):
+    """Delay every query by seconds on the connections opened meanwhile (the handlers' threads open their own)."""
+    def delay(execute, sql, params, many, context):
+        time.sleep(seconds)
+        return execute(sql, params, many, context)
+
+    def add_delay(sender, connection, **kwargs):
+        if delay not in connection.execute_wrappers:
+            # First: execute_wrapper() blocks open on the connection remove the last one on exit
+            connection.execute_wrappers.insert(0, delay)
+
+    if not seconds:
+        yield
+        return
+    connection_created.connect(add_delay)
+    try:
+        yield
+    finally:
+        connection_created.disconnect(add_delay)
+
+
+def wsgi_get(handler, url, cookie):
+    """GET url through a WSGI handler. Returns the status code."""
+    path, _, query = url.partition('?')
+    environ = {
+        'REQUEST_METHOD': 'GET',
+        'SCRIPT_NAME': '',
+        'PATH_INFO': path,
+        'QUERY_STRING': query,
+        'SERVER_NAME': 'testserver',
+        'SERVER_PORT': '80',
+        'SERVER_PROTOCOL': 'HTTP/1.1',
+        'REMOTE_ADDR': '127.0.0.1',
+        'HTTP_HOST': 'testserver',
+        'HTTP_COOKIE': cookie,
+        'wsgi.version': (1, 0),
+        'wsgi.url_scheme': 'http',
+        'wsgi.input': BytesIO(),
+        'wsgi.errors': sys.stderr,
+        'wsgi.multithread': True,
+        'wsgi.multiprocess': False,
+        'wsgi.run_once': False,
+    }
+    statuses = []
+    response = handler(environ, lambda status, headers: statuses.append(status))
+    try:
+        for _ in response:
+            pass
+    finally:
+        # Sends request_finished, as a WSGI server does
+        response.close()
+    return int(statuses[0].split()[0])
+
+
+async def asgi_get(handler, url, cookie):
+    """GET url through an ASGI handler. Returns the status code."""
+    path, _, query = url.partition('?')
+    scope = {
+        'type': 'http',
+        'asgi': {'version': '3.0'},
+        'http_version': '1.1',
+        'method': 'GET',
+        'scheme': 'http',
+        'path': path,
+        'raw_path': path.encode(),
+        'query_string': query.encode(),
+        'root_path': '',
+        'headers': [(b'host', b'testserver'), (b'cookie', cookie.encode())],
+        'client': ('127.0.0.1', 0),
+        'server': ('testserver', 80),
+    }
+    body_sent = False
+    statuses = []
+
+    async def receive():
+        nonlocal body_sent
+        if not body_sent:
+            body_sent = True
+            return {'type': 'http.request', 'body': b'', 'more_body': False}
+        # The client stays connected until the handler is done
+        await asyncio.Event().wait()
+
+    async def send(message):
+        if message['type'] == 'http.response.start':
+            statuses.append(message['status'])
+
+    await handler(scope, receive, send)
+    return statuses[0]
+
+
+def _summary(latencies, errors, seconds):
+    latencies.sort()
+    return {
+        'requests': len(latencies),
+        'errors': errors,
+        'requests_per_second': round(len(latencies) / seconds, 1),
+        'p50_ms': round(statistics.median(latencies), 2),
+        'p95_ms': round(latencies[min(len(latencies) - 1, int(len(latencies) * 0.95))], 2),
+    }
+
+
+def run_wsgi(url, cookie, concurrency, requests):
+    """Make requests GETs of url from concurrency threads through a WSGI handler."""
+    handler = WSGIHandler()
+    wsgi_get(handler, url, cookie)
+    remaining = iter(range(requests))
+    lock = threading.Lock()
+    latencies = []
+    errors = []
+
+    def worker():
+        try:
+            while True:
+                with lock:
+                    if next(remaining, None) is None:
+                        return
+                started = time.perf_counter()
+                status = wsgi_get(handler, url, cookie)
+                elapsed = (time.perf_counter() - started) * 1000
+                with lock:
+                    latencies.append(elapsed)
+                    if status != 200:
+                        errors.append(status)
+        finally:
+            # Persistent connections of this thread
+            connections.close_all()
+
+    threads = [threading.Thread(target=worker) for _ in range(concurrency)]
+    started = time.perf_counter()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return _summary(latencies, len(errors), time.perf_counter() - started)
+
+
+def run_asgi(url, cookie, concurrency, requests):
+    """Make requests GETs of url from concurrency tasks through an ASGI handler."""
+    with asgi_settings():
+        handler = ASGIHandler()
+
+        async def run():
+            await asgi_get(handler, url, cookie)
+            remaining = iter(range(requests))
+            latencies = []
+            errors = []
+
+            async def worker():
+                while next(remaining, None) is not None:
+                    started = time.perf_counter()
+                    status = await asgi_get(handler, url, cookie)
+                    latencies.append((time.perf_counter() - started) * 1000)
+                    if status != 200:
+                        errors.append(status)
+
+            started = time.perf_counter()
+            await asyncio.gather(*(worker() for _ in range(concurrency)))
+            return _summary(latencies, len(errors), time.perf_counter() - started)
+
+        return asyncio.run(run())
+
+
+def _session_cookie(username):
+    client = Client()
+    client.force_login(User.objects.get(username=username))
+    return f'{settings.SESSION_COOKIE_NAME}={client.cookies[settings.SESSION_COOKIE_NAME].value}'
+
+
+def run_concurrency_benchmark(concurrency=16, requests=200, only=None, modes=MODES, db_latency=0):
+    """
+    Run every read scenario (or those named in only) in each mode, with
+    db_latency seconds added to each query. Returns {scenario: {mode:
+    summary}}. Call after benchmarks.seed_fixture().
+    """
+    cookies = {False: _session_cookie(MEMBER_USERNAME), True: _session_cookie(ADMIN_USERNAME)}
+    runners = {WSGI: run_wsgi, ASGI: run_asgi}
+    results = {}
+    for scenario in scenarios():
+        if scenario.name not in READ_SCENARIOS or (only and scenario.name not in only):
+            continue
+        url = scenario.url()
+        with simulated_latency(db_latency):
+            results[scenario.name] = {
+                mode: runners[mode](url, cookies[scenario.as_admin], concurrency, requests) for mode in modes
+            }
+    return results
@@ -0,0 +1,163 @@
+"""
+Conditional GET (ETag / Last-Modified) for the dashboard, history and
+trainer profile pages.
+
+Each page's validators come from one indexed query over the rows it shows:
+the latest ``updated_at`` and the row count (deletions do not move the
+maximum). Staff viewing another member's dashboard also load that account,
+which lives on ``default`` while the metrics may be on a shard. A browser
+revalidating an unchanged page gets a 304 before the view runs. Responses are marked ``Cache-Control: private, no-cache`` so browsers
+keep them but always revalidate instead of guessing a lifetime from
+Last-Modified.
+
+Async views get their validators before condition() runs, since it calls
+the validator functions synchronously; validators may then be coroutine
+functions.
+
+Writes that bypass ``auto_now`` (queryset ``update()``, bulk imports) must set
+``updated_at`` themselves or these pages will not notice the change.
+"""
+import hashlib
+from functools import partial, wraps
+
+from asgiref.sync import iscoroutinefunction, sync_to_async
+from django.contrib.auth.models import User
+from django.contrib.messages import get_messages
+from django.db.models import Count, Max
+from django.views.decorators.cache import cache_control
+from django.views.decorators.http import condition
+
+from .async_queries import gather_queries
+from .dashboard_cache import cached_trainer_profile
+from .models import PersonalTrainer, UserHealthMetrics
+
+
+def make_etag(*parts):
+    return hashlib.md5(repr(parts).encode()).hexdigest()
+
+
+def _viewer(request):
+    """What base.html shows of the logged-in user, and the CSRF secret the page's forms use."""
+    user = request.user
+    return (
+        user.pk,
+        user.get_username(),
+        user.is_staff,
+        user.is_superuser,
+        request.META.get('CSRF_COOKIE', ''),
+    )
+
+
+def _latest(*values):
+    values = [value for value in values if value is not None]
+    return max(values) if values else None
+
+
+def conditional_page(validators):
+    """
+    Add ETag / Last-Modified support to a view. validators(request, *args,
+    **kwargs) returns (etag, last_modified); either may be None. Nothing is
+    checked while flash messages are pending, so they are never hidden by a 304.
+    Async views take sync or async validators.
+    """
+    def decorator(view):
+        def get_validators(request, *args, **kwargs):
+            # condition() asks for the ETag and Last-Modified separately; look up once
+            if not hasattr(request, '_trainer_validators'):
+                if _messages_pending(request):
+                    request._trainer_validators = (None, None)
+                else:
+                    request._trainer_validators = validators(request, *args, **kwargs)
+            return request._trainer_validators
+
+        conditional_view = condition(
+            etag_func=lambda request, *args, **kwargs: get_validators(request, *args, **kwargs)[0],
+            last_modified_func=lambda request, *args, **kwargs: get_validators(request, *args, **kwargs)[1],
+        )(view)
+
+        if iscoroutinefunction(view):
+            get_async_validators = validators if iscoroutinefunction(validators) else sync_to_async(validators)
+            conditional_async_view = conditional_view
+
+            @wraps(view)
+            async def conditional_view(request, *args, **kwargs):
+                if not hasattr(request, '_trainer_validators'):
+                    # Messages may live in the session, which is read synchronously
+                    if await sync_to_async(_messages_pending)(request):
+                        request._trainer_validators = (None, None)
+                    else:
+                        request._trainer_validators = await get_async_validators(request, *args, **kwargs)
+                return await conditional_async_view(request, *args, **kwargs)
+
+        return cache_control(private=True, no_cache=True)(conditional_view)
+
+    return decorator
+
+
+def _messages_pending(request):
+    return len(get_messages(request)) > 0
+
+
+def _metrics_state(user):
+    """Latest change and number of the user's metrics, read from the (user, updated_at) index."""
+    return UserHealthMetrics.objects.for_user(user).aggregate(last=Max('updated_at'), count=Count('*'))
+
+
+def _requested_user_id(request):
+    """Id in ?user_id= of a staff member viewing another member, None otherwise. Raises ValueError."""
+    if (request.user.is_superuser or request.user.is_staff) and request.GET.get('user_id'):
+        return int(request.GET['user_id'])
+    return None
+
+
+def _dashboard_validators(request, viewing_user, state, trainer_profile):
+    trainer_updated = trainer_profile.updated_at if trainer_profile is not None else None
+    viewed = (viewing_user.pk, viewing_user.username, viewing_user.first_name, viewing_user.last_name)
+    return (
+        make_etag('dashboard', _viewer(request), viewed, state, trainer_updated),
+        _latest(state['last'], trainer_updated),
+    )
+
+
+def dashboard_validators(request):
+    try:
+        user_id = _requested_user_id(request)
+    except ValueError:
+        return None, None
+    viewing_user = request.user if user_id is None else User.objects.filter(pk=user_id).first()
+    if viewing_user is None:
+        return None, None
+    return _dashboard_validators(
+        request, viewing_user, _metrics_state(viewing_user), cached_trainer_profile(request.user)
+    )
+
+
+async def adashboard_validators(request):
+    """dashboard_validators() for the async dashboard, looking up the metrics and the trainer profile together."""
+    try:
+        user_id = _requested_user_id(request)
+    except ValueError:
+        return None, None
+    viewing_user = request.user if user_id is None else await User.objects.filter(pk=user_id).afirst()
+    if viewing_user is None:
+        return None, None
+    state, trainer_profile = await gather_queries(
+        partial(_metrics_state, viewing_user), partial(cached_trainer_profile, request.user)
+    )
+    return _dashboard_validators(request, viewing_user, state, trainer_profile)
+
+
+def health_metrics_validators(request):
+    state = _metrics_state(request.user)
+    return make_etag('health_metrics', _viewer(request), state), state['last']
+
+
+def trainer_profile_validators(request, trainer_id):
+    state = (
+        PersonalTrainer.objects.filter(pk=trainer_id)
+        .values_list('updated_at', 'user__first_name', 'user__last_name')
+        .first()
+    )
+    if state is None:
+        return None, None
+    return make_etag('trainer_profile', _viewer(request), trainer_id, state), state[0]
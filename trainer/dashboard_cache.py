@@ -0,0 +1,92 @@
+"""
+Per-user caching of the dashboard.
+
+The charts and recent photos fragments are rendered once per viewed user and
+kept in the cache named by ``TRAINER_DASHBOARD_CACHE``; the logged-in user's
+trainer profile is cached the same way. Every key contains the id of the user
+the entry describes, so a staff member viewing ``?user_id=`` gets that user's
+fragments and never their own (or the other way round).
+
+Entries are dropped by the signal handlers in signals.py when a
+UserHealthMetrics or PersonalTrainer row changes, and explicitly by code that
+writes without signals (bulk imports, background photo processing). Use a
+shared cache backend in production so that every worker sees the invalidation.
+"""
+from django.conf import settings
+from django.core.cache import caches
+from django.db import transaction
+from django.utils.safestring import mark_safe
+
+from .monitoring import registry
+
+FRAGMENT_CHARTS = 'charts'
+FRAGMENT_PHOTOS = 'photos'
+FRAGMENTS = [FRAGMENT_CHARTS, FRAGMENT_PHOTOS]
+
+TRAINER_PROFILE = 'trainer_profile'
+
+HITS_METRIC = 'trainer_dashboard_cache_hits_total'
+MISSES_METRIC = 'trainer_dashboard_cache_misses_total'
+
+
+def get_cache():
+    return caches[getattr(settings, 'TRAINER_DASHBOARD_CACHE', 'default')]
+
+
+def cache_timeout():
+    return getattr(settings, 'TRAINER_DASHBOARD_CACHE_TIMEOUT', 600)
+
+
+def cache_key(entry, user_id):
+    return f'trainer:dashboard:{entry}:{user_id}'
+
+
+def _count(entry, hit):
+    if hit:
+        registry.increment(HITS_METRIC, 'Dashboard cache hits by entry.', entry=entry)
+    else:
+        registry.increment(MISSES_METRIC, 'Dashboard cache misses by entry.', entry=entry)
+
+
+def cached_fragment(fragment, user_id, render_fragment):
+    """Return the HTML of a dashboard fragment, calling render_fragment() on a miss."""
+    key = cache_key(fragment, user_id)
+    cache = get_cache()
+    html = cache.get(key)
+    _count(fragment, html is not None)
+    if html is None:
+        html = render_fragment()
+        cache.set(key, str(html), cache_timeout())
+    return mark_safe(html)
+
+
+def cached_trainer_profile(user):
+    """Return the user's PersonalTrainer profile or None, cached per user."""
+    from .models import PersonalTrainer
+
+    key = cache_key(TRAINER_PROFILE, user.pk)
+    cache = get_cache()
+    # Wrapped in a tuple so that "not a trainer" (None) can be cached too
+    entry = cache.get(key)
+    _count(TRAINER_PROFILE, entry is not None)
+    if entry is None:
+        entry = (PersonalTrainer.objects.filter(user=user).first(),)
+        cache.set(key, entry, cache_timeout())
+    return entry[0]
+
+
+def invalidate_users(user_ids, using=None):
+    """
+    Drop the cached dashboard fragments of users once the current transaction
+    on the database using (``default`` when None) commits. Writes to a metrics
+    shard must pass its alias: invalidating when ``default`` commits would let
+    a concurrent request cache the rows the shard has not committed yet.
+    """
+    keys = [cache_key(fragment, user_id) for user_id in user_ids for fragment in FRAGMENTS]
+    if keys:
+        transaction.on_commit(lambda: get_cache().delete_many(keys), using=using)
+
+
+def invalidate_trainer_profile(user_id, using=None):
+    key = cache_key(TRAINER_PROFILE, user_id)
+    transaction.on_commit(lambda: get_cache().delete(key), using=using)
@@ -0,0 +1,69 @@
+"""
+Retry of writes that find the SQLite write lock taken.
+
+SQLite has one writer at a time. With the production profile in settings a
+connection waits up to ``busy_timeout`` for the lock, but during a burst of
+check-ins a write can still give up with "database is locked".
+retry_on_lock() runs such a write again after a short pause that doubles
+(with jitter) on every attempt, at most ``TRAINER_WRITE_RETRIES`` times.
+Retries and writes that still failed are counted in the monitoring registry.
+
+Only a whole transaction can be retried: inside an atomic block the error is
+passed on to the code that owns the transaction.
+"""
+import functools
+import random
+import time
+
+from django.conf import settings
+from django.db import OperationalError, connections
+
+from .monitoring import registry
+
+RETRIES_METRIC = 'trainer_db_lock_retries_total'
+FAILURES_METRIC = 'trainer_db_lock_failures_total'
+
+# First pause and cap of the backoff, in seconds
+BASE_DELAY = 0.05
+MAX_DELAY = 1.0
+
+LOCK_MESSAGES = ('database is locked', 'database table is locked')
+
+
+def write_retries():
+    return getattr(settings, 'TRAINER_WRITE_RETRIES', 5)
+
+
+def is_lock_error(error):
+    return isinstance(error, OperationalError) and any(message in str(error) for message in LOCK_MESSAGES)
+
+
+def _in_transaction():
+    return any(connection.in_atomic_block for connection in connections.all(initialized_only=True))
+
+
+def backoff_delay(attempt):
+    """Pause before retry number attempt (0 for the first): doubling, capped and jittered."""
+    return min(MAX_DELAY, BASE_DELAY * 2 ** attempt) * random.uniform(0.5, 1.0)
+
+
+def retry_on_lock(func):
+    """Decorate (or wrap) a function that writes so it is retried when the database is locked."""
+    operation = getattr(func, '__qualname__', type(func).__qualname__)
+
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        retries = 0 if _in_transaction() else write_retries()
+        for attempt in range(retries + 1):
+            try:
+                return func(*args, **kwargs)
+            except OperationalError as e:
+                if not is_lock_error(e):
+                    raise
+                if attempt == retries:
+                    registry.increment(FAILURES_METRIC, 'Writes that failed on a locked database.', operation=operation)
+                    raise
+                registry.increment(RETRIES_METRIC, 'Writes retried on a locked database.', operation=operation)
+                time.sleep(backoff_delay(attempt))
+
+    return wrapper
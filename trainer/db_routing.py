@@ -0,0 +1,163 @@
+"""
+Read/write splitting between the primary database and read replicas.
+
+ReplicaRoutingMiddleware lets reads in GET/HEAD requests go to one of the
+``TRAINER_READ_REPLICAS`` aliases. Everything else stays on ``default``:
+writes, reads inside a transaction, unsafe requests and, through a short
+lived cookie, the ``TRAINER_PRIMARY_PIN_SECONDS`` after one (so a member sees
+the metrics they have just saved). Code outside a request (management
+commands, background workers) reads from the primary unless it asks for the
+replicas with ``use_replicas()``; a view can pin itself with ``use_primary()``.
+
+Without replicas configured the router routes everything to ``default``.
+"""
+import random
+import sqlite3
+from contextlib import contextmanager
+from contextvars import ContextVar
+
+from asgiref.sync import iscoroutinefunction, markcoroutinefunction
+from django.conf import settings
+from django.db import DEFAULT_DB_ALIAS, connections
+
+PRIMARY = 'primary'
+REPLICA = 'replica'
+
+PIN_COOKIE = 'trainer_primary'
+
+SAFE_METHODS = ('GET', 'HEAD', 'OPTIONS', 'TRACE')
+
+# Always read from the primary: a session missing from a lagging replica makes
+# SessionMiddleware delete the cookie, logging the user out
+PRIMARY_ONLY_APPS = {'sessions'}
+
+# Where reads of the current request (or task) may go; None outside requests
+_route = ContextVar('trainer_db_route', default=None)
+
+
+def read_replicas():
+    return getattr(settings, 'TRAINER_READ_REPLICAS', [])
+
+
+def pin_seconds():
+    return getattr(settings, 'TRAINER_PRIMARY_PIN_SECONDS', 5)
+
+
+@contextmanager
+def _routed(route):
+    token = _route.set(route)
+    try:
+        yield
+    finally:
+        _route.reset(token)
+
+
+def use_primary():
+    """Context manager (or view decorator) sending all reads to the primary."""
+    return _routed(PRIMARY)
+
+
+def use_replicas():
+    """Context manager (or decorator) letting reads go to the replicas."""
+    return _routed(REPLICA)
+
+
+def keep_routing(iterable):
+    """
+    Iterate iterable with the current routing, e.g. the body of a streaming
+    response, which is consumed after the middleware has returned.
+    """
+    route = _route.get()
+
+    def iterate():
+        iterator = iter(iterable)
+        while True:
+            with _routed(route):
+                try:
+                    item = next(iterator)
+                except StopIteration:
+                    return
+            yield item
+
+    return iterate()
+
+
+class ReadReplicaRouter:
+    def db_for_read(self, model, **hints):
+        replicas = read_replicas()
+        if not replicas or _route.get() != REPLICA or model._meta.app_label in PRIMARY_ONLY_APPS:
+            return DEFAULT_DB_ALIAS
+        # Reads inside a transaction must see its writes
+        if connections[DEFAULT_DB_ALIAS].in_atomic_block:
+            return DEFAULT_DB_ALIAS
+        return random.choice(replicas)
+
+    def db_for_write(self, model, **hints):
+        # Also for instances that were read from a replica
+        return DEFAULT_DB_ALIAS
+
+    def allow_relation(self, obj1, obj2, **hints):
+        pool = {DEFAULT_DB_ALIAS, *read_replicas()}
+        if obj1._state.db in pool and obj2._state.db in pool:
+            return True
+        return None
+
+    def allow_migrate(self, db, app_label, model_name=None, **hints):
+        # Replicas get the schema from the primary
+        if db in read_replicas():
+            return False
+        return None
+
+
+class ReplicaRoutingMiddleware:
+    """Route the reads of safe requests to the replicas and pin the others (and what follows) to the primary."""
+
+    sync_capable = True
+    async_capable = True
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+        if iscoroutinefunction(get_response):
+            markcoroutinefunction(self)
+
+    def __call__(self, request):
+        if iscoroutinefunction(self):
+            return self.__acall__(request)
+        with _routed(self.route(request)):
+            response = self.get_response(request)
+        return self.pin(request, response)
+
+    async def __acall__(self, request):
+        # The route is copied to the threads the ORM runs on
+        with _routed(self.route(request)):
+            response = await self.get_response(request)
+        return self.pin(request, response)
+
+    def route(self, request):
+        pinned = request.method not in SAFE_METHODS or PIN_COOKIE in request.COOKIES
+        return PRIMARY if pinned else REPLICA
+
+    def pin(self, request, response):
+        if request.method not in SAFE_METHODS and read_replicas():
+            # Read-your-writes: stay on the primary until the replicas have caught up
+            response.set_cookie(PIN_COOKIE, '1', max_age=pin_seconds(), httponly=True, samesite='Lax')
+        return response
+
+
+def copy_sqlite_database(source_alias, target_path):
+    """
+    Copy the SQLite database of source_alias to target_path with SQLite's
+    online backup API. Stands in for replication in local setups.
+    """
+    connection = connections[source_alias]
+    if connection.vendor != 'sqlite':
+        raise ValueError(f'Database {source_alias!r} is not SQLite.')
+    if connection.in_atomic_block:
+        # The backup would wait forever for the transaction to end
+        raise ValueError('Cannot copy a database inside a transaction.')
+    connection.ensure_connection()
+    target = sqlite3.connect(target_path)
+    try:
+        connection.connection.backup(target)
+    finally:
+        target.close()
@@ -0,0 +1,199 @@
+"""
+Streaming export of health metrics as CSV or NDJSON.
+
+Rows are read with ``values_list(...).iterator(chunk_size=...)`` and encoded
+one at a time, so memory stays flat however long the history is and the
+header goes out before the query has finished. Columns match the importer
+(``username``, ``date``, ``sleep_time``, ``wakeup_time``, ``weight``,
+``thigh_length``, ``hip_length``), so an export can be imported again, plus
+the derived ``sleep_duration_seconds`` and, optionally, ``photo_url``.
+
+The bulk export writes every user's history into one ZIP archive, one
+member file per user, again without buffering more than the current chunk.
+Usernames are looked up once per chunk rather than joined, as the metrics may
+live on a shard without the users table; the archive reads the shards one
+after the other.
+"""
+import csv
+import json
+import zipfile
+from itertools import chain, groupby, islice
+from operator import itemgetter
+
+from django.contrib.auth.models import User
+from django.core.files.storage import default_storage
+from django.utils import timezone
+
+from .importers import FORMAT_CSV, FORMAT_NDJSON
+from .models import UserHealthMetrics
+from .sharding import each_shard
+
+DEFAULT_CHUNK_SIZE = 2000
+
+# Encoded lines are sent in blocks of about this many characters
+BLOCK_SIZE = 64 * 1024
+
+COLUMNS = [
+    'username',
+    'date',
+    'sleep_time',
+    'wakeup_time',
+    'weight',
+    'thigh_length',
+    'hip_length',
+    'sleep_duration_seconds',
+]
+PHOTO_COLUMN = 'photo_url'
+
+CONTENT_TYPES = {
+    FORMAT_CSV: 'text/csv; charset=utf-8',
+    FORMAT_NDJSON: 'application/x-ndjson',
+}
+
+VALUE_FIELDS = [
+    'user_id',
+    'recorded_date',
+    'sleeping_datetime',
+    'wakeup_datetime',
+    'weight',
+    'thigh_length',
+    'hip_length',
+    'sleep_duration_seconds',
+    'image',
+]
+
+
+def _local_time(value):
+    return timezone.localtime(value).strftime('%H:%M') if value else ''
+
+
+def _decimal(value):
+    return '' if value is None else str(value)
+
+
+def _with_usernames(rows, usernames, chunk_size):
+    """Pass rows through, filling usernames (user id -> username) with one query per chunk."""
+    rows = iter(rows)
+    while chunk := list(islice(rows, chunk_size)):
+        missing = {row[0] for row in chunk} - usernames.keys()
+        if missing:
+            usernames.update(User.objects.filter(pk__in=missing).values_list('pk', 'username'))
+        yield from chunk
+
+
+def export_rows(queryset, include_photos=False, photo_url=None, chunk_size=DEFAULT_CHUNK_SIZE):
+    """
+    Yield one list of values (in columns() order) per metric of queryset.
+    photo_url turns a storage URL into the exported one (e.g. an absolute URL).
+    """
+    rows = queryset.order_by('user_id', 'recorded_date').values_list(*VALUE_FIELDS)
+    usernames = {}
+    for user_id, day, sleeping, wakeup, weight, thigh, hip, sleep_seconds, image in _with_usernames(
+        rows.iterator(chunk_size=chunk_size), usernames, chunk_size
+    ):
+        row = [
+            usernames[user_id],
+            day.isoformat(),
+            _local_time(sleeping),
+            _local_time(wakeup),
+            _decimal(weight),
+            _decimal(thigh),
+            _decimal(hip),
+            '' if sleep_seconds is None else sleep_seconds,
+        ]
+        if include_photos:
+            url = default_storage.url(image) if image else ''
+            row.append(photo_url(url) if url and photo_url else url)
+        yield row
+
+
+def columns(include_photos=False):
+    return COLUMNS + [PHOTO_COLUMN] if include_photos else COLUMNS
+
+
+class _Echo:
+    """File-like object whose write() returns the line, for csv.writer."""
+
+    def write(self, value):
+        return value
+
+
+def encode_rows(rows, file_format, include_photos=False):
+    """Yield the export as text chunks: a CSV header and one line per row, or NDJSON lines."""
+    names = columns(include_photos)
+    if file_format == FORMAT_NDJSON:
+        for row in rows:
+            yield json.dumps(dict(zip(names, row))) + '\n'
+        return
+
+    writer = csv.writer(_Echo())
+    yield writer.writerow(names)
+    for row in rows:
+        yield writer.writerow(row)
+
+
+def _blocks(chunks):
+    """Join small chunks into blocks of about BLOCK_SIZE, sending the first one right away."""
+    block = []
+    size = 0
+    for index, chunk in enumerate(chunks):
+        block.append(chunk)
+        size += len(chunk)
+        if index == 0 or size >= BLOCK_SIZE:
+            yield ''.join(block)
+            block = []
+            size = 0
+    if block:
+        yield ''.join(block)
+
+
+def stream_user_export(user, file_format, include_photos=False, photo_url=None, chunk_size=DEFAULT_CHUNK_SIZE):
+    """Yield one user's complete history as encoded text blocks."""
+    rows = export_rows(
+        UserHealthMetrics.objects.for_user(user), include_photos, photo_url, chunk_size
+    )
+    return _blocks(encode_rows(rows, file_format, include_photos))
+
+
+class _StreamBuffer:
+    """Unseekable sink for zipfile; drain() hands over what was written so far."""
+
+    def __init__(self):
+        self._chunks = []
+
+    def write(self, data):
+        self._chunks.append(bytes(data))
+        return len(data)
+
+    def flush(self):
+        pass
+
+    def drain(self):
+        data = b''.join(self._chunks)
+        self._chunks = []
+        return data
+
+
+def stream_archive(file_format, include_photos=False, photo_url=None, chunk_size=DEFAULT_CHUNK_SIZE):
+    """
+    Yield a ZIP archive (as bytes chunks) with one file per user holding that
+    user's complete history. Rows are read in a single pass ordered by user
+    (per shard: a user's rows are all on one).
+    """
+    buffer = _StreamBuffer()
+    rows = chain.from_iterable(
+        export_rows(UserHealthMetrics.objects.on_shard(alias), include_photos, photo_url, chunk_size)
+        for alias in each_shard()
+    )
+    extension = 'csv' if file_format == FORMAT_CSV else 'ndjson'
+
+    with zipfile.ZipFile(buffer, 'w', compression=zipfile.ZIP_DEFLATED) as archive:
+        for username, user_rows in groupby(rows, key=itemgetter(0)):
+            with archive.open(f'{username}.{extension}', 'w', force_zip64=True) as member:
+                for chunk in encode_rows(user_rows, file_format, include_photos):
+                    member.write(chunk.encode())
+                    data = buffer.drain()
+                    if data:
+                        yield data
+    # Remaining compressed data and the central directory
+    yield buffer.drain()
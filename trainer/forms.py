@@ -1,7 +1,15 @@
 from django import forms
 from django.utils import timezone
 from datetime import datetime, time
+from .image_decode import ImageTooLarge, check_pixels
 from .models import UserHealthMetrics
+from .uploads import MAX_PHOTO_BYTES
+from .trainer_search import SORT_CHOICES
+
+def combine_date_and_time(day, time_of_day):
+    """Return the aware datetime stored for a sleep or wakeup time on the given day."""
+    return timezone.make_aware(datetime.combine(day, time_of_day))
+
 
 class HealthMetricsForm(forms.ModelForm):
     # Date field with calendar widget
@@ -100,13 +108,21 @@ class HealthMetricsForm(forms.ModelForm):
             'image': 'Progress Photo (Optional)',
         }
     
+    def __init__(self, *args, upload_errors=None, **kwargs):
+        super().__init__(*args, **kwargs)
+        # Files refused while streaming (see trainer/uploads.py), by field name
+        self.upload_errors = upload_errors or {}
+    
     def clean_image(self):
         """Validate uploaded image file."""
+        if 'image' in self.upload_errors:
+            raise forms.ValidationError(self.upload_errors['image'])
+        
         image = self.cleaned_data.get('image')
         
         if image:
             # Check file size (5MB limit)
-            max_size = 5 * 1024 * 1024  # 5MB
+            max_size = MAX_PHOTO_BYTES
             if image.size > max_size:
                 raise forms.ValidationError(
                     f'Image file too large. Maximum size is 5MB. '
@@ -119,6 +135,14 @@ class HealthMetricsForm(forms.ModelForm):
                 raise forms.ValidationError(
                     'Invalid image format. Please upload JPEG, PNG, GIF, or WebP images only.'
                 )
+            
+            # Check pixel count from the header read by ImageField (new uploads only)
+            header = getattr(image, 'image', None)
+            if header is not None:
+                try:
+                    check_pixels(header.size)
+                except ImageTooLarge as e:
+                    raise forms.ValidationError(str(e))
         
         return image
     
@@ -157,16 +181,88 @@ class HealthMetricsForm(forms.ModelForm):
         wakeup_time = time(wakeup_hour_24, wakeup_minute)
         
         # Create datetime objects
-        instance.sleeping_datetime = timezone.make_aware(
-            datetime.combine(date, sleep_time)
-        )
-        instance.wakeup_datetime = timezone.make_aware(
-            datetime.combine(date, wakeup_time)
-        )
+        instance.sleeping_datetime = combine_date_and_time(date, sleep_time)
+        instance.wakeup_datetime = combine_date_and_time(date, wakeup_time)
         
         # Set the recorded_date to the selected date
         instance.recorded_date = date
         
         if commit:
             instance.save()
-        return instance
\ No newline at end of file
+        return instance
+
+
+class HealthMetricsImportRow:
+    """
+    Validate one imported row with the same field rules as HealthMetricsForm.
+    The field objects are shared between rows, so no form is built per row.
+    Times are 24-hour (22:30) or 12-hour (10:30 PM) on the recorded date,
+    exactly as the form combines them.
+    """
+    time_formats = ['%H:%M', '%H:%M:%S', '%I:%M %p', '%I:%M%p']
+    fields = {
+        'date': HealthMetricsForm.base_fields['date'],
+        'sleep_time': forms.TimeField(input_formats=time_formats),
+        'wakeup_time': forms.TimeField(input_formats=time_formats),
+        'weight': HealthMetricsForm.base_fields['weight'],
+        'thigh_length': HealthMetricsForm.base_fields['thigh_length'],
+        'hip_length': HealthMetricsForm.base_fields['hip_length'],
+    }
+
+    @classmethod
+    def clean(cls, data):
+        """Return (cleaned_data, errors) where errors maps a column to its messages."""
+        cleaned_data = {}
+        errors = {}
+        for name, field in cls.fields.items():
+            value = data.get(name)
+            if isinstance(value, str):
+                value = value.strip()
+            try:
+                cleaned_data[name] = field.clean(value)
+            except forms.ValidationError as e:
+                errors[name] = e.messages
+        return cleaned_data, errors
+
+
+class HealthMetricsImportForm(forms.Form):
+    """Upload form for the staff bulk import page."""
+    file = forms.FileField(
+        widget=forms.FileInput(attrs={'class': 'form-control', 'accept': '.csv,.ndjson,.jsonl'}),
+        label='CSV or NDJSON file',
+    )
+    format = forms.ChoiceField(
+        choices=[('', 'Detect from file name'), ('csv', 'CSV'), ('ndjson', 'NDJSON')],
+        widget=forms.Select(attrs={'class': 'form-control'}),
+        required=False,
+    )
+
+
+class TrainerSearchForm(forms.Form):
+    """Filters and sorting of the trainer list; every field is optional."""
+    specialization = forms.ChoiceField(
+        required=False,
+        widget=forms.Select(attrs={'class': 'form-select form-select-sm'}),
+    )
+    min_rate = forms.DecimalField(
+        required=False, min_value=0, max_digits=6, decimal_places=2,
+        widget=forms.NumberInput(attrs={'class': 'form-control form-control-sm', 'placeholder': 'Min $'}),
+    )
+    max_rate = forms.DecimalField(
+        required=False, min_value=0, max_digits=6, decimal_places=2,
+        widget=forms.NumberInput(attrs={'class': 'form-control form-control-sm', 'placeholder': 'Max $'}),
+    )
+    min_experience = forms.IntegerField(
+        required=False, min_value=0,
+        widget=forms.NumberInput(attrs={'class': 'form-control form-control-sm', 'placeholder': 'Years'}),
+        label='Min. experience',
+    )
+    sort = forms.ChoiceField(
+        choices=SORT_CHOICES,
+        required=False,
+        widget=forms.Select(attrs={'class': 'form-select form-select-sm'}),
+    )
+
+    def __init__(self, *args, specializations=(), **kwargs):
+        super().__init__(*args, **kwargs)
+        self.fields['specialization'].choices = [('', 'Any')] + [(s, s) for s in specializations]
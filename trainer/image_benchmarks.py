@@ -0,0 +1,114 @@
+"""
+Benchmark of progress photo compression on large images.
+
+Compares the draft-mode pipeline behind ``UserHealthMetrics.compress_image``
+with the full-resolution pipeline it replaced (kept here as
+legacy_compress()) on a corpus of phone-sized JPEGs. Each pipeline runs in a
+forked child so its peak resident memory can be read from ``ru_maxrss``
+without the other's allocations; Pillow allocates pixel buffers outside the
+Python allocator, so tracemalloc would not see them.
+"""
+import multiprocessing
+import os
+import resource
+import statistics
+import sys
+import time
+from io import BytesIO
+
+from django.core.files import File
+from PIL import Image
+
+from .image_decode import ORIENTATION_TAG
+from .models import UserHealthMetrics
+
+
+def _in_child(func, *args):
+    """Run func(*args) in a forked process and return its result."""
+    with multiprocessing.get_context('fork').Pool(1) as pool:
+        return pool.apply(func, args)
+
+
+def _write_corpus(directory, count, size, quality):
+    paths = []
+    for i in range(count):
+        grain = Image.effect_noise(size, 24 + i)
+        gradient = Image.linear_gradient('L').resize(size)
+        img = Image.merge('RGB', (grain, gradient, Image.effect_noise(size, 12)))
+        exif = Image.Exif()
+        if i % 2:
+            exif[ORIENTATION_TAG] = 6
+        path = os.path.join(directory, f'photo{i}.jpg')
+        img.save(path, format='JPEG', quality=quality, exif=exif)
+        img.close()
+        paths.append(path)
+    return paths
+
+
+def photo_corpus(directory, count=6, size=(6000, 4000), quality=90):
+    """
+    Write count noisy JPEGs of size to directory, like camera photos (every
+    other one stored sideways with an EXIF orientation), and return their
+    paths. They are generated in a child process: memory this process kept
+    from building them would be reused by the measured children.
+    """
+    return _in_child(_write_corpus, directory, count, size, quality)
+
+
+def legacy_compress(image_field, quality=85, max_width=800, max_height=800):
+    """compress_image as it was before draft-mode decoding, for comparison."""
+    img = Image.open(image_field)
+    if img.mode in ('RGBA', 'LA', 'P'):
+        img = img.convert('RGB')
+    original_width, original_height = img.size
+    if original_width > max_width or original_height > max_height:
+        scale_factor = min(max_width / original_width, max_height / original_height)
+        new_size = (int(original_width * scale_factor), int(original_height * scale_factor))
+        img = img.resize(new_size, Image.Resampling.LANCZOS)
+    output = BytesIO()
+    img.save(output, format='JPEG', quality=quality, optimize=True)
+    return output.getvalue()
+
+
+def draft_compress(image_field):
+    return UserHealthMetrics().compress_image(image_field).read()
+
+
+PIPELINES = {
+    'legacy': legacy_compress,
+    'draft': draft_compress,
+}
+
+
+def _max_rss_mb():
+    max_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Kilobytes on Linux, bytes on macOS
+    return max_rss / (1024 * 1024 if sys.platform == 'darwin' else 1024)
+
+
+def _run_pipeline(name, paths):
+    baseline = _max_rss_mb()
+    timings = []
+    output_bytes = 0
+    for path in paths:
+        with open(path, 'rb') as f:
+            started = time.perf_counter()
+            output_bytes += len(PIPELINES[name](File(f, name=os.path.basename(path))))
+            timings.append((time.perf_counter() - started) * 1000)
+    return {
+        'images': len(paths),
+        'p50_ms': round(statistics.median(timings), 2),
+        'mean_ms': round(statistics.fmean(timings), 2),
+        'peak_rss_mb': round(_max_rss_mb() - baseline, 1),
+        'output_bytes': output_bytes,
+    }
+
+
+def measure_pipeline(name, paths):
+    """Compress every path with the named pipeline in a child process; return timings and memory growth."""
+    return _in_child(_run_pipeline, name, paths)
+
+
+def run_decode_benchmark(paths, only=None):
+    """Measure each pipeline (or those named in only) on the corpus; results keyed by pipeline name."""
+    return {name: measure_pipeline(name, paths) for name in PIPELINES if not only or name in only}
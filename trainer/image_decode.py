@@ -0,0 +1,102 @@
+"""
+Memory-bounded decoding of progress photos.
+
+A 5MB phone JPEG can hold 24 megapixels or more, around 100MB once decoded,
+while photos are never shown larger than 800 pixels. decode_scaled() reads
+the size from the header and refuses images over
+``TRAINER_IMAGE_MAX_PIXELS`` before decoding anything. It then lets libjpeg
+decode JPEGs at 1/2, 1/4 or 1/8 scale (draft mode), as small as possible
+while still covering the target box. Other formats are decoded in full and
+reduced by a whole factor before the final LANCZOS resize. The EXIF
+orientation is applied to the small image, and the full-size buffers are
+released as soon as they have been scaled down.
+
+Every decode adds its time and the bytes of pixel data it decoded to the
+monitoring registry.
+"""
+import time
+
+from django.conf import settings
+from PIL import Image
+
+from .monitoring import registry
+
+DECODED_METRIC = 'trainer_images_decoded_total'
+SECONDS_METRIC = 'trainer_image_decode_seconds_total'
+BYTES_METRIC = 'trainer_image_decode_bytes_total'
+
+DEFAULT_MAX_PIXELS = 50_000_000
+
+ORIENTATION_TAG = 0x0112
+
+# EXIF orientation -> transpose that shows the image upright
+ORIENTATION_TRANSPOSE = {
+    2: Image.Transpose.FLIP_LEFT_RIGHT,
+    3: Image.Transpose.ROTATE_180,
+    4: Image.Transpose.FLIP_TOP_BOTTOM,
+    5: Image.Transpose.TRANSPOSE,
+    6: Image.Transpose.ROTATE_270,
+    7: Image.Transpose.TRANSVERSE,
+    8: Image.Transpose.ROTATE_90,
+}
+
+# Bytes per pixel of Pillow's in-memory modes; multi-band modes use 4
+MODE_BYTES = {'1': 1, 'L': 1, 'P': 1, 'I;16': 2, 'I': 4, 'F': 4}
+
+
+class ImageTooLarge(ValueError):
+    """The image has more pixels than TRAINER_IMAGE_MAX_PIXELS."""
+
+
+def max_pixels():
+    return getattr(settings, 'TRAINER_IMAGE_MAX_PIXELS', DEFAULT_MAX_PIXELS)
+
+
+def check_pixels(size):
+    """Raise ImageTooLarge if an image of size (width, height) is over the pixel ceiling."""
+    width, height = size
+    limit = max_pixels()
+    if width * height > limit:
+        raise ImageTooLarge(
+            f'Image is {width}x{height} pixels; at most {limit / 1_000_000:g} megapixels are allowed.'
+        )
+
+
+def buffer_bytes(img):
+    """Memory held by an image's pixels."""
+    return img.width * img.height * MODE_BYTES.get(img.mode, 4)
+
+
+def decode_scaled(source, box):
+    """
+    Decode source (a path or file object) to an RGB or L image that fits in
+    box (width, height) once upright. Raises ImageTooLarge, or PIL's errors
+    for files that are not images.
+    """
+    started = time.perf_counter()
+    with Image.open(source) as img:
+        check_pixels(img.size)
+        source_format = img.format or 'unknown'
+        orientation = img.getexif().get(ORIENTATION_TAG, 1)
+        # The box applies to the upright image; rotated photos are stored sideways
+        target = (box[1], box[0]) if orientation in (5, 6, 7, 8) else box
+        # draft() keeps both sides at least this size, so ask for the fitted size, not the box
+        scale = min(1, target[0] / img.width, target[1] / img.height)
+        img.draft('RGB', (max(1, round(img.width * scale)), max(1, round(img.height * scale))))
+        img.load()
+        decoded_bytes = buffer_bytes(img)
+        # Reduces by a whole factor first, then resamples the small image
+        img.thumbnail(target, Image.Resampling.LANCZOS)
+        scaled = img.copy() if img.mode in ('RGB', 'L') else img.convert('RGB')
+    # The decoded buffer is released with img here
+
+    transpose = ORIENTATION_TRANSPOSE.get(orientation)
+    if transpose is not None:
+        scaled = scaled.transpose(transpose)
+
+    registry.increment(DECODED_METRIC, 'Progress photos decoded, by source format.', format=source_format)
+    registry.increment(
+        SECONDS_METRIC, 'Time spent decoding and scaling progress photos.', value=time.perf_counter() - started
+    )
+    registry.increment(BYTES_METRIC, 'Pixel data decoded from progress photos, in bytes.', value=decoded_bytes)
+    return scaled
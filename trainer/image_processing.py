@@ -0,0 +1,121 @@
+"""
+Background processing of progress photos.
+
+When ``TRAINER_ASYNC_IMAGE_PROCESSING`` is enabled, ``UserHealthMetrics.save()``
+stores the raw upload and marks the row as pending instead of compressing the
+photo inside the request. The row id is handed to a local thread pool once the
+surrounding transaction commits; a worker compresses the photo, swaps it in
+and marks the row as ready.
+"""
+import logging
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+from django.conf import settings
+from django.db import close_old_connections, transaction
+from django.utils import timezone
+
+from .dashboard_cache import invalidate_users
+from .db_retry import retry_on_lock
+from .photo_store import photo_directory, store_photo
+
+logger = logging.getLogger(__name__)
+
+_executor = None
+_executor_lock = threading.Lock()
+
+
+def async_processing_enabled():
+    """Return True if photos should be compressed outside the request."""
+    return getattr(settings, 'TRAINER_ASYNC_IMAGE_PROCESSING', False)
+
+
+def get_executor():
+    """Return the shared worker pool, creating it on first use."""
+    global _executor
+    with _executor_lock:
+        if _executor is None:
+            _executor = ThreadPoolExecutor(
+                max_workers=getattr(settings, 'TRAINER_IMAGE_WORKERS', 2),
+                thread_name_prefix='trainer-image',
+            )
+        return _executor
+
+
+def shutdown_executor(wait=True):
+    """Stop the worker pool, waiting for queued photos by default."""
+    global _executor
+    with _executor_lock:
+        if _executor is not None:
+            _executor.shutdown(wait=wait)
+            _executor = None
+
+
+def enqueue_image_processing(metric_id):
+    """Schedule compression of a pending photo after the current transaction commits."""
+    transaction.on_commit(lambda: get_executor().submit(_run_in_worker, metric_id))
+
+
+def _run_in_worker(metric_id):
+    # Worker threads get their own DB connection; release it when done
+    close_old_connections()
+    try:
+        process_pending_image(metric_id)
+    finally:
+        close_old_connections()
+
+
+def process_pending_image(metric_id):
+    """
+    Compress the raw photo of a pending row and swap in the result.
+    Returns True if the row was updated.
+    """
+    from .models import UserHealthMetrics
+
+    try:
+        metric = UserHealthMetrics.objects.on_shard_of(metric_id).get(pk=metric_id)
+    except UserHealthMetrics.DoesNotExist:
+        return False
+
+    if metric.image_status == UserHealthMetrics.IMAGE_STATUS_READY or not metric.image:
+        return False
+
+    storage = metric.image.storage
+    raw_name = metric.image.name
+    # Only update the row while it still points at the raw upload being processed
+    pending_row = UserHealthMetrics.objects.on_shard_of(metric_id).filter(pk=metric_id, image=raw_name)
+    try:
+        compressed_image = metric.compress_image(metric.image)
+        metric.image.close()
+        compressed_name = store_photo(compressed_image, photo_directory(metric.image.field), storage)
+    except Exception:
+        logger.exception('Failed to process progress photo for metric %s', metric_id)
+        retry_on_lock(pending_row.update)(
+            image_status=UserHealthMetrics.IMAGE_STATUS_FAILED,
+            updated_at=timezone.now(),
+        )
+        invalidate_users([metric.user_id])
+        return False
+
+    updated = retry_on_lock(pending_row.update)(
+        image=compressed_name,
+        image_status=UserHealthMetrics.IMAGE_STATUS_READY,
+        updated_at=timezone.now(),
+    )
+    if not updated:
+        # The compressed file may be shared; the photo collector removes it if unused
+        return False
+
+    storage.delete(raw_name)
+
+    # Build renditions now so the first dashboard view does not have to
+    from .renditions import build_renditions
+
+    metric.refresh_from_db()
+    try:
+        build_renditions(metric)
+    except Exception:
+        logger.exception('Failed to build renditions for metric %s', metric_id)
+    # Queryset updates do not send signals; drop the cached "processing" placeholder
+    invalidate_users([metric.user_id])
+    return True
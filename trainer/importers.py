@@ -0,0 +1,237 @@
+"""
+Streaming bulk import of health metrics from CSV or NDJSON.
+
+Rows are read one at a time, validated with HealthMetricsImportRow and
+written in batches with a single ``bulk_create(update_conflicts=True)`` on the
+``(user, recorded_date)`` key, one transaction per batch and shard. Only the
+current batch is held in memory, so file size does not matter.
+
+Columns: ``username`` (unless a user is given for the whole file), ``date``,
+``sleep_time``, ``wakeup_time``, ``weight``, ``thigh_length`` and ``hip_length``.
+
+A day repeated in one batch keeps its last row and counts once. A file that
+stops being UTF-8 (or readable CSV) is rejected from that line on.
+"""
+import csv
+import json
+import time
+from collections import defaultdict
+
+from django.contrib.auth.models import User
+from django.db import transaction
+
+from .dashboard_cache import invalidate_users
+from .db_retry import retry_on_lock
+from .forms import HealthMetricsImportRow, combine_date_and_time
+from .models import UserHealthMetrics
+from .rollups import rebuild_rollups
+from .sharding import shards_for_users
+
+FORMAT_CSV = 'csv'
+FORMAT_NDJSON = 'ndjson'
+FORMATS = [FORMAT_CSV, FORMAT_NDJSON]
+
+DEFAULT_BATCH_SIZE = 1000
+
+# Rejected rows kept on the result for display; all of them go to on_reject
+MAX_REPORTED_REJECTS = 100
+
+UPDATE_FIELDS = [
+    'wakeup_datetime',
+    'sleeping_datetime',
+    'sleep_duration_seconds',
+    'weight',
+    'thigh_length',
+    'hip_length',
+    'updated_at',
+]
+
+
+def detect_format(filename):
+    """Guess the file format from its extension, defaulting to CSV."""
+    if filename and filename.lower().endswith(('.ndjson', '.jsonl', '.json')):
+        return FORMAT_NDJSON
+    return FORMAT_CSV
+
+
+class ImportFileError(ValueError):
+    """The rest of the file cannot be read, from line_number on."""
+
+    def __init__(self, line_number, message):
+        super().__init__(message)
+        self.line_number = line_number
+
+
+def _decode_lines(stream):
+    """Decode a binary stream a line at a time, so a line that is not UTF-8 is found where it is."""
+    for line_number, line in enumerate(stream, start=1):
+        try:
+            yield line.decode('utf-8-sig' if line_number == 1 else 'utf-8')
+        except UnicodeDecodeError:
+            raise ImportFileError(line_number, 'The file is not UTF-8 text.')
+
+
+def iter_rows(stream, file_format):
+    """
+    Yield (line_number, row_dict) from a binary or text stream.
+    Malformed NDJSON lines are yielded as (line_number, None). Raises
+    ImportFileError at the first line that is not UTF-8 or readable CSV.
+    """
+    if isinstance(stream.read(0), bytes):
+        stream = _decode_lines(stream)
+
+    if file_format == FORMAT_NDJSON:
+        for line_number, line in enumerate(stream, start=1):
+            if not line.strip():
+                continue
+            try:
+                row = json.loads(line)
+            except ValueError:
+                row = None
+            yield line_number, row if isinstance(row, dict) else None
+        return
+
+    reader = csv.DictReader(stream)
+    try:
+        for row in reader:
+            yield reader.line_num, row
+    except csv.Error as e:
+        # The DictReader's line_num only moves on rows it returns
+        raise ImportFileError(reader.reader.line_num, f'Malformed CSV: {e}.')
+
+
+class ImportResult:
+    """Counters and rejected rows of one import run."""
+
+    def __init__(self):
+        self.imported = 0
+        self.rejected = 0
+        self.rejects = []
+        self.elapsed = 0.0
+
+    @property
+    def rows_per_second(self):
+        total = self.imported + self.rejected
+        return total / self.elapsed if self.elapsed else 0.0
+
+    def summary(self):
+        return (
+            f'Imported {self.imported} rows, rejected {self.rejected} '
+            f'in {self.elapsed:.1f}s ({self.rows_per_second:.0f} rows/s)'
+        )
+
+
+class HealthMetricsImporter:
+    """
+    Import rows into UserHealthMetrics, updating rows that already exist for
+    the same user and date.
+
+    Args:
+        user: import every row for this user instead of reading a username column
+        batch_size: rows per INSERT and per transaction
+        on_reject: called with (line_number, row, errors) for every rejected row
+    """
+
+    def __init__(self, user=None, batch_size=DEFAULT_BATCH_SIZE, on_reject=None):
+        self.user = user
+        self.batch_size = batch_size
+        self.on_reject = on_reject
+        self._user_ids = {}
+
+    def _user_id(self, username):
+        if username not in self._user_ids:
+            self._user_ids[username] = (
+                User.objects.filter(username=username).values_list('id', flat=True).first()
+            )
+        return self._user_ids[username]
+
+    def _reject(self, result, line_number, row, errors):
+        result.rejected += 1
+        if len(result.rejects) < MAX_REPORTED_REJECTS:
+            result.rejects.append((line_number, errors))
+        if self.on_reject:
+            self.on_reject(line_number, row, errors)
+
+    def _build(self, row):
+        """Return (metric, errors) for one raw row."""
+        cleaned_data, errors = HealthMetricsImportRow.clean(row)
+
+        if self.user is not None:
+            user_id = self.user.pk
+        else:
+            username = (row.get('username') or '').strip()
+            user_id = self._user_id(username) if username else None
+            if user_id is None:
+                errors['username'] = [f'Unknown user "{username}".' if username else 'This field is required.']
+
+        if errors:
+            return None, errors
+
+        metric = UserHealthMetrics(
+            user_id=user_id,
+            recorded_date=cleaned_data['date'],
+            sleeping_datetime=combine_date_and_time(cleaned_data['date'], cleaned_data['sleep_time']),
+            wakeup_datetime=combine_date_and_time(cleaned_data['date'], cleaned_data['wakeup_time']),
+            weight=cleaned_data['weight'],
+            thigh_length=cleaned_data['thigh_length'],
+            hip_length=cleaned_data['hip_length'],
+        )
+        metric.update_sleep_duration()
+        return metric, None
+
+    @retry_on_lock
+    def _flush(self, batch):
+        shards = shards_for_users({user_id for user_id, _ in batch})
+        by_shard = defaultdict(list)
+        for (user_id, _), metric in batch.items():
+            by_shard[shards[user_id]].append(metric)
+        # One INSERT and transaction per shard the batch touches
+        for alias, metrics in by_shard.items():
+            with transaction.atomic(using=alias):
+                UserHealthMetrics.objects.on_shard(alias).bulk_create(
+                    metrics,
+                    update_conflicts=True,
+                    unique_fields=['user', 'recorded_date'],
+                    update_fields=UPDATE_FIELDS,
+                )
+
+    def run(self, rows):
+        """Import (line_number, row) pairs as produced by iter_rows()."""
+        result = ImportResult()
+        started = time.perf_counter()
+        touched_user_ids = set()
+        # Keyed by (user, date) so a repeated day inside one batch keeps the last row
+        batch = {}
+
+        try:
+            for line_number, row in rows:
+                if row is None:
+                    self._reject(result, line_number, row, {'row': ['Malformed row.']})
+                    continue
+                metric, errors = self._build(row)
+                if errors:
+                    self._reject(result, line_number, row, errors)
+                    continue
+
+                batch[(metric.user_id, metric.recorded_date)] = metric
+                if len(batch) >= self.batch_size:
+                    self._flush(batch)
+                    result.imported += len(batch)
+                    touched_user_ids.update(user_id for user_id, _ in batch)
+                    batch = {}
+        except ImportFileError as e:
+            # The rows before it are still imported
+            self._reject(result, e.line_number, None, {'file': [str(e)]})
+
+        if batch:
+            self._flush(batch)
+            result.imported += len(batch)
+            touched_user_ids.update(user_id for user_id, _ in batch)
+
+        # bulk_create bypasses the rollup and dashboard cache signal handlers
+        if touched_user_ids:
+            rebuild_rollups(sorted(touched_user_ids))
+            invalidate_users(touched_user_ids)
+
+        result.elapsed = time.perf_counter() - started
+        return result
@@ -0,0 +1,87 @@
+import json
+import os
+import platform
+import tempfile
+
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection
+from django.test.utils import override_settings, setup_test_environment, teardown_test_environment
+from django.utils import timezone
+from trainer.benchmarks import seed_fixture
+from trainer.concurrency_benchmarks import MODES, READ_SCENARIOS, run_concurrency_benchmark
+
+
+class Command(BaseCommand):
+    help = (
+        'Benchmark the read views under concurrent load on a freshly seeded test database, '
+        'comparing the sync views under WSGI with the async views under ASGI'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--users', type=int, default=200, help='Users in the fixture')
+        parser.add_argument('--days', type=int, default=365, help='Days of metrics per user')
+        parser.add_argument('--photo-ratio', type=float, default=0.05, help='Share of rows with a photo')
+        parser.add_argument('--concurrency', type=int, default=16, help='Requests in flight at once')
+        parser.add_argument('--requests', type=int, default=200, help='Timed requests per scenario and mode')
+        parser.add_argument(
+            '--db-latency', type=float, default=0,
+            help='Milliseconds added to every query, to model a database server (default: 0)',
+        )
+        parser.add_argument('--only', action='append', choices=READ_SCENARIOS, help='Run only this scenario')
+        parser.add_argument('--mode', action='append', choices=MODES, help='Run only this mode')
+        parser.add_argument('--output', help='Write results as JSON to this file')
+
+    def handle(self, *args, **options):
+        if options['concurrency'] < 1 or options['requests'] < 1:
+            raise CommandError('--concurrency and --requests must be at least 1.')
+        if options['db_latency'] < 0:
+            raise CommandError('--db-latency cannot be negative.')
+
+        setup_test_environment(debug=False)
+        # Never touch the real database or media
+        old_name = connection.creation.create_test_db(verbosity=0, autoclobber=True)
+        try:
+            with tempfile.TemporaryDirectory() as media_root, override_settings(MEDIA_ROOT=media_root):
+                seed_fixture(users=options['users'], days=options['days'], photo_ratio=options['photo_ratio'])
+                results = run_concurrency_benchmark(
+                    concurrency=options['concurrency'],
+                    requests=options['requests'],
+                    only=options['only'],
+                    modes=options['mode'] or MODES,
+                    db_latency=options['db_latency'] / 1000,
+                )
+        finally:
+            connection.creation.destroy_test_db(old_name, verbosity=0)
+            teardown_test_environment()
+
+        self.stdout.write(
+            f'Fixture: {options["users"]} users x {options["days"]} days; '
+            f'{options["requests"]} requests per scenario, {options["concurrency"]} in flight, '
+            f'{options["db_latency"]:g} ms added per query'
+        )
+        self.stdout.write(f'{"scenario":<20}{"mode":<6}{"req/s":>10}{"p50 ms":>10}{"p95 ms":>10}{"errors":>8}')
+        for name, modes in results.items():
+            for mode, result in modes.items():
+                self.stdout.write(
+                    f'{name:<20}{mode:<6}{result["requests_per_second"]:>10.1f}{result["p50_ms"]:>10.1f}'
+                    f'{result["p95_ms"]:>10.1f}{result["errors"]:>8}'
+                )
+
+        if options['output']:
+            report = {
+                'created_at': timezone.now().isoformat(),
+                'python': platform.python_version(),
+                'database': connection.vendor,
+                'cpus': os.cpu_count(),
+                'fixture': {'users': options['users'], 'days': options['days'], 'photo_ratio': options['photo_ratio']},
+                'concurrency': options['concurrency'],
+                'requests': options['requests'],
+                'db_latency_ms': options['db_latency'],
+                'results': results,
+            }
+            with open(options['output'], 'w') as f:
+                json.dump(report, f, indent=2)
+            self.stdout.write(f'Results written to {options["output"]}')
+
+        if any(result['errors'] for modes in results.values() for result in modes.values()):
+            raise CommandError('Some requests failed.')
@@ -0,0 +1,48 @@
+import json
+import platform
+import tempfile
+
+import PIL
+from django.core.management.base import BaseCommand
+from django.utils import timezone
+from trainer.image_benchmarks import PIPELINES, photo_corpus, run_decode_benchmark
+
+
+class Command(BaseCommand):
+    help = (
+        'Benchmark progress photo compression on generated large JPEGs, comparing '
+        'draft-mode decoding with the previous full-resolution pipeline'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--images', type=int, default=6, help='Photos in the corpus')
+        parser.add_argument('--width', type=int, default=6000, help='Width of each photo in pixels')
+        parser.add_argument('--height', type=int, default=4000, help='Height of each photo in pixels')
+        parser.add_argument('--only', action='append', choices=list(PIPELINES), help='Run only this pipeline')
+        parser.add_argument('--output', help='Write results as JSON to this file')
+
+    def handle(self, *args, **options):
+        size = (options['width'], options['height'])
+        with tempfile.TemporaryDirectory() as directory:
+            paths = photo_corpus(directory, count=options['images'], size=size)
+            results = run_decode_benchmark(paths, only=options['only'])
+
+        self.stdout.write(f'Corpus: {options["images"]} JPEGs of {size[0]}x{size[1]} pixels')
+        self.stdout.write(f'{"pipeline":<12}{"p50 ms":>10}{"mean ms":>10}{"peak RSS MB":>14}{"output bytes":>14}')
+        for name, result in results.items():
+            self.stdout.write(
+                f'{name:<12}{result["p50_ms"]:>10.1f}{result["mean_ms"]:>10.1f}'
+                f'{result["peak_rss_mb"]:>14.1f}{result["output_bytes"]:>14}'
+            )
+
+        if options['output']:
+            report = {
+                'created_at': timezone.now().isoformat(),
+                'python': platform.python_version(),
+                'pillow': PIL.__version__,
+                'corpus': {'images': options['images'], 'width': size[0], 'height': size[1]},
+                'results': results,
+            }
+            with open(options['output'], 'w') as f:
+                json.dump(report, f, indent=2)
+            self.stdout.write(f'Results written to {options["output"]}')
@@ -0,0 +1,79 @@
+import json
+import platform
+import tempfile
+
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection
+from django.test.utils import override_settings, setup_test_environment, teardown_test_environment
+from django.utils import timezone
+from trainer.benchmarks import BUDGETS_PATH, compare_with_budgets, load_budgets, run_benchmarks, seed_fixture
+
+
+class Command(BaseCommand):
+    help = (
+        'Benchmark the hot trainer views on a freshly seeded test database, '
+        'recording wall time, SQL query count and bytes rendered'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--users', type=int, default=200, help='Users in the fixture')
+        parser.add_argument('--days', type=int, default=365, help='Days of metrics per user')
+        parser.add_argument('--photo-ratio', type=float, default=0.05, help='Share of rows with a photo')
+        parser.add_argument('--repeat', type=int, default=10, help='Timed requests per scenario')
+        parser.add_argument('--only', action='append', help='Run only this scenario (can be repeated)')
+        parser.add_argument('--output', help='Write results as JSON to this file')
+        parser.add_argument(
+            '--compare',
+            nargs='?',
+            const=str(BUDGETS_PATH),
+            help='Fail if a scenario exceeds its query budget, warn on latency (default file: %(const)s)',
+        )
+        parser.add_argument(
+            '--strict-latency', action='store_true', help='With --compare, also fail on latency overruns',
+        )
+
+    def handle(self, *args, **options):
+        setup_test_environment(debug=False)
+        # Never touch the real database or media
+        old_name = connection.creation.create_test_db(verbosity=0, autoclobber=True)
+        try:
+            with tempfile.TemporaryDirectory() as media_root, override_settings(MEDIA_ROOT=media_root):
+                seed_started = timezone.now()
+                seed_fixture(users=options['users'], days=options['days'], photo_ratio=options['photo_ratio'])
+                seed_seconds = (timezone.now() - seed_started).total_seconds()
+                results = run_benchmarks(repeat=options['repeat'], only=options['only'])
+        finally:
+            connection.creation.destroy_test_db(old_name, verbosity=0)
+            teardown_test_environment()
+
+        self.stdout.write(f'Fixture: {options["users"]} users x {options["days"]} days (seeded in {seed_seconds:.1f}s)')
+        self.stdout.write(f'{"scenario":<28}{"queries":>8}{"p50 ms":>10}{"p95 ms":>10}{"bytes":>10}')
+        for name, result in results.items():
+            self.stdout.write(
+                f'{name:<28}{result["queries"]:>8}{result["p50_ms"]:>10.1f}'
+                f'{result["p95_ms"]:>10.1f}{result["bytes"]:>10}'
+            )
+
+        if options['output']:
+            report = {
+                'created_at': timezone.now().isoformat(),
+                'python': platform.python_version(),
+                'database': connection.vendor,
+                'fixture': {'users': options['users'], 'days': options['days'], 'photo_ratio': options['photo_ratio']},
+                'repeat': options['repeat'],
+                'results': results,
+            }
+            with open(options['output'], 'w') as f:
+                json.dump(report, f, indent=2)
+            self.stdout.write(f'Results written to {options["output"]}')
+
+        if options['compare']:
+            failures, latency_overruns = compare_with_budgets(results, load_budgets(options['compare']))
+            if options['strict_latency']:
+                failures += latency_overruns
+            else:
+                for overrun in latency_overruns:
+                    self.stdout.write(self.style.WARNING(f'Latency over budget: {overrun}'))
+            if failures:
+                raise CommandError('Budget exceeded:\n  ' + '\n  '.join(failures))
+            self.stdout.write(self.style.SUCCESS('All scenarios are within their query budgets.'))
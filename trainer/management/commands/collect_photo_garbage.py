@@ -0,0 +1,33 @@
+from datetime import timedelta
+
+from django.core.management.base import BaseCommand, CommandError
+from trainer.photo_store import DEFAULT_MIN_AGE, collect_garbage
+
+
+class Command(BaseCommand):
+    help = 'Delete progress photo and rendition files that no health metric or rendition refers to'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--dry-run', action='store_true', help='Only list the files that would be deleted')
+        parser.add_argument(
+            '--min-age',
+            type=float,
+            default=DEFAULT_MIN_AGE.total_seconds() / 60,
+            help='Keep files stored or reused within this many minutes, e.g. by uploads in progress '
+                 f'(default: {DEFAULT_MIN_AGE.total_seconds() / 60:.0f})',
+        )
+
+    def handle(self, *args, **options):
+        if options['min_age'] < 0:
+            raise CommandError('--min-age cannot be negative.')
+
+        def report(name):
+            if options['verbosity'] > 1 or options['dry_run']:
+                self.stdout.write(name)
+
+        stats = collect_garbage(
+            min_age=timedelta(minutes=options['min_age']),
+            dry_run=options['dry_run'],
+            on_delete=report,
+        )
+        self.stdout.write(self.style.SUCCESS(stats.summary(options['dry_run'])))
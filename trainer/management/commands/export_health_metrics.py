@@ -0,0 +1,57 @@
+import sys
+
+from django.contrib.auth.models import User
+from django.core.management.base import BaseCommand, CommandError
+from trainer.db_routing import use_replicas
+from trainer.exporters import DEFAULT_CHUNK_SIZE, stream_archive, stream_user_export
+from trainer.importers import FORMAT_CSV, FORMATS
+
+
+class Command(BaseCommand):
+    help = 'Stream the health metrics of one user as CSV/NDJSON, or of every user as a ZIP archive'
+
+    def add_arguments(self, parser):
+        parser.add_argument('path', nargs='?', default='-', help='Output file ("-" writes to standard output)')
+        parser.add_argument('--user', help='Username to export')
+        parser.add_argument('--all', action='store_true', help='Export every user into one ZIP archive')
+        parser.add_argument('--format', choices=FORMATS, default=FORMAT_CSV, help='Row format (default: csv)')
+        parser.add_argument('--photos', action='store_true', help='Add a photo_url column')
+        parser.add_argument('--chunk-size', type=int, default=DEFAULT_CHUNK_SIZE, help='Rows fetched per query chunk')
+
+    def handle(self, *args, **options):
+        if bool(options['user']) == options['all']:
+            raise CommandError('Give either --user or --all.')
+        # A long read-only scan: keep it off the primary when there are replicas
+        with use_replicas():
+            self.export(options)
+
+    def export(self, options):
+        if options['all']:
+            chunks = stream_archive(options['format'], options['photos'], chunk_size=options['chunk_size'])
+        else:
+            try:
+                user = User.objects.get(username=options['user'])
+            except User.DoesNotExist:
+                raise CommandError(f'User "{options["user"]}" does not exist.')
+            chunks = (
+                chunk.encode()
+                for chunk in stream_user_export(
+                    user, options['format'], options['photos'], chunk_size=options['chunk_size']
+                )
+            )
+
+        path = options['path']
+        output = sys.stdout.buffer if path == '-' else open(path, 'wb')
+        written = 0
+        try:
+            for chunk in chunks:
+                output.write(chunk)
+                written += len(chunk)
+        finally:
+            if path == '-':
+                output.flush()
+            else:
+                output.close()
+
+        if path != '-':
+            self.stdout.write(self.style.SUCCESS(f'Wrote {written} bytes to {path}'))
@@ -0,0 +1,56 @@
+import json
+import sys
+
+from django.contrib.auth.models import User
+from django.core.management.base import BaseCommand, CommandError
+from trainer.importers import DEFAULT_BATCH_SIZE, FORMATS, HealthMetricsImporter, detect_format, iter_rows
+
+
+class Command(BaseCommand):
+    help = 'Stream health metrics from a CSV or NDJSON file into the database in batches'
+
+    def add_arguments(self, parser):
+        parser.add_argument('path', help='File to import ("-" reads standard input)')
+        parser.add_argument('--format', choices=FORMATS, help='File format (default: guessed from the extension)')
+        parser.add_argument('--user', help='Import every row for this username instead of a username column')
+        parser.add_argument('--batch-size', type=int, default=DEFAULT_BATCH_SIZE, help='Rows per batch/transaction')
+        parser.add_argument('--rejects', help='Write rejected rows and their errors to this NDJSON file')
+
+    def handle(self, *args, **options):
+        user = None
+        if options['user']:
+            try:
+                user = User.objects.get(username=options['user'])
+            except User.DoesNotExist:
+                raise CommandError(f'User "{options["user"]}" does not exist.')
+
+        path = options['path']
+        file_format = options['format'] or detect_format(path)
+
+        rejects_file = open(options['rejects'], 'w') if options['rejects'] else None
+
+        def write_reject(line_number, row, errors):
+            rejects_file.write(json.dumps({'line': line_number, 'row': row, 'errors': errors}) + '\n')
+
+        importer = HealthMetricsImporter(
+            user=user,
+            batch_size=options['batch_size'],
+            on_reject=write_reject if rejects_file else None,
+        )
+        try:
+            if path == '-':
+                result = importer.run(iter_rows(sys.stdin.buffer, file_format))
+            else:
+                with open(path, 'rb') as stream:
+                    result = importer.run(iter_rows(stream, file_format))
+        finally:
+            if rejects_file:
+                rejects_file.close()
+
+        for line_number, errors in result.rejects[:10]:
+            details = '; '.join(f'{field}: {" ".join(messages)}' for field, messages in errors.items())
+            self.stdout.write(self.style.WARNING(f'Line {line_number}: {details}'))
+        if result.rejected > 10:
+            self.stdout.write(self.style.WARNING(f'... and {result.rejected - 10} more rejected rows'))
+
+        self.stdout.write(self.style.SUCCESS(result.summary()))
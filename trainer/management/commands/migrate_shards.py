@@ -0,0 +1,17 @@
+from django.core.management import call_command
+from django.core.management.base import BaseCommand, CommandError
+from trainer.sharding import metric_shards
+
+
+class Command(BaseCommand):
+    help = 'Apply migrations to every metrics shard and start each shard\'s ids in its own range'
+
+    def handle(self, *args, **options):
+        shards = metric_shards()
+        if not shards:
+            raise CommandError('No shards configured. Add aliases to TRAINER_METRICS_SHARDS.')
+        for alias in shards:
+            self.stdout.write(f'Migrating {alias}')
+            # The post_migrate handler seeds the id ranges
+            call_command('migrate', database=alias, interactive=False, verbosity=options['verbosity'])
+        self.stdout.write(self.style.SUCCESS(f'Migrated {len(shards)} shard(s)'))
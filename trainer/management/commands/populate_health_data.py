@@ -1,123 +1,269 @@
-from django.core.management.base import BaseCommand
+from django.core.management.base import BaseCommand, CommandError
+from django.contrib.auth.hashers import make_password
 from django.contrib.auth.models import User
+from django.core.files.base import ContentFile
+from django.core.files.storage import default_storage
 from django.utils import timezone
-from django.db import models
+from django.db import DEFAULT_DB_ALIAS, connection, connections, models, transaction
 from datetime import datetime, time, date, timedelta
+from io import BytesIO
+from PIL import Image
 import random
+from trainer.dashboard_cache import invalidate_users
+from trainer.db_retry import retry_on_lock
 from trainer.models import UserHealthMetrics
+from trainer.processes import worker_pool
+from trainer.rollups import rebuild_rollups
+from trainer.sharding import fan_out, place_new_users, shards_for_users
+
+DEFAULT_START_DATE = date(2025, 10, 15)
+
+# Users handed to a worker at a time
+USERS_PER_TASK = 50
+
+# Synthetic photos are generated once and shared by every row that gets one
+SYNTHETIC_PHOTO_COUNT = 8
+SYNTHETIC_PHOTO_DIR = 'health_metrics/synthetic'
+
+SLEEP_TIMES = [
+    (21, 30), (22, 0), (22, 15), (22, 30), (22, 45),
+    (23, 0), (23, 15), (23, 30)
+]
+WAKE_TIMES = [
+    (6, 0), (6, 30), (7, 0), (7, 15), (7, 30),
+    (8, 0), (8, 15)
+]
+
+# Columns written by the generator, in row tuple order
+COLUMNS = [
+    'user_id', 'recorded_date', 'sleeping_datetime', 'wakeup_datetime', 'sleep_duration_seconds',
+    'weight', 'thigh_length', 'hip_length', 'image', 'image_status', 'created_at', 'updated_at',
+]
+UPDATE_COLUMNS = COLUMNS[2:10] + ['updated_at']
+
+# The demo account keeps the name it always had; generated users only get a username
+NAMED_USERS = {
+    'user1': {'first_name': 'John', 'last_name': 'Doe', 'email': 'john.doe@example.com'},
+}
+
+
+def synthetic_photo_names(seed):
+    """Write the shared synthetic progress photos (once) and return their storage names."""
+    rng = random.Random(f'{seed}-photos')
+    names = []
+    for index in range(SYNTHETIC_PHOTO_COUNT):
+        name = f'{SYNTHETIC_PHOTO_DIR}/seed{seed}_{index}.jpg'
+        if not default_storage.exists(name):
+            color = tuple(rng.randrange(256) for _ in range(3))
+            output = BytesIO()
+            Image.new('RGB', (600, 800), color).save(output, format='JPEG', quality=85)
+            name = default_storage.save(name, ContentFile(output.getvalue()))
+        names.append(name)
+    return names
+
+
+def generate_user_metrics(user_id, user_index, options, photo_names):
+    """
+    Yield row tuples (in COLUMNS order, without timestamps) for one user with
+    realistic variations. The sequence depends only on the seed and the
+    user's index, so results are reproducible whatever the number of workers.
+    """
+    rng = random.Random(f"{options['seed']}-{user_index}")
+    adapt_date = connection.ops.adapt_datefield_value
+    adapt_datetime = connection.ops.adapt_datetimefield_value
+
+    # Per-user starting point and daily trend
+    base_weight = rng.uniform(55.0, 100.0)
+    base_thigh = rng.uniform(48.0, 66.0)
+    base_hip = rng.uniform(85.0, 110.0)
+    daily_trend = rng.uniform(-0.02, 0.01)
+
+    start_date = options['start_date']
+    for day in range(options['days']):
+        current_date = start_date + timedelta(days=day)
+        weight_trend = max(-25.0, min(15.0, daily_trend * day))
+
+        sleep_hour, sleep_minute = rng.choice(SLEEP_TIMES)
+        wake_hour, wake_minute = rng.choice(WAKE_TIMES)
+        sleeping_datetime = timezone.make_aware(datetime.combine(current_date, time(sleep_hour, sleep_minute)))
+        wakeup_datetime = timezone.make_aware(
+            datetime.combine(current_date + timedelta(days=1), time(wake_hour, wake_minute))
+        )
+        sleep_duration = UserHealthMetrics.compute_sleep_duration(sleeping_datetime, wakeup_datetime)
+
+        weight = round(base_weight + weight_trend + rng.uniform(-0.5, 0.5), 2)
+        thigh_length = round(base_thigh + (weight_trend * 0.2) + rng.uniform(-0.5, 0.5), 2)
+        hip_length = round(base_hip + (weight_trend * 0.3) + rng.uniform(-1.0, 1.0), 2)
+        image = None
+        if photo_names and rng.random() < options['photo_ratio']:
+            image = rng.choice(photo_names)
+
+        yield (
+            user_id, adapt_date(current_date), adapt_datetime(sleeping_datetime), adapt_datetime(wakeup_datetime),
+            int(sleep_duration.total_seconds()), weight, thigh_length, hip_length,
+            image, UserHealthMetrics.IMAGE_STATUS_READY,
+        )
+
+
+def populate_users(user_indexes, options, photo_names):
+    """Create (or reuse) the given users and upsert their metrics. Returns the number of rows written."""
+    usernames = {f'user{index}': index for index in user_indexes}
+    existing = set(User.objects.filter(username__in=usernames).values_list('id', flat=True))
+    User.objects.bulk_create(
+        [
+            User(
+                username=username,
+                password=options['password_hash'],
+                **NAMED_USERS.get(username, {'email': f'{username}@example.com'}),
+            )
+            for username in usernames
+        ],
+        ignore_conflicts=True,
+        batch_size=options['batch_size'],
+    )
+    user_ids = dict(User.objects.filter(username__in=usernames).values_list('username', 'id'))
+    # bulk_create skips the post_save handler that places new users on a shard
+    place_new_users(set(user_ids.values()) - existing)
+    shards = shards_for_users(user_ids.values())
+
+    rows = 0
+    batches = {}
+    for username, user_index in usernames.items():
+        alias = shards[user_ids[username]]
+        batch = batches.setdefault(alias, [])
+        for row in generate_user_metrics(user_ids[username], user_index, options, photo_names):
+            batch.append(row)
+            if len(batch) >= options['batch_size']:
+                rows += _write_batch(batch, alias)
+                batch.clear()
+    for alias, batch in batches.items():
+        if batch:
+            rows += _write_batch(batch, alias)
+
+    # The raw upsert bypasses the rollup and dashboard cache signal handlers
+    rebuild_rollups(sorted(user_ids.values()))
+    invalidate_users(user_ids.values())
+    return rows
+
+
+def _upsert_sql(connection):
+    quote = connection.ops.quote_name
+    table = quote(UserHealthMetrics._meta.db_table)
+    return (
+        f'INSERT INTO {table} ({", ".join(quote(c) for c in COLUMNS)}) '
+        f'VALUES ({", ".join(["%s"] * len(COLUMNS))}) '
+        f'ON CONFLICT ({quote("user_id")}, {quote("recorded_date")}) DO UPDATE SET '
+        + ', '.join(f'{quote(c)} = excluded.{quote(c)}' for c in UPDATE_COLUMNS)
+    )
+
+
+@retry_on_lock
+def _write_batch(batch, alias=None):
+    """
+    Upsert generated rows with one prepared statement on the users' shard
+    (alias, None for default). Building model instances and preparing every
+    value through the ORM costs more than the insert itself at this volume;
+    ON CONFLICT works on SQLite and PostgreSQL.
+    """
+    alias = alias or DEFAULT_DB_ALIAS
+    target = connections[alias]
+    now = target.ops.adapt_datetimefield_value(timezone.now())
+    with transaction.atomic(using=alias), target.cursor() as cursor:
+        cursor.executemany(_upsert_sql(target), [row + (now, now) for row in batch])
+    return len(batch)
+
+
+def _populate_task(args):
+    # Runs in a worker process with its own database connection
+    try:
+        return populate_users(*args)
+    finally:
+        connections.close_all()
+
 
 class Command(BaseCommand):
-    help = 'Populate database with sample health metrics data from Oct 15-30, 2025'
+    help = 'Generate reproducible synthetic health metrics (users user1..userN) for demos and load testing'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--users', type=int, default=1, help='Number of users to generate (default: 1)')
+        parser.add_argument('--days', type=int, default=16, help='Days of data per user (default: 16)')
+        parser.add_argument(
+            '--start-date',
+            type=date.fromisoformat,
+            default=DEFAULT_START_DATE,
+            help=f'First recorded date, YYYY-MM-DD (default: {DEFAULT_START_DATE})',
+        )
+        parser.add_argument('--seed', type=int, default=0, help='Random seed; the same seed gives the same data')
+        parser.add_argument(
+            '--photo-ratio',
+            type=float,
+            default=0.0,
+            help='Share of rows (0-1) that get a synthetic progress photo',
+        )
+        parser.add_argument('--workers', type=int, default=1, help='Number of worker processes')
+        parser.add_argument('--batch-size', type=int, default=5000, help='Rows per bulk insert')
 
     def handle(self, *args, **options):
-        # Get or create user1
-        try:
-            user = User.objects.get(username='user1')
-        except User.DoesNotExist:
-            user = User.objects.create_user(
-                username='user1',
-                password='123',
-                first_name='John',
-                last_name='Doe',
-                email='john.doe@example.com'
-            )
-            self.stdout.write(self.style.SUCCESS('Created user: user1'))
-
-        # Clear existing data for this user in the date range
-        start_date = date(2025, 10, 15)
-        end_date = date(2025, 10, 30)
-        
-        UserHealthMetrics.objects.filter(
-            user=user,
-            recorded_date__range=[start_date, end_date]
-        ).delete()
-
-        # Sample data with realistic variations
-        base_weight = 75.0  # Starting weight in kg
-        base_thigh = 58.0   # Starting thigh length in cm
-        base_hip = 95.0     # Starting hip length in cm
-        
-        # Create entries for each day
-        current_date = start_date
-        entries_created = 0
-        
-        while current_date <= end_date:
-            # Calculate realistic weight progression (slight fluctuations with overall trend)
-            days_passed = (current_date - start_date).days
-            weight_trend = -0.1 * days_passed  # Losing 0.1kg per day on average
-            weight_variation = random.uniform(-0.5, 0.5)  # Daily fluctuation
-            weight = round(base_weight + weight_trend + weight_variation, 2)
-            
-            # Thigh measurements with slight variations
-            thigh_variation = random.uniform(-0.5, 0.5)
-            thigh_length = round(base_thigh + (weight_trend * 0.2) + thigh_variation, 2)
-            
-            # Hip measurements with slight variations
-            hip_variation = random.uniform(-1.0, 1.0)
-            hip_length = round(base_hip + (weight_trend * 0.3) + hip_variation, 2)
-            
-            # Generate realistic sleep and wake times
-            sleep_times = [
-                (21, 30), (22, 0), (22, 15), (22, 30), (22, 45),
-                (23, 0), (23, 15), (23, 30)
-            ]
-            wake_times = [
-                (6, 0), (6, 30), (7, 0), (7, 15), (7, 30),
-                (8, 0), (8, 15)
-            ]
-            
-            # Random sleep and wake times
-            sleep_hour, sleep_minute = random.choice(sleep_times)
-            wake_hour, wake_minute = random.choice(wake_times)
-            
-            # Create datetime objects
-            sleep_datetime = timezone.make_aware(
-                datetime.combine(current_date, time(sleep_hour, sleep_minute))
-            )
-            wake_datetime = timezone.make_aware(
-                datetime.combine(current_date + timedelta(days=1), time(wake_hour, wake_minute))
-            )
-            
-            # Create the health metrics entry
-            health_metric = UserHealthMetrics(
-                user=user,
-                wakeup_datetime=wake_datetime,
-                sleeping_datetime=sleep_datetime,
-                weight=weight,
-                thigh_length=thigh_length,
-                hip_length=hip_length,
-                recorded_date=current_date
-            )
-            health_metric.save()
-            
-            entries_created += 1
-            self.stdout.write(
-                f'Created entry for {current_date}: Weight={weight}kg, '
-                f'Sleep={sleep_hour:02d}:{sleep_minute:02d}, '
-                f'Wake={wake_hour:02d}:{wake_minute:02d}, '
-                f'Sleep Duration={health_metric.sleeped_time_formatted}'
+        if options['users'] < 1 or options['days'] < 1:
+            raise CommandError('--users and --days must be at least 1.')
+        if not 0.0 <= options['photo_ratio'] <= 1.0:
+            raise CommandError('--photo-ratio must be between 0 and 1.')
+
+        started = timezone.now()
+        generator_options = {
+            'seed': options['seed'],
+            'start_date': options['start_date'],
+            'days': options['days'],
+            'photo_ratio': options['photo_ratio'],
+            'batch_size': options['batch_size'],
+            # Hash once; every generated user gets the same password ("123")
+            'password_hash': make_password('123'),
+        }
+        photo_names = synthetic_photo_names(options['seed']) if options['photo_ratio'] else []
+
+        user_indexes = list(range(1, options['users'] + 1))
+        tasks = [
+            (user_indexes[i:i + USERS_PER_TASK], generator_options, photo_names)
+            for i in range(0, len(user_indexes), USERS_PER_TASK)
+        ]
+
+        if options['workers'] > 1:
+            with worker_pool(options['workers']) as pool:
+                rows = sum(pool.imap_unordered(_populate_task, tasks))
+        else:
+            rows = sum(populate_users(*task) for task in tasks)
+
+        elapsed = (timezone.now() - started).total_seconds()
+        end_date = options['start_date'] + timedelta(days=options['days'] - 1)
+        sample_ids = list(
+            User.objects.filter(username__in=[f'user{index}' for index in user_indexes[:1000]])
+            .values_list('id', flat=True)
+        )
+
+        def shard_totals(alias):
+            # Sums and counts, so the shards can be averaged together
+            return UserHealthMetrics.objects.on_shard(alias).filter(
+                user_id__in=sample_ids,
+                recorded_date__range=[options['start_date'], end_date],
+            ).aggregate(
+                weight_sum=models.Sum('weight'),
+                weight_count=models.Count('weight'),
+                sleep_sum=models.Sum('sleep_duration_seconds'),
+                sleep_count=models.Count('sleep_duration_seconds'),
+                short_nights=models.Count('id', filter=models.Q(sleep_duration_seconds__lt=6 * 3600)),
             )
-            
-            current_date += timedelta(days=1)
+
+        totals = fan_out(shard_totals)
+        summary = {key: sum(total[key] or 0 for total in totals) for key in totals[0]}
 
         self.stdout.write(
             self.style.SUCCESS(
-                f'Successfully created {entries_created} health metric entries '
-                f'from {start_date} to {end_date}'
+                f'Wrote {rows} health metric rows for {options["users"]} users '
+                f'({options["start_date"]} to {end_date}) in {elapsed:.1f}s '
+                f'({rows / elapsed if elapsed else 0:.0f} rows/s, {options["workers"]} workers)'
+                f'\n- Sample of first {min(len(user_indexes), 1000)} users: '
+                f'average weight {summary["weight_sum"] / max(summary["weight_count"], 1):.2f}kg, '
+                f'average sleep {summary["sleep_sum"] / max(summary["sleep_count"], 1) / 3600:.2f}h, '
+                f'{summary["short_nights"]} nights under 6h'
             )
         )
-        
-        # Display summary statistics
-        total_entries = UserHealthMetrics.objects.filter(user=user).count()
-        avg_weight = UserHealthMetrics.objects.filter(user=user).aggregate(
-            avg_weight=models.Avg('weight')
-        )['avg_weight']
-        
-        self.stdout.write(
-            self.style.SUCCESS(
-                f'\nSummary for user1:'
-                f'\n- Total entries: {total_entries}'
-                f'\n- Average weight: {avg_weight:.2f}kg'
-                f'\n- Date range: {start_date} to {end_date}'
-            )
-        )
\ No newline at end of file
@@ -0,0 +1,39 @@
+from django.core.management.base import BaseCommand
+from trainer.image_processing import process_pending_image
+from trainer.models import UserHealthMetrics
+from trainer.sharding import fan_out
+
+
+class Command(BaseCommand):
+    help = 'Compress progress photos left pending (e.g. after a restart) or failed by the background workers'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--include-failed',
+            action='store_true',
+            help='Also retry photos whose previous processing attempt failed',
+        )
+
+    def handle(self, *args, **options):
+        statuses = [UserHealthMetrics.IMAGE_STATUS_PENDING]
+        if options['include_failed']:
+            statuses.append(UserHealthMetrics.IMAGE_STATUS_FAILED)
+
+        def pending_ids(alias):
+            return list(
+                UserHealthMetrics.objects.on_shard(alias)
+                .filter(image_status__in=statuses)
+                .values_list('pk', flat=True)
+            )
+
+        processed = 0
+        failed = 0
+        for metric_id in (pk for ids in fan_out(pending_ids) for pk in ids):
+            if process_pending_image(metric_id):
+                processed += 1
+            else:
+                failed += 1
+
+        self.stdout.write(
+            self.style.SUCCESS(f'Processed {processed} photos ({failed} skipped or failed)')
+        )
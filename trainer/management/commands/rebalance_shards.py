@@ -0,0 +1,66 @@
+from django.core.management.base import BaseCommand, CommandError
+from django.db.models import Count
+from trainer.models import UserHealthMetrics
+from trainer.sharding import fan_out, metric_shards, move_user, plan_rebalance, shard_for_user
+
+
+def _shard_loads(alias):
+    """{user_id: metric rows} of the users whose metrics are on alias."""
+    return dict(
+        UserHealthMetrics.objects.on_shard(alias)
+        .order_by()
+        .values_list('user_id')
+        .annotate(rows=Count('*'))
+    )
+
+
+class Command(BaseCommand):
+    help = 'Move members\' health metrics between shards: one member, or enough to even out the shards'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--user', type=int, help='Id of the member to move (with --to)')
+        parser.add_argument('--to', help='Alias of the shard to move the member to')
+        parser.add_argument(
+            '--even',
+            action='store_true',
+            help='Move members from the fullest shards to the emptiest until the row counts are within --tolerance',
+        )
+        parser.add_argument(
+            '--tolerance',
+            type=float,
+            default=0.1,
+            help='Allowed deviation from the average rows per shard with --even (default: 0.1)',
+        )
+        parser.add_argument('--dry-run', action='store_true', help='Only print the planned moves')
+
+    def handle(self, *args, **options):
+        shards = metric_shards()
+        if not shards:
+            raise CommandError('No shards configured. Add aliases to TRAINER_METRICS_SHARDS.')
+
+        if options['even']:
+            loads = dict(zip(shards, fan_out(_shard_loads, shards)))
+            moves = plan_rebalance(loads, options['tolerance'])
+        elif options['user'] is not None and options['to']:
+            if options['to'] not in shards:
+                raise CommandError(f'{options["to"]!r} is not in TRAINER_METRICS_SHARDS.')
+            moves = [(options['user'], shard_for_user(options['user']), options['to'])]
+        else:
+            raise CommandError('Give --user and --to, or --even.')
+
+        moved = 0
+        for user_id, source, target in moves:
+            if source == target:
+                self.stdout.write(f'User {user_id} is already on {target}')
+                continue
+            if options['dry_run']:
+                self.stdout.write(f'Would move user {user_id} from {source} to {target}')
+                continue
+            rows = move_user(user_id, target)
+            moved += 1
+            self.stdout.write(f'Moved user {user_id} ({rows} rows) from {source} to {target}')
+
+        if options['dry_run']:
+            self.stdout.write(self.style.SUCCESS(f'{len(moves)} move(s) planned'))
+        else:
+            self.stdout.write(self.style.SUCCESS(f'Moved {moved} member(s)'))
@@ -0,0 +1,40 @@
+from django.core.management.base import BaseCommand, CommandError
+from trainer.rollups import find_rollup_drift, rebuild_rollups
+
+
+class Command(BaseCommand):
+    help = 'Rebuild weekly/monthly health metric rollups from scratch, or check them for drift'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--check',
+            action='store_true',
+            help='Only compare stored rollups with the source rows; exit with an error on drift',
+        )
+        parser.add_argument(
+            '--user',
+            type=int,
+            action='append',
+            dest='user_ids',
+            help='Limit to this user id (can be given several times)',
+        )
+
+    def handle(self, *args, **options):
+        user_ids = options['user_ids']
+
+        if options['check']:
+            drift = 0
+            for user_id, period, period_start, differences in find_rollup_drift(user_ids):
+                drift += 1
+                details = ', '.join(
+                    f'{field}: stored={stored} expected={expected}'
+                    for field, (stored, expected) in differences.items()
+                )
+                self.stdout.write(f'User {user_id} {period} of {period_start}: {details}')
+            if drift:
+                raise CommandError(f'{drift} rollups have drifted. Run rebuild_rollups to fix them.')
+            self.stdout.write(self.style.SUCCESS('Rollups are in sync with health metrics.'))
+            return
+
+        written = rebuild_rollups(user_ids)
+        self.stdout.write(self.style.SUCCESS(f'Rebuilt {written} rollups'))
@@ -0,0 +1,81 @@
+import os
+import time
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from trainer.models import PHOTO_MAX_SIZE, PHOTO_QUALITY
+from trainer.photo_backfill import DEFAULT_BATCH_SIZE, DEFAULT_MAX_RATE, Checkpoint, backfill_photos
+from trainer.processes import worker_pool
+
+
+class Command(BaseCommand):
+    help = (
+        'Recompress existing progress photos with the current settings and render their renditions again, '
+        'resuming from a checkpoint'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--workers', type=int, default=os.cpu_count() or 1,
+            help='Worker processes (default: one per core; 1 runs in this process)',
+        )
+        parser.add_argument('--batch-size', type=int, default=DEFAULT_BATCH_SIZE, help='Rows updated per batch')
+        parser.add_argument(
+            '--max-rate', type=float, default=DEFAULT_MAX_RATE,
+            help=f'Photos started per second at most, 0 for no limit (default: {DEFAULT_MAX_RATE})',
+        )
+        parser.add_argument('--quality', type=int, default=PHOTO_QUALITY, help='JPEG quality (1-95)')
+        parser.add_argument('--max-size', type=int, default=PHOTO_MAX_SIZE, help='Longest edge in pixels')
+        parser.add_argument(
+            '--checkpoint',
+            # Local state: not in the checkout's tracked files, nor in the publicly served MEDIA_ROOT
+            default=os.path.join(settings.BASE_DIR, 'var', 'recompress_photos.checkpoint.json'),
+            help='File the progress is kept in (default: var/recompress_photos.checkpoint.json)',
+        )
+        parser.add_argument('--restart', action='store_true', help='Ignore the checkpoint and start over')
+
+    def handle(self, *args, **options):
+        if options['workers'] < 1 or options['batch_size'] < 1:
+            raise CommandError('--workers and --batch-size must be at least 1.')
+        if options['max_rate'] < 0:
+            raise CommandError('--max-rate cannot be negative.')
+        if not 1 <= options['quality'] <= 95:
+            raise CommandError('--quality must be between 1 and 95.')
+        if options['max_size'] < 1:
+            raise CommandError('--max-size must be at least 1.')
+
+        os.makedirs(os.path.dirname(os.path.abspath(options['checkpoint'])), exist_ok=True)
+        # A checkpoint written with other settings does not cover this run
+        checkpoint = Checkpoint(
+            options['checkpoint'], {'quality': options['quality'], 'max_size': options['max_size']}
+        )
+        # Started over, photos already written with these settings are still skipped
+        if checkpoint.load(resume=not options['restart']):
+            self.stdout.write(f'Resuming after {checkpoint.stats.processed} photos: {checkpoint.last_pks}')
+
+        started = time.perf_counter()
+        already_done = checkpoint.stats.processed
+
+        def report(alias, stats):
+            rate = (stats.processed - already_done) / (time.perf_counter() - started)
+            self.stdout.write(
+                f'{alias or "default"}: {stats.processed} photos, {rate:.1f}/s, '
+                f'{stats.bytes_saved / 1024 / 1024:.1f} MB saved'
+            )
+
+        backfill = dict(
+            quality=options['quality'],
+            max_size=options['max_size'],
+            batch_size=options['batch_size'],
+            max_rate=options['max_rate'],
+            on_batch=report,
+        )
+        if options['workers'] > 1:
+            with worker_pool(options['workers']) as pool:
+                stats = backfill_photos(checkpoint, pool=pool, **backfill)
+        else:
+            stats = backfill_photos(checkpoint, **backfill)
+
+        seconds = time.perf_counter() - started
+        self.stdout.write(self.style.SUCCESS(stats.summary(seconds, already_done)))
+        self.stdout.write('Replaced files are deleted by collect_photo_garbage.')
@@ -0,0 +1,47 @@
+import time
+
+from django.core.management.base import BaseCommand, CommandError
+from django.db import DEFAULT_DB_ALIAS, connections
+from trainer.db_routing import copy_sqlite_database, read_replicas
+
+
+class Command(BaseCommand):
+    help = 'Copy the primary SQLite database over the read replicas (a local stand-in for replication)'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--database',
+            action='append',
+            dest='databases',
+            help='Replica alias to refresh (repeatable, default: every alias in TRAINER_READ_REPLICAS)',
+        )
+        parser.add_argument(
+            '--interval',
+            type=float,
+            help='Keep copying every this many seconds until interrupted',
+        )
+
+    def handle(self, *args, **options):
+        aliases = options['databases'] or read_replicas()
+        if not aliases:
+            raise CommandError('No replicas configured. Add aliases to TRAINER_READ_REPLICAS.')
+        for alias in aliases:
+            if alias not in connections.settings or alias == DEFAULT_DB_ALIAS:
+                raise CommandError(f'{alias!r} is not a replica database alias.')
+            if connections[alias].vendor != 'sqlite':
+                raise CommandError(f'Replica {alias!r} is not SQLite.')
+
+        while True:
+            for alias in aliases:
+                # Drop this process's connection so it reopens the new copy
+                connections[alias].close()
+                try:
+                    copy_sqlite_database(DEFAULT_DB_ALIAS, connections[alias].settings_dict['NAME'])
+                except ValueError as e:
+                    raise CommandError(str(e))
+                self.stdout.write(f'Copied {DEFAULT_DB_ALIAS} to {alias}')
+            if not options['interval']:
+                break
+            time.sleep(options['interval'])
+
+        self.stdout.write(self.style.SUCCESS(f'Refreshed {len(aliases)} replica(s)'))
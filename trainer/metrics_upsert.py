@@ -0,0 +1,141 @@
+"""
+Single-statement upsert of one day's health metrics.
+
+``update_or_create`` reads the (user, recorded_date) row, then writes it, and
+the model's save() used to read it once more to see whether the photo had
+changed. upsert_health_metrics() instead issues one
+``INSERT ... ON CONFLICT (user_id, recorded_date) DO UPDATE`` that sets the
+submitted columns only when one of them differs from the stored row, so an
+unchanged resubmission writes nothing and leaves ``updated_at`` (and the
+pages' conditional GET validators) alone. A photo is only processed when a
+new file was uploaded; without one the stored photo is kept.
+
+The upsert does not compare the photo columns: when it changes nothing but a
+new photo was uploaded, a second UPDATE stores just the photo, and the
+rollups, which do not depend on it, are left alone. post_save is sent for
+every write as for a saved instance, so rollups and the dashboard cache
+follow. Databases without ``ON CONFLICT`` fall back to update_or_create.
+"""
+from django.db import connections, router, transaction
+from django.db.models.signals import post_save
+
+from .db_retry import retry_on_lock
+from .models import UserHealthMetrics
+from .sharding import shard_for_write
+
+CREATED = 'created'
+UPDATED = 'updated'
+UNCHANGED = 'unchanged'
+
+UPSERT_VENDORS = ('sqlite', 'postgresql')
+
+# Columns set on every write; the rest are only written when submitted
+DERIVED_COLUMNS = ('sleep_duration_seconds',)
+
+# Columns of a new photo; they do not feed the rollups
+PHOTO_COLUMNS = ('image', 'image_status')
+
+
+def _upsert_sql(connection, columns, updated, compared):
+    quote = connection.ops.quote_name
+    table = quote(UserHealthMetrics._meta.db_table)
+    distinct = 'IS NOT' if connection.vendor == 'sqlite' else 'IS DISTINCT FROM'
+    return (
+        f'INSERT INTO {table} ({", ".join(quote(column) for column in columns)}) '
+        f'VALUES ({", ".join(["%s"] * len(columns))}) '
+        f'ON CONFLICT ({quote("user_id")}, {quote("recorded_date")}) DO UPDATE SET '
+        + ', '.join(f'{quote(column)} = excluded.{quote(column)}' for column in updated)
+        + ' WHERE '
+        + ' OR '.join(f'{table}.{quote(column)} {distinct} excluded.{quote(column)}' for column in compared)
+        # Both timestamps are stamped with the same time on insert only
+        + f' RETURNING {quote("id")}, {quote("created_at")} = {quote("updated_at")}'
+    )
+
+
+def _photo_update_sql(connection):
+    quote = connection.ops.quote_name
+    distinct = 'IS NOT' if connection.vendor == 'sqlite' else 'IS DISTINCT FROM'
+    return (
+        f'UPDATE {quote(UserHealthMetrics._meta.db_table)} '
+        f'SET {quote("image")} = %s, {quote("image_status")} = %s, {quote("updated_at")} = %s '
+        f'WHERE {quote("user_id")} = %s AND {quote("recorded_date")} = %s '
+        f'AND ({quote("image")} {distinct} %s OR {quote("image_status")} {distinct} %s) '
+        f'RETURNING {quote("id")}, {quote("created_at")} = {quote("updated_at")}'
+    )
+
+
+@retry_on_lock
+def _write(metric, using, upsert, photo_update=None):
+    """Run the upsert, and the photo update if the upsert changed nothing. Returns the outcome."""
+    with transaction.atomic(using=using), connections[using].cursor() as cursor:
+        cursor.execute(*upsert)
+        row = cursor.fetchone()
+        if row is None and photo_update is not None:
+            cursor.execute(*photo_update)
+            row = cursor.fetchone()
+            if row is not None:
+                # Everything but the photo is as stored: tells the rollups there is nothing to redo
+                metric.remember_values()
+        if row is None:
+            return UNCHANGED
+        metric.pk, created = row[0], bool(row[1])
+        metric._state.adding = False
+        metric._state.db = using
+        post_save.send(
+            sender=UserHealthMetrics, instance=metric, created=created, update_fields=None, raw=False, using=using
+        )
+    return CREATED if created else UPDATED
+
+
+def upsert_health_metrics(user, recorded_date, values):
+    """
+    Create or update the metrics of user on recorded_date with values (a dict
+    of field names; 'image' only for a newly uploaded photo). Returns the
+    metric and CREATED, UPDATED or UNCHANGED. The metric is not read back:
+    it holds the submitted values, and its pk only when something was written.
+    """
+    from .image_processing import enqueue_image_processing
+
+    using = shard_for_write(user) or router.db_for_write(UserHealthMetrics)
+    connection = connections[using]
+    if connection.vendor not in UPSERT_VENDORS:
+        metric, created = retry_on_lock(UserHealthMetrics.objects.for_user(user).update_or_create)(
+            user=user, recorded_date=recorded_date, defaults=values
+        )
+        return metric, CREATED if created else UPDATED
+
+    metric = UserHealthMetrics(user=user, recorded_date=recorded_date, **values)
+    submitted = set(values)
+    process_later = False
+    if metric.image:
+        process_later = metric.prepare_image()
+        submitted.add('image_status')
+    metric.update_sleep_duration()
+
+    params = {}
+    for field in UserHealthMetrics._meta.concrete_fields:
+        if not field.primary_key:
+            # Stamps the timestamps and stores a photo left to the workers
+            value = field.pre_save(metric, add=True)
+            params[field.column] = field.get_db_prep_save(value, connection)
+    params['updated_at'] = params['created_at']
+    metric.updated_at = metric.created_at
+
+    compared = [
+        UserHealthMetrics._meta.get_field(name).column for name in sorted(submitted)
+        if name not in PHOTO_COLUMNS
+    ] + list(DERIVED_COLUMNS)
+    updated = compared + [column for column in PHOTO_COLUMNS if column in submitted] + ['updated_at']
+    upsert = (_upsert_sql(connection, list(params), updated, compared), list(params.values()))
+    photo_update = None
+    if metric.image:
+        photo_update = (_photo_update_sql(connection), [
+            params['image'], params['image_status'], params['updated_at'],
+            params['user_id'], params['recorded_date'], params['image'], params['image_status'],
+        ])
+    outcome = _write(metric, using, upsert, photo_update)
+    if outcome != UNCHANGED:
+        metric.remember_values()
+        if process_later:
+            enqueue_image_processing(metric.pk)
+    return metric, outcome
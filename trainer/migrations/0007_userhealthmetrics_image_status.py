@@ -0,0 +1,27 @@
+# Generated by Django 5.2.7 on 2026-10-17 09:58
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("trainer", "0006_alter_userhealthmetrics_recorded_date"),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name="userhealthmetrics",
+            name="image_status",
+            field=models.CharField(
+                choices=[
+                    ("pending", "Pending"),
+                    ("ready", "Ready"),
+                    ("failed", "Failed"),
+                ],
+                default="ready",
+                help_text="Processing state of the progress photo",
+                max_length=10,
+            ),
+        ),
+    ]
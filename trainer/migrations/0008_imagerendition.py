@@ -0,0 +1,69 @@
+# Generated by Django 5.2.7 on 2026-10-17 09:59
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("trainer", "0007_userhealthmetrics_image_status"),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name="ImageRendition",
+            fields=[
+                (
+                    "id",
+                    models.BigAutoField(
+                        auto_created=True,
+                        primary_key=True,
+                        serialize=False,
+                        verbose_name="ID",
+                    ),
+                ),
+                (
+                    "kind",
+                    models.CharField(
+                        choices=[
+                            ("thumbnail", "Thumbnail"),
+                            ("card", "Card"),
+                            ("full", "Full"),
+                        ],
+                        max_length=10,
+                    ),
+                ),
+                (
+                    "format",
+                    models.CharField(
+                        choices=[("jpeg", "JPEG"), ("webp", "WebP")],
+                        default="jpeg",
+                        max_length=4,
+                    ),
+                ),
+                ("image", models.ImageField(upload_to="health_metrics/renditions/")),
+                ("width", models.PositiveIntegerField(default=0)),
+                ("height", models.PositiveIntegerField(default=0)),
+                (
+                    "source_name",
+                    models.CharField(
+                        help_text="Name of the photo this rendition was built from",
+                        max_length=255,
+                    ),
+                ),
+                ("created_at", models.DateTimeField(auto_now_add=True)),
+                (
+                    "metric",
+                    models.ForeignKey(
+                        on_delete=django.db.models.deletion.CASCADE,
+                        related_name="renditions",
+                        to="trainer.userhealthmetrics",
+                    ),
+                ),
+            ],
+            options={
+                "unique_together": {("metric", "kind", "format")},
+            },
+        ),
+    ]
@@ -0,0 +1,33 @@
+# Generated by Django 5.2.7 on 2026-10-17 10:03
+
+from django.conf import settings
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("trainer", "0009_healthmetricsrollup"),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name="userhealthmetrics",
+            name="sleep_duration_seconds",
+            field=models.PositiveIntegerField(
+                blank=True,
+                db_index=True,
+                editable=False,
+                help_text="Sleep duration in seconds, derived from the sleep and wakeup times",
+                null=True,
+            ),
+        ),
+        migrations.AddIndex(
+            model_name="userhealthmetrics",
+            index=models.Index(
+                fields=["user", "sleep_duration_seconds"],
+                name="trainer_uhm_user_sleep_idx",
+            ),
+        ),
+    ]
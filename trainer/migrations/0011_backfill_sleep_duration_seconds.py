@@ -0,0 +1,44 @@
+from datetime import timedelta
+
+from django.db import migrations
+
+BATCH_SIZE = 1000
+
+
+def sleep_duration_seconds(sleeping_datetime, wakeup_datetime):
+    # Same rule as UserHealthMetrics.compute_sleep_duration: wakeup wraps to the next day
+    if wakeup_datetime <= sleeping_datetime:
+        wakeup_datetime += timedelta(days=1)
+    return int((wakeup_datetime - sleeping_datetime).total_seconds())
+
+
+def backfill_sleep_duration(apps, schema_editor):
+    UserHealthMetrics = apps.get_model("trainer", "UserHealthMetrics")
+    rows = (
+        UserHealthMetrics.objects.filter(sleep_duration_seconds__isnull=True)
+        .only("id", "sleeping_datetime", "wakeup_datetime")
+        .order_by("id")
+    )
+    last_id = 0
+    while True:
+        # Walk the table in primary key order so each batch is a short indexed read
+        batch = list(rows.filter(id__gt=last_id)[:BATCH_SIZE])
+        if not batch:
+            break
+        for metric in batch:
+            metric.sleep_duration_seconds = sleep_duration_seconds(
+                metric.sleeping_datetime, metric.wakeup_datetime
+            )
+        UserHealthMetrics.objects.bulk_update(batch, ["sleep_duration_seconds"])
+        last_id = batch[-1].id
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("trainer", "0010_userhealthmetrics_sleep_duration_seconds"),
+    ]
+
+    operations = [
+        migrations.RunPython(backfill_sleep_duration, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,55 @@
+from django.db import migrations
+
+# Case-insensitive prefix indexes on auth_user for the dashboard user search.
+# The index must match the SQL each backend generates for istartswith, so it
+# is created with backend-specific statements.
+SEARCH_FIELDS = ["username", "first_name", "last_name"]
+
+
+def index_name(field):
+    return f"trainer_user_{field}_prefix_idx"
+
+
+def create_indexes(apps, schema_editor):
+    vendor = schema_editor.connection.vendor
+    for field in SEARCH_FIELDS:
+        if vendor == "sqlite":
+            # LIKE is case-insensitive on SQLite and can use a NOCASE index
+            expression = f'"{field}" COLLATE NOCASE'
+        elif vendor == "postgresql":
+            # istartswith compiles to UPPER(field::text) LIKE UPPER(%s)
+            expression = f'(UPPER("{field}"::text)) text_pattern_ops'
+        elif field == "username":
+            # Elsewhere (e.g. MySQL) the column collation is case-insensitive
+            # and username already has its unique index
+            continue
+        else:
+            expression = schema_editor.quote_name(field)
+        schema_editor.execute(
+            f"CREATE INDEX {schema_editor.quote_name(index_name(field))} "
+            f"ON {schema_editor.quote_name('auth_user')} ({expression})"
+        )
+
+
+def drop_indexes(apps, schema_editor):
+    vendor = schema_editor.connection.vendor
+    for field in SEARCH_FIELDS:
+        if field == "username" and vendor not in ("sqlite", "postgresql"):
+            continue
+        name = schema_editor.quote_name(index_name(field))
+        if vendor == "mysql":
+            schema_editor.execute(f"DROP INDEX {name} ON {schema_editor.quote_name('auth_user')}")
+        else:
+            schema_editor.execute(f"DROP INDEX {name}")
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("auth", "0012_alter_user_first_name_max_length"),
+        ("trainer", "0011_backfill_sleep_duration_seconds"),
+    ]
+
+    operations = [
+        migrations.RunPython(create_indexes, drop_indexes),
+    ]
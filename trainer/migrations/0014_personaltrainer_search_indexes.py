@@ -0,0 +1,42 @@
+# Generated by Django 5.2.7 on 2026-10-17 10:24
+
+from django.conf import settings
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("trainer", "0013_userhealthmetrics_date_index"),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name="personaltrainer",
+            index=models.Index(
+                fields=["is_available", "specialization", "hourly_rate"],
+                name="trainer_pt_avail_spec_rate_idx",
+            ),
+        ),
+        migrations.AddIndex(
+            model_name="personaltrainer",
+            index=models.Index(
+                fields=["is_available", "hourly_rate"], name="trainer_pt_avail_rate_idx"
+            ),
+        ),
+        migrations.AddIndex(
+            model_name="personaltrainer",
+            index=models.Index(
+                fields=["is_available", "experience_years"],
+                name="trainer_pt_avail_exp_idx",
+            ),
+        ),
+        migrations.AddIndex(
+            model_name="personaltrainer",
+            index=models.Index(
+                fields=["is_available", "created_at"],
+                name="trainer_pt_avail_created_idx",
+            ),
+        ),
+    ]
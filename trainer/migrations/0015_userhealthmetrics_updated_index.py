@@ -0,0 +1,21 @@
+# Generated by Django 5.2.7 on 2026-10-17 10:26
+
+from django.conf import settings
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("trainer", "0014_personaltrainer_search_indexes"),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name="userhealthmetrics",
+            index=models.Index(
+                fields=["user", "updated_at"], name="trainer_uhm_user_updated_idx"
+            ),
+        ),
+    ]
@@ -0,0 +1,42 @@
+# Generated by Django 5.2.7 on 2026-10-17 10:54
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("trainer", "0016_metrics_sharding"),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name="StoredPhoto",
+            fields=[
+                (
+                    "name",
+                    models.CharField(max_length=255, primary_key=True, serialize=False),
+                ),
+                ("size", models.PositiveIntegerField()),
+                ("last_used", models.DateTimeField(auto_now=True)),
+            ],
+        ),
+        migrations.AlterField(
+            model_name="imagerendition",
+            name="image",
+            field=models.ImageField(
+                db_index=True, upload_to="health_metrics/renditions/"
+            ),
+        ),
+        migrations.AlterField(
+            model_name="userhealthmetrics",
+            name="image",
+            field=models.ImageField(
+                blank=True,
+                db_index=True,
+                help_text="Progress photo",
+                null=True,
+                upload_to="health_metrics/",
+            ),
+        ),
+    ]
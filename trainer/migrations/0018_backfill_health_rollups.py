@@ -0,0 +1,26 @@
+from django.db import migrations
+
+from trainer.rollups import REBUILD_BATCH_SIZE, replace_rollups
+
+
+def backfill_rollups(apps, schema_editor):
+    # Runs once per migrated database, so each shard rebuilds its own users
+    alias = schema_editor.connection.alias
+    UserHealthMetrics = apps.get_model("trainer", "UserHealthMetrics")
+    HealthMetricsRollup = apps.get_model("trainer", "HealthMetricsRollup")
+    metrics = UserHealthMetrics.objects.using(alias)
+    rollups = HealthMetricsRollup.objects.using(alias)
+    user_ids = list(metrics.values_list("user_id", flat=True).distinct().order_by("user_id"))
+    for start in range(0, len(user_ids), REBUILD_BATCH_SIZE):
+        replace_rollups(metrics, rollups, user_ids[start:start + REBUILD_BATCH_SIZE])
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("trainer", "0017_photo_store"),
+    ]
+
+    operations = [
+        migrations.RunPython(backfill_rollups, migrations.RunPython.noop),
+    ]
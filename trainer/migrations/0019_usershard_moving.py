@@ -0,0 +1,18 @@
+# Generated by Django 5.2.7 on 2026-10-17 12:28
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("trainer", "0018_backfill_health_rollups"),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name="usershard",
+            name="moving",
+            field=models.BooleanField(default=False),
+        ),
+    ]
@@ -1,9 +1,17 @@
 from django.db import models
 from django.contrib.auth.models import User
-from PIL import Image
 from io import BytesIO
 from django.core.files.base import ContentFile
 import os
+from datetime import timedelta
+
+from .image_decode import decode_scaled
+from .sharding import metric_shards, shard_for_pk, shard_for_user
+
+# Progress photos are stored as JPEGs of at most this size and quality
+PHOTO_MAX_SIZE = 800
+PHOTO_QUALITY = 85
+
 
 # Create your models here.
 class PersonalTrainer(models.Model):
@@ -16,45 +24,153 @@ class PersonalTrainer(models.Model):
     created_at = models.DateTimeField(auto_now_add=True)
     updated_at = models.DateTimeField(auto_now=True)
 
+    class Meta:
+        indexes = [
+            # Trainer search: filter on availability (and specialization), then rate, experience or recency
+            models.Index(fields=['is_available', 'specialization', 'hourly_rate'], name='trainer_pt_avail_spec_rate_idx'),
+            models.Index(fields=['is_available', 'hourly_rate'], name='trainer_pt_avail_rate_idx'),
+            models.Index(fields=['is_available', 'experience_years'], name='trainer_pt_avail_exp_idx'),
+            models.Index(fields=['is_available', 'created_at'], name='trainer_pt_avail_created_idx'),
+        ]
+
     def __str__(self):
         return f"{self.user.first_name} {self.user.last_name} - {self.specialization}"
 
 
 
+class ShardedQuerySet(models.QuerySet):
+    """Queries of a table sharded by user (see trainer/sharding.py)."""
+    user_lookup = 'user'
+
+    def on_shard(self, alias):
+        """Run on the given shard; None (no sharding) keeps the normal routing."""
+        return self if alias is None else self.using(alias)
+
+    def for_user(self, user):
+        """Rows of one user (an instance or id), on that user's shard."""
+        return self.on_shard(shard_for_user(user)).filter(**{self.user_lookup: user})
+
+    def on_shard_of(self, pk):
+        """Run on the shard holding the row with this primary key."""
+        return self.on_shard(shard_for_pk(pk))
+
+    def create(self, **kwargs):
+        if self._db is not None or not metric_shards():
+            return super().create(**kwargs)
+        # Let the router pick the shard from the new row, not from the model alone
+        obj = self.model(**kwargs)
+        obj.save(force_insert=True)
+        return obj
+
+
+class RenditionQuerySet(ShardedQuerySet):
+    user_lookup = 'metric__user'
+
+
+class UserShard(models.Model):
+    """The database holding a user's metrics when they are sharded (see trainer/sharding.py)."""
+    user = models.OneToOneField(User, on_delete=models.CASCADE, primary_key=True, related_name='metrics_shard')
+    shard = models.CharField(max_length=100)
+    # Set while move_user() copies the user to another shard; writes wait for it
+    moving = models.BooleanField(default=False)
+    updated_at = models.DateTimeField(auto_now=True)
+
+    def __str__(self):
+        return f"{self.user_id} on {self.shard}"
+
+
+class StoredPhoto(models.Model):
+    """A content-addressed photo or rendition file and when it was last stored or reused (see trainer/photo_store.py)."""
+    name = models.CharField(max_length=255, primary_key=True)
+    size = models.PositiveIntegerField()
+    last_used = models.DateTimeField(auto_now=True)
+
+    def __str__(self):
+        return self.name
+
+
 class UserHealthMetrics(models.Model):
-    user = models.ForeignKey(User, on_delete=models.CASCADE)
+    IMAGE_STATUS_PENDING = 'pending'
+    IMAGE_STATUS_READY = 'ready'
+    IMAGE_STATUS_FAILED = 'failed'
+    IMAGE_STATUS_CHOICES = [
+        (IMAGE_STATUS_PENDING, 'Pending'),
+        (IMAGE_STATUS_READY, 'Ready'),
+        (IMAGE_STATUS_FAILED, 'Failed'),
+    ]
+
+    # No database constraint: with sharding the user lives on another database
+    user = models.ForeignKey(User, on_delete=models.CASCADE, db_constraint=False)
     wakeup_datetime = models.DateTimeField()
     sleeping_datetime = models.DateTimeField()
     weight = models.DecimalField(max_digits=5, decimal_places=2, help_text="Weight in kg")
     thigh_length = models.DecimalField(max_digits=5, decimal_places=2, help_text="Thigh length in cm")
     hip_length = models.DecimalField(max_digits=5, decimal_places=2, help_text="Hip length in cm")
-    image = models.ImageField(upload_to='health_metrics/', blank=True, null=True, help_text="Progress photo")
+    # Indexed for the photo garbage collector's reference checks
+    image = models.ImageField(
+        upload_to='health_metrics/', blank=True, null=True, db_index=True, help_text="Progress photo"
+    )
+    image_status = models.CharField(
+        max_length=10,
+        choices=IMAGE_STATUS_CHOICES,
+        default=IMAGE_STATUS_READY,
+        help_text="Processing state of the progress photo",
+    )
     recorded_date = models.DateField()
+    sleep_duration_seconds = models.PositiveIntegerField(
+        null=True,
+        blank=True,
+        editable=False,
+        db_index=True,
+        help_text="Sleep duration in seconds, derived from the sleep and wakeup times",
+    )
     created_at = models.DateTimeField(auto_now_add=True)
     updated_at = models.DateTimeField(auto_now=True)
 
-    @property
-    def sleeped_time(self):
+    objects = ShardedQuerySet.as_manager()
+
+    @classmethod
+    def from_db(cls, db, field_names, values):
+        instance = super().from_db(db, field_names, values)
+        # Remember the values as loaded so writes can tell what changed
+        instance._loaded_values = dict(zip(field_names, values))
+        return instance
+
+    @staticmethod
+    def compute_sleep_duration(sleeping_datetime, wakeup_datetime):
         """
         Calculate the duration of sleep between sleeping_datetime and wakeup_datetime.
         Returns a timedelta object representing the sleep duration.
         Handles cases where wakeup time is the next day.
         """
-        if not self.sleeping_datetime or not self.wakeup_datetime:
+        if not sleeping_datetime or not wakeup_datetime:
             return None
-        
+
         # If wakeup time is before sleep time, assume wakeup is the next day
-        if self.wakeup_datetime <= self.sleeping_datetime:
+        if wakeup_datetime <= sleeping_datetime:
             # Add 24 hours to wakeup time to account for next day
-            from datetime import timedelta
-            next_day_wakeup = self.wakeup_datetime + timedelta(days=1)
-            sleep_duration = next_day_wakeup - self.sleeping_datetime
-        else:
-            # Same day scenario (rare but possible for naps)
-            sleep_duration = self.wakeup_datetime - self.sleeping_datetime
-        
-        return sleep_duration
-    
+            return wakeup_datetime + timedelta(days=1) - sleeping_datetime
+        # Same day scenario (rare but possible for naps)
+        return wakeup_datetime - sleeping_datetime
+
+    def update_sleep_duration(self):
+        """
+        Refresh the stored sleep_duration_seconds from the sleep/wakeup times.
+        save() calls this; bulk_create/bulk_update callers must call it themselves.
+        """
+        duration = self.compute_sleep_duration(self.sleeping_datetime, self.wakeup_datetime)
+        self.sleep_duration_seconds = None if duration is None else int(duration.total_seconds())
+
+    @property
+    def sleeped_time(self):
+        """
+        Return the stored sleep duration as a timedelta.
+        Falls back to computing it for rows that have not been saved yet.
+        """
+        if self.sleep_duration_seconds is not None:
+            return timedelta(seconds=self.sleep_duration_seconds)
+        return self.compute_sleep_duration(self.sleeping_datetime, self.wakeup_datetime)
+
     @property
     def sleeped_time_hours(self):
         """
@@ -90,7 +206,7 @@ class UserHealthMetrics(models.Model):
         else:
             return f"{minutes}m"
 
-    def compress_image(self, image_field, quality=85, max_width=800, max_height=800):
+    def compress_image(self, image_field, quality=PHOTO_QUALITY, max_width=PHOTO_MAX_SIZE, max_height=PHOTO_MAX_SIZE):
         """
         Compress and resize image before saving.
         Args:
@@ -102,32 +218,13 @@ class UserHealthMetrics(models.Model):
         if not image_field:
             return None
             
-        # Open the image
-        img = Image.open(image_field)
-        
-        # Convert to RGB if necessary (for PNG with transparency, etc.)
-        if img.mode in ('RGBA', 'LA', 'P'):
-            img = img.convert('RGB')
-        
-        # Calculate new dimensions while maintaining aspect ratio
-        original_width, original_height = img.size
-        
-        # Only resize if image is larger than max dimensions
-        if original_width > max_width or original_height > max_height:
-            # Calculate scaling factor
-            width_ratio = max_width / original_width
-            height_ratio = max_height / original_height
-            scale_factor = min(width_ratio, height_ratio)
-            
-            new_width = int(original_width * scale_factor)
-            new_height = int(original_height * scale_factor)
-            
-            # Resize with high-quality resampling
-            img = img.resize((new_width, new_height), Image.Resampling.LANCZOS)
+        # Decoded close to the target size, upright and as RGB (or grayscale)
+        img = decode_scaled(image_field, (max_width, max_height))
         
         # Compress the image
         output = BytesIO()
         img.save(output, format='JPEG', quality=quality, optimize=True)
+        img.close()
         output.seek(0)
         
         # Generate new filename with .jpg extension
@@ -137,32 +234,192 @@ class UserHealthMetrics(models.Model):
         # Return compressed image as ContentFile
         return ContentFile(output.read(), name=compressed_name)
 
+    @property
+    def image_ready(self):
+        """Return True when the progress photo can be shown on the dashboard."""
+        return bool(self.image) and self.image_status == self.IMAGE_STATUS_READY
+
+    def remember_values(self):
+        """Record the current field values as the ones in the database (see from_db)."""
+        deferred = self.get_deferred_fields()
+        self._loaded_values = {
+            field.attname: getattr(self, field.attname).name if isinstance(field, models.FileField)
+            else getattr(self, field.attname)
+            for field in self._meta.concrete_fields
+            if field.attname not in deferred
+        }
+
+    def prepare_image(self):
+        """
+        Compress a newly assigned photo and store it under its content hash,
+        or with async processing leave it to the workers. Returns True if the
+        photo must be enqueued once the row is saved.
+        """
+        from .image_processing import async_processing_enabled
+        from .photo_store import photo_directory, store_photo
+
+        if async_processing_enabled():
+            # Store the raw upload now; a background worker compresses it later
+            self.image_status = self.IMAGE_STATUS_PENDING
+            return True
+        compressed_image = self.compress_image(self.image)
+        if compressed_image:
+            # Stored under its content hash; a photo stored before is reused
+            self.image = store_photo(compressed_image, photo_directory(self.image.field))
+        self.image_status = self.IMAGE_STATUS_READY
+        return False
+
     def save(self, *args, **kwargs):
         """Override save method to compress image before saving."""
+        from .image_processing import enqueue_image_processing
+
         # Compress image if it exists and is being updated
-        if self.image and hasattr(self.image, 'file'):
-            # Check if this is a new image or if the image has changed
+        image_changed = False
+        if self.image:
+            loaded = getattr(self, '_loaded_values', None)
             if not self.pk or (self.pk and self._state.adding):
                 # New record or new image
-                compressed_image = self.compress_image(self.image)
-                if compressed_image:
-                    self.image.save(compressed_image.name, compressed_image, save=False)
+                image_changed = True
+            elif loaded is not None and 'image' in loaded:
+                # Compare with the value as loaded instead of reading the row again
+                image_changed = self.image.name != loaded['image']
             else:
                 # Check if image has changed
                 try:
-                    old_instance = UserHealthMetrics.objects.get(pk=self.pk)
-                    if old_instance.image != self.image:
-                        compressed_image = self.compress_image(self.image)
-                        if compressed_image:
-                            self.image.save(compressed_image.name, compressed_image, save=False)
+                    old_instance = UserHealthMetrics.objects.on_shard_of(self.pk).get(pk=self.pk)
+                    image_changed = old_instance.image != self.image
                 except UserHealthMetrics.DoesNotExist:
                     pass
-        
+            image_changed = image_changed and hasattr(self.image, 'file')
+
+        process_later = image_changed and self.prepare_image()
+
+        self.update_sleep_duration()
+
+        # update_or_create() passes update_fields; keep derived columns in sync
+        update_fields = kwargs.get('update_fields')
+        if update_fields is not None:
+            update_fields = set(update_fields)
+            if image_changed:
+                update_fields.add('image_status')
+            if update_fields & {'sleeping_datetime', 'wakeup_datetime'}:
+                update_fields.add('sleep_duration_seconds')
+            kwargs['update_fields'] = update_fields
+
         super().save(*args, **kwargs)
+        # Later saves compare with what was just written
+        self.remember_values()
+
+        if process_later:
+            enqueue_image_processing(self.pk)
 
     class Meta:
         unique_together = ['user', 'recorded_date']  # One record per user per day
         ordering = ['-recorded_date']
+        indexes = [
+            models.Index(fields=['user', 'sleep_duration_seconds'], name='trainer_uhm_user_sleep_idx'),
+            # Admin change list: unfiltered ordering, date hierarchy bounds and ranges
+            models.Index(fields=['recorded_date', 'id'], name='trainer_uhm_date_id_idx'),
+            # Conditional GET validators: latest change and row count per user
+            models.Index(fields=['user', 'updated_at'], name='trainer_uhm_user_updated_idx'),
+        ]
 
     def __str__(self):
         return f"{self.user.username} - {self.recorded_date} (Weight: {self.weight}kg)"
+
+
+
+class HealthMetricsRollup(models.Model):
+    """
+    Per-user weekly or monthly aggregate of UserHealthMetrics.
+    Kept up to date by the signal handlers in trainer/rollups.py.
+    """
+    PERIOD_WEEK = 'week'
+    PERIOD_MONTH = 'month'
+    PERIOD_CHOICES = [
+        (PERIOD_WEEK, 'Week'),
+        (PERIOD_MONTH, 'Month'),
+    ]
+
+    user = models.ForeignKey(User, on_delete=models.CASCADE, related_name='health_rollups', db_constraint=False)
+    period = models.CharField(max_length=5, choices=PERIOD_CHOICES)
+    period_start = models.DateField(help_text="Monday of the week or first day of the month")
+    count = models.PositiveIntegerField(default=0)
+    weight_sum = models.DecimalField(max_digits=12, decimal_places=2, default=0)
+    weight_min = models.DecimalField(max_digits=5, decimal_places=2, null=True)
+    weight_max = models.DecimalField(max_digits=5, decimal_places=2, null=True)
+    thigh_length_sum = models.DecimalField(max_digits=12, decimal_places=2, default=0)
+    thigh_length_min = models.DecimalField(max_digits=5, decimal_places=2, null=True)
+    thigh_length_max = models.DecimalField(max_digits=5, decimal_places=2, null=True)
+    hip_length_sum = models.DecimalField(max_digits=12, decimal_places=2, default=0)
+    hip_length_min = models.DecimalField(max_digits=5, decimal_places=2, null=True)
+    hip_length_max = models.DecimalField(max_digits=5, decimal_places=2, null=True)
+    sleep_seconds_sum = models.BigIntegerField(default=0)
+    sleep_seconds_min = models.IntegerField(null=True)
+    sleep_seconds_max = models.IntegerField(null=True)
+    updated_at = models.DateTimeField(auto_now=True)
+
+    objects = ShardedQuerySet.as_manager()
+
+    class Meta:
+        unique_together = ['user', 'period', 'period_start']
+        ordering = ['user', 'period', '-period_start']
+
+    def _average(self, total):
+        return total / self.count if self.count else None
+
+    @property
+    def weight_avg(self):
+        return self._average(self.weight_sum)
+
+    @property
+    def thigh_length_avg(self):
+        return self._average(self.thigh_length_sum)
+
+    @property
+    def hip_length_avg(self):
+        return self._average(self.hip_length_sum)
+
+    @property
+    def sleep_hours_avg(self):
+        average = self._average(self.sleep_seconds_sum)
+        return None if average is None else round(average / 3600, 2)
+
+    def __str__(self):
+        return f"{self.user.username} - {self.period} of {self.period_start} ({self.count} entries)"
+
+
+class ImageRendition(models.Model):
+    """A resized copy of a progress photo used for responsive delivery."""
+    KIND_THUMBNAIL = 'thumbnail'
+    KIND_CARD = 'card'
+    KIND_FULL = 'full'
+    KIND_CHOICES = [
+        (KIND_THUMBNAIL, 'Thumbnail'),
+        (KIND_CARD, 'Card'),
+        (KIND_FULL, 'Full'),
+    ]
+
+    FORMAT_JPEG = 'jpeg'
+    FORMAT_WEBP = 'webp'
+    FORMAT_CHOICES = [
+        (FORMAT_JPEG, 'JPEG'),
+        (FORMAT_WEBP, 'WebP'),
+    ]
+
+    metric = models.ForeignKey(UserHealthMetrics, on_delete=models.CASCADE, related_name='renditions')
+    kind = models.CharField(max_length=10, choices=KIND_CHOICES)
+    format = models.CharField(max_length=4, choices=FORMAT_CHOICES, default=FORMAT_JPEG)
+    image = models.ImageField(upload_to='health_metrics/renditions/', db_index=True)
+    width = models.PositiveIntegerField(default=0)
+    height = models.PositiveIntegerField(default=0)
+    source_name = models.CharField(max_length=255, help_text="Name of the photo this rendition was built from")
+    created_at = models.DateTimeField(auto_now_add=True)
+
+    objects = RenditionQuerySet.as_manager()
+
+    class Meta:
+        unique_together = ['metric', 'kind', 'format']
+
+    def __str__(self):
+        return f"{self.metric} - {self.kind} ({self.format}, {self.width}x{self.height})"
@@ -0,0 +1,310 @@
+"""
+Request metrics in Prometheus text format.
+
+RequestMetricsMiddleware records, per URL name (e.g. ``trainer:dashboard``),
+a latency histogram, the number of requests by method and status, SQL query
+count and time (through a connection execute wrapper) and template render
+time (through InstrumentedDjangoTemplates). Under ASGI, SQL runs on worker
+threads, each with its own connections: the middleware counts the queries
+of the request's thread, and code running queries on other threads wraps
+them in counting_queries(). The counters live in one
+process-wide registry guarded by a lock and are served by the ``metrics``
+view. Each process keeps its own counters, as with any Prometheus client.
+
+The ``metrics`` view is for staff users. A scraper can be let in with a
+bearer token (``TRAINER_METRICS_TOKEN``) or by address
+(``TRAINER_METRICS_ALLOWED_IPS``); both are off by default. Behind a reverse
+proxy every request comes from the proxy's address, so only list addresses
+that nothing but the scraper can connect from, and prefer the token.
+"""
+import bisect
+import hmac
+import threading
+import time
+from contextlib import ExitStack, contextmanager
+from contextvars import ContextVar
+
+from asgiref.sync import iscoroutinefunction, markcoroutinefunction, sync_to_async
+from django.conf import settings
+from django.core.exceptions import MiddlewareNotUsed
+from django.db import connections
+from django.template.backends.django import DjangoTemplates
+
+# Upper bounds (seconds) of the latency histogram buckets
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+UNRESOLVED_VIEW = '<unresolved>'
+
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+# Stats of the request being handled in the current thread or task
+_current_request = ContextVar('trainer_request_stats', default=None)
+
+
+def metrics_enabled():
+    return getattr(settings, 'TRAINER_REQUEST_METRICS', True)
+
+
+def scraper_allowed(request):
+    """Whether request may read the metrics without a staff login: by bearer token or allowed address."""
+    token = getattr(settings, 'TRAINER_METRICS_TOKEN', '')
+    scheme, _, credentials = request.headers.get('Authorization', '').partition(' ')
+    if token and scheme.lower() == 'bearer' and hmac.compare_digest(credentials.encode(), token.encode()):
+        return True
+    return request.META.get('REMOTE_ADDR') in getattr(settings, 'TRAINER_METRICS_ALLOWED_IPS', [])
+
+
+class RequestStats:
+    """
+    SQL and template timings collected while one request is handled. The
+    request's queries may run on several threads at once (gather_queries), so
+    the counters are updated under a lock.
+    """
+
+    __slots__ = ('_lock', 'sql_queries', 'sql_seconds', 'template_seconds')
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.sql_queries = 0
+        self.sql_seconds = 0.0
+        self.template_seconds = 0.0
+
+    def __call__(self, execute, sql, params, many, context):
+        # Connection execute wrapper
+        started = time.perf_counter()
+        try:
+            return execute(sql, params, many, context)
+        finally:
+            elapsed = time.perf_counter() - started
+            with self._lock:
+                self.sql_seconds += elapsed
+                self.sql_queries += 1
+
+    def add_template_time(self, seconds):
+        with self._lock:
+            self.template_seconds += seconds
+
+
+class _ViewMetrics:
+    __slots__ = ('buckets', 'latency_sum', 'count', 'statuses', 'sql_queries', 'sql_seconds', 'template_seconds')
+
+    def __init__(self):
+        self.buckets = [0] * (len(LATENCY_BUCKETS) + 1)
+        self.latency_sum = 0.0
+        self.count = 0
+        self.statuses = {}
+        self.sql_queries = 0
+        self.sql_seconds = 0.0
+        self.template_seconds = 0.0
+
+
+class MetricsRegistry:
+    """Thread-safe per-view counters."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._views = {}
+        # Free-form counters: {name: (help text, {label items: value})}
+        self._counters = {}
+
+    def increment(self, name, help_text, value=1, **labels):
+        """Add value to the counter name with the given labels."""
+        key = tuple(sorted(labels.items()))
+        with self._lock:
+            values = self._counters.setdefault(name, (help_text, {}))[1]
+            values[key] = values.get(key, 0) + value
+
+    def counter_value(self, name, **labels):
+        with self._lock:
+            values = self._counters.get(name, (None, {}))[1]
+            return values.get(tuple(sorted(labels.items())), 0)
+
+    def observe(self, view, method, status, duration, stats):
+        bucket = bisect.bisect_left(LATENCY_BUCKETS, duration)
+        with self._lock:
+            metrics = self._views.get(view)
+            if metrics is None:
+                metrics = self._views[view] = _ViewMetrics()
+            metrics.buckets[bucket] += 1
+            metrics.latency_sum += duration
+            metrics.count += 1
+            key = (method, status)
+            metrics.statuses[key] = metrics.statuses.get(key, 0) + 1
+            metrics.sql_queries += stats.sql_queries
+            metrics.sql_seconds += stats.sql_seconds
+            metrics.template_seconds += stats.template_seconds
+
+    def reset(self):
+        with self._lock:
+            self._views = {}
+            self._counters = {}
+
+    def snapshot(self):
+        """Return {view: dict of counters}, copied under the lock."""
+        with self._lock:
+            return {
+                view: {
+                    'buckets': list(metrics.buckets),
+                    'latency_sum': metrics.latency_sum,
+                    'count': metrics.count,
+                    'statuses': dict(metrics.statuses),
+                    'sql_queries': metrics.sql_queries,
+                    'sql_seconds': metrics.sql_seconds,
+                    'template_seconds': metrics.template_seconds,
+                }
+                for view, metrics in self._views.items()
+            }
+
+    def render(self):
+        """Return the counters in Prometheus text exposition format."""
+        views = sorted(self.snapshot().items())
+        lines = [
+            '# HELP trainer_request_duration_seconds Request latency by view.',
+            '# TYPE trainer_request_duration_seconds histogram',
+        ]
+        for view, metrics in views:
+            label = _label(view)
+            cumulative = 0
+            for bound, count in zip(LATENCY_BUCKETS + (None,), metrics['buckets']):
+                cumulative += count
+                le = '+Inf' if bound is None else repr(bound)
+                lines.append(f'trainer_request_duration_seconds_bucket{{view="{label}",le="{le}"}} {cumulative}')
+            lines.append(f'trainer_request_duration_seconds_sum{{view="{label}"}} {metrics["latency_sum"]:.6f}')
+            lines.append(f'trainer_request_duration_seconds_count{{view="{label}"}} {metrics["count"]}')
+
+        lines += [
+            '# HELP trainer_requests_total Requests by view, method and status code.',
+            '# TYPE trainer_requests_total counter',
+        ]
+        for view, metrics in views:
+            for (method, status), count in sorted(metrics['statuses'].items()):
+                lines.append(
+                    f'trainer_requests_total{{view="{_label(view)}",method="{_label(method)}",'
+                    f'status="{status}"}} {count}'
+                )
+
+        for name, key, help_text, fmt in [
+            ('trainer_sql_queries_total', 'sql_queries', 'SQL queries executed by view.', '{}'),
+            ('trainer_sql_duration_seconds_total', 'sql_seconds', 'Time spent in SQL by view.', '{:.6f}'),
+            (
+                'trainer_template_render_seconds_total', 'template_seconds',
+                'Time spent rendering templates by view.', '{:.6f}',
+            ),
+        ]:
+            lines += [f'# HELP {name} {help_text}', f'# TYPE {name} counter']
+            for view, metrics in views:
+                lines.append(f'{name}{{view="{_label(view)}"}} {fmt.format(metrics[key])}')
+
+        with self._lock:
+            counters = {
+                name: (help_text, dict(values)) for name, (help_text, values) in self._counters.items()
+            }
+        for name, (help_text, values) in sorted(counters.items()):
+            lines += [f'# HELP {name} {help_text}', f'# TYPE {name} counter']
+            for key, value in sorted(values.items()):
+                labels = ','.join(f'{label}="{_label(label_value)}"' for label, label_value in key)
+                lines.append(f'{name}{{{labels}}} {value}' if labels else f'{name} {value}')
+
+        return '\n'.join(lines) + '\n'
+
+
+def _label(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+registry = MetricsRegistry()
+
+
+@contextmanager
+def counting_queries():
+    """Count the queries run on this thread's connections towards the current request, if any."""
+    stats = _current_request.get()
+    with ExitStack() as stack:
+        if stats is not None:
+            for connection in connections.all():
+                stack.enter_context(connection.execute_wrapper(stats))
+        yield
+
+
+class RequestMetricsMiddleware:
+    """Record latency, SQL and template time of every request in the registry."""
+
+    sync_capable = True
+    async_capable = True
+
+    def __init__(self, get_response):
+        if not metrics_enabled():
+            raise MiddlewareNotUsed
+        self.get_response = get_response
+        if iscoroutinefunction(get_response):
+            markcoroutinefunction(self)
+
+    def __call__(self, request):
+        if iscoroutinefunction(self):
+            return self.__acall__(request)
+        stats = RequestStats()
+        token = _current_request.set(stats)
+        started = time.perf_counter()
+        try:
+            with counting_queries():
+                response = self.get_response(request)
+        finally:
+            _current_request.reset(token)
+        self.observe(request, response, started, stats)
+        return response
+
+    async def __acall__(self, request):
+        stats = RequestStats()
+        token = _current_request.set(stats)
+        started = time.perf_counter()
+        try:
+            # Entered and left on the thread the request's ORM calls run on
+            counting = ExitStack()
+            await sync_to_async(counting.enter_context)(counting_queries())
+            try:
+                response = await self.get_response(request)
+            finally:
+                await sync_to_async(counting.close)()
+        finally:
+            _current_request.reset(token)
+        self.observe(request, response, started, stats)
+        return response
+
+    def observe(self, request, response, started, stats):
+        match = getattr(request, 'resolver_match', None)
+        view = match.view_name if match and match.view_name else UNRESOLVED_VIEW
+        registry.observe(view, request.method, response.status_code, time.perf_counter() - started, stats)
+
+
+class InstrumentedTemplate:
+    """Wrap a backend template to add its render time to the current request."""
+
+    def __init__(self, template):
+        self.template = template
+
+    def __getattr__(self, name):
+        return getattr(self.template, name)
+
+    def render(self, context=None, request=None):
+        stats = _current_request.get()
+        if stats is None:
+            return self.template.render(context, request)
+        started = time.perf_counter()
+        try:
+            return self.template.render(context, request)
+        finally:
+            stats.add_template_time(time.perf_counter() - started)
+
+
+class InstrumentedDjangoTemplates(DjangoTemplates):
+    """
+    The Django template backend, timing every top-level render. Included and
+    extended templates are rendered inside the top-level one, so nothing is
+    counted twice.
+    """
+
+    def from_string(self, template_code):
+        return InstrumentedTemplate(super().from_string(template_code))
+
+    def get_template(self, template_name):
+        return InstrumentedTemplate(super().get_template(template_name))
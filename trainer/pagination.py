@@ -0,0 +1,87 @@
+"""
+Keyset (cursor) pagination over (recorded_date, id), newest first.
+
+Instead of OFFSET, each page starts right after the row the cursor points
+at, so the database seeks straight to it through the (user, recorded_date)
+unique index and page N costs the same as page 1. Cursors are opaque
+URL-safe strings encoding the boundary row's date and id.
+"""
+import base64
+import binascii
+from datetime import date
+
+from django.db.models import Q
+
+PAGE_SIZES = [10, 25, 50, 100]
+DEFAULT_PAGE_SIZE = 25
+
+
+def encode_cursor(recorded_date, pk):
+    raw = f'{recorded_date.isoformat()}|{pk}'.encode()
+    return base64.urlsafe_b64encode(raw).decode().rstrip('=')
+
+
+def decode_cursor(cursor):
+    """Return (recorded_date, id) from a cursor, or None if it is malformed."""
+    try:
+        raw = base64.urlsafe_b64decode(cursor + '=' * (-len(cursor) % 4)).decode()
+        day, pk = raw.split('|')
+        return date.fromisoformat(day), int(pk)
+    except (binascii.Error, UnicodeDecodeError, ValueError):
+        return None
+
+
+class KeysetPage:
+    """One page of rows with the cursors of the neighbouring pages (None at either end)."""
+
+    def __init__(self, rows, next_cursor, previous_cursor):
+        self.rows = rows
+        self.next_cursor = next_cursor
+        self.previous_cursor = previous_cursor
+
+    @property
+    def has_next(self):
+        return self.next_cursor is not None
+
+    @property
+    def has_previous(self):
+        return self.previous_cursor is not None
+
+
+def keyset_page(queryset, after=None, before=None, page_size=DEFAULT_PAGE_SIZE):
+    """
+    Return the page of queryset (rows with 'recorded_date' and 'id', e.g. from
+    values()) that follows the after cursor or precedes the before cursor, newest
+    first. Without a cursor the first page is returned.
+    """
+    after = decode_cursor(after) if after else None
+    before = decode_cursor(before) if before else None
+
+    if before:
+        # Walk backwards towards newer rows, then restore newest-first order
+        day, pk = before
+        rows = list(
+            queryset.filter(recorded_date__gte=day)
+            .filter(Q(recorded_date__gt=day) | Q(id__gt=pk))
+            .order_by('recorded_date', 'id')[:page_size + 1]
+        )
+        has_more_newer = len(rows) > page_size
+        rows = rows[:page_size][::-1]
+        has_more_older = True
+    else:
+        if after:
+            day, pk = after
+            queryset = queryset.filter(recorded_date__lte=day).filter(Q(recorded_date__lt=day) | Q(id__lt=pk))
+        rows = list(queryset.order_by('-recorded_date', '-id')[:page_size + 1])
+        has_more_older = len(rows) > page_size
+        rows = rows[:page_size]
+        has_more_newer = after is not None
+
+    if not rows:
+        return KeysetPage(rows, None, None)
+    first, last = rows[0], rows[-1]
+    return KeysetPage(
+        rows,
+        encode_cursor(last['recorded_date'], last['id']) if has_more_older else None,
+        encode_cursor(first['recorded_date'], first['id']) if has_more_newer else None,
+    )
@@ -0,0 +1,276 @@
+"""
+Backfill of existing progress photos: recompress them with the current
+settings and render their renditions again.
+
+Rows are read shard by shard in primary key order, a batch at a time, and
+their photos are processed by worker processes that only touch files: each
+worker recompresses a photo with compress_image() and renders the
+renditions, and the parent stores the results and updates the batch's rows
+in one statement. A photo is only replaced when the recompressed file is
+smaller. Replaced files are left to ``collect_photo_garbage``.
+
+After every batch the last primary key done on each shard is written to a
+checkpoint file, so an interrupted run resumes where it stopped. Work is
+handed to the workers at most ``max_rate`` photos per second, to leave
+capacity to the live site.
+
+Recompressing a JPEG again loses quality each time, so photos stored since
+the checkpoint's settings were first used (their StoredPhoto row is newer)
+are skipped, also by a run started over.
+"""
+import json
+import os
+import time
+from datetime import datetime
+from functools import reduce
+from io import BytesIO
+from operator import or_
+
+from django.core.files.base import ContentFile
+from django.db import DEFAULT_DB_ALIAS, transaction
+from django.db.models import Case, Q, Value, When
+from django.utils import timezone
+
+from .dashboard_cache import invalidate_users
+from .db_retry import retry_on_lock
+from .models import PHOTO_MAX_SIZE, PHOTO_QUALITY, ImageRendition, StoredPhoto, UserHealthMetrics
+from .photo_store import photo_directory, store_photo
+from .renditions import decode_source, render_renditions, rendition_keys
+from .sharding import each_shard
+
+DEFAULT_BATCH_SIZE = 100
+DEFAULT_MAX_RATE = 10
+
+
+class BackfillStats:
+    """Counters of a backfill, carried over in the checkpoint."""
+
+    FIELDS = ('processed', 'replaced', 'skipped', 'failed', 'bytes_before', 'bytes_saved')
+
+    def __init__(self, **counts):
+        for field in self.FIELDS:
+            setattr(self, field, counts.get(field, 0))
+
+    def as_dict(self):
+        return {field: getattr(self, field) for field in self.FIELDS}
+
+    def summary(self, seconds, resumed_from=0):
+        """One line report; the rate counts the photos done in seconds, after resumed_from."""
+        rate = (self.processed - resumed_from) / seconds if seconds else 0
+        return (
+            f'{self.processed} photos ({rate:.1f}/s): {self.replaced} recompressed, {self.skipped} skipped, '
+            f'{self.failed} failed; '
+            f'saved {self.bytes_saved / 1024 / 1024:.1f} MB of {self.bytes_before / 1024 / 1024:.1f} MB'
+        )
+
+
+class Checkpoint:
+    """
+    Progress of a backfill in a JSON file: the last primary key done per
+    shard, the counters, and since when photos are stored with its settings.
+    """
+
+    def __init__(self, path, settings):
+        self.path = path
+        self.settings = settings
+        self.last_pks = {}
+        self.stats = BackfillStats()
+        self.since = timezone.now()
+
+    def load(self, resume=True):
+        """
+        Read the file if it was written with the same settings. Returns True if
+        resumed; with resume False only since is kept, to start over.
+        """
+        if not self.path or not os.path.exists(self.path):
+            return False
+        with open(self.path) as f:
+            state = json.load(f)
+        if state.get('settings') != self.settings:
+            return False
+        if state.get('since'):
+            self.since = datetime.fromisoformat(state['since'])
+        if not resume:
+            return False
+        self.last_pks = state['last_pks']
+        self.stats = BackfillStats(**state['stats'])
+        return True
+
+    def save(self):
+        if not self.path:
+            return
+        # Written aside and renamed, so an interruption never leaves half a file
+        temporary = f'{self.path}.tmp'
+        with open(temporary, 'w') as f:
+            json.dump({
+                'settings': self.settings,
+                'since': self.since.isoformat(),
+                'last_pks': self.last_pks,
+                'stats': self.stats.as_dict(),
+            }, f)
+        os.replace(temporary, self.path)
+
+
+class RateLimiter:
+    """Let callers through at most rate times per second (no limit for 0)."""
+
+    def __init__(self, rate):
+        self.interval = 1 / rate if rate else 0
+        self.next_time = time.monotonic()
+
+    def wait(self):
+        if not self.interval:
+            return
+        now = time.monotonic()
+        if self.next_time > now:
+            time.sleep(self.next_time - now)
+        self.next_time = max(now, self.next_time) + self.interval
+
+
+def iter_photo_batches(alias, after=0, batch_size=DEFAULT_BATCH_SIZE):
+    """Yield lists of (pk, user_id, image name) of rows with a ready photo on a shard, in pk order after a pk."""
+    rows = (
+        UserHealthMetrics.objects.on_shard(alias)
+        .filter(image_status=UserHealthMetrics.IMAGE_STATUS_READY)
+        .exclude(image='').exclude(image__isnull=True)
+        .order_by('pk')
+        .values_list('pk', 'user_id', 'image')
+    )
+    while batch := list(rows.filter(pk__gt=after)[:batch_size]):
+        yield batch
+        after = batch[-1][0]
+
+
+def recompress_photo(task):
+    """
+    Worker: recompress one stored photo and render its renditions. Returns
+    (pk, original size, new photo bytes or None to keep it, renditions as
+    (kind, format, file name, bytes, size) tuples, error message or None).
+    Only reads files, so it can run in a worker process.
+    """
+    pk, name, quality, max_size = task
+    storage = UserHealthMetrics._meta.get_field('image').storage
+    try:
+        with storage.open(name, 'rb') as f:
+            original = f.read()
+        compressed = UserHealthMetrics().compress_image(
+            ContentFile(original, name=name), quality=quality, max_width=max_size, max_height=max_size
+        ).read()
+        photo = compressed if len(compressed) < len(original) else None
+        img = decode_source(BytesIO(photo or original))
+        renditions = [
+            (kind, fmt, content.name, content.read(), size)
+            for kind, fmt, content, size in render_renditions(img, rendition_keys())
+        ]
+    except Exception as e:
+        return pk, 0, None, [], f'{name}: {e}'
+    return pk, len(original), photo, renditions, None
+
+
+@retry_on_lock
+def _write_batch(alias, names, replaced, renditions):
+    """
+    Point the rows at their new photos and upsert their renditions, in one
+    transaction. Rows whose photo changed since they were read are left
+    alone. Returns the primary keys written.
+    """
+    metrics = UserHealthMetrics.objects.on_shard(alias)
+    with transaction.atomic(using=alias):
+        unchanged = set(
+            metrics.select_for_update()
+            .filter(reduce(or_, (Q(pk=pk, image=name) for pk, name in names.items())))
+            .values_list('pk', flat=True)
+        )
+        replaced = {pk: name for pk, name in replaced.items() if pk in unchanged}
+        if replaced:
+            metrics.filter(pk__in=replaced).update(
+                image=Case(*(When(pk=pk, then=Value(name)) for pk, name in replaced.items())),
+                updated_at=timezone.now(),
+            )
+        renditions = [rendition for rendition in renditions if rendition.metric_id in unchanged]
+        if renditions:
+            ImageRendition.objects.on_shard(alias).bulk_create(
+                renditions,
+                update_conflicts=True,
+                unique_fields=['metric', 'kind', 'format'],
+                update_fields=['image', 'width', 'height', 'source_name'],
+            )
+    return unchanged
+
+
+def _store_batch(alias, rows, results, stats):
+    """Store the batch's new files, then point its rows and renditions at them."""
+    photo_field = UserHealthMetrics._meta.get_field('image')
+    rendition_field = ImageRendition._meta.get_field('image')
+    names = {pk: name for pk, _, name in rows}
+    user_ids = {pk: user_id for pk, user_id, _ in rows}
+    done = {}
+    replaced = {}
+    renditions = []
+    for pk, original_size, photo, rendered, error in results:
+        stats.processed += 1
+        if error:
+            stats.failed += 1
+            continue
+        stats.bytes_before += original_size
+        done[pk] = names[pk]
+        source_name = names[pk]
+        if photo is not None:
+            source_name = store_photo(ContentFile(photo, name='photo.jpg'), photo_directory(photo_field))
+            replaced[pk] = source_name
+        for kind, fmt, file_name, data, (width, height) in rendered:
+            renditions.append(ImageRendition(
+                metric_id=pk, kind=kind, format=fmt, width=width, height=height, source_name=source_name,
+                image=store_photo(ContentFile(data, name=file_name), photo_directory(rendition_field)),
+            ))
+    if not done:
+        return
+
+    written = _write_batch(alias, done, replaced, renditions)
+    saved = {pk: original_size - len(photo) for pk, original_size, photo, _, _ in results if pk in replaced}
+    for pk in replaced.keys() & written:
+        stats.replaced += 1
+        stats.bytes_saved += saved[pk]
+    invalidate_users({user_ids[pk] for pk in written})
+
+
+def backfill_photos(
+    checkpoint,
+    pool=None,
+    quality=PHOTO_QUALITY,
+    max_size=PHOTO_MAX_SIZE,
+    batch_size=DEFAULT_BATCH_SIZE,
+    max_rate=DEFAULT_MAX_RATE,
+    on_batch=None,
+):
+    """
+    Recompress every ready photo after the checkpoint, on a multiprocessing
+    pool if given. on_batch(alias, stats) is called after each batch. Returns
+    the checkpoint's BackfillStats.
+    """
+    limiter = RateLimiter(max_rate)
+    imap = pool.imap_unordered if pool is not None else map
+
+    def throttled(tasks):
+        for task in tasks:
+            limiter.wait()
+            yield task
+
+    stats = checkpoint.stats
+    for alias in each_shard():
+        key = alias or DEFAULT_DB_ALIAS
+        for rows in iter_photo_batches(alias, checkpoint.last_pks.get(key, 0), batch_size):
+            # Already written with these settings, by this backfill or an upload
+            recent = set(
+                StoredPhoto.objects.filter(name__in=[name for _, _, name in rows], last_used__gte=checkpoint.since)
+                .values_list('name', flat=True)
+            )
+            stats.skipped += sum(name in recent for _, _, name in rows)
+            tasks = [(pk, name, quality, max_size) for pk, _, name in rows if name not in recent]
+            results = list(imap(recompress_photo, throttled(tasks)))
+            _store_batch(alias, rows, results, stats)
+            checkpoint.last_pks[key] = rows[-1][0]
+            checkpoint.save()
+            if on_batch:
+                on_batch(alias, stats)
+    return stats
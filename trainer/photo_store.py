@@ -0,0 +1,155 @@
+"""
+Content-addressed storage of progress photos and their renditions.
+
+Compressed photos and renditions are stored under the SHA-256 of their bytes
+(``health_metrics/3f/3fa4....jpg``), so identical photos share one file and
+uploading a photo again stores nothing new. As files can be shared, nothing
+deletes a file when a row stops using it; collect_garbage() (the
+``collect_photo_garbage`` command) later removes the files no row references.
+
+Storing or reusing a file records it in StoredPhoto with a fresh
+``last_used``. The collector leaves alone files used within a grace period
+(untracked files, e.g. raw uploads, by modification time) and removes the
+StoredPhoto row and the file in one transaction. An upload reusing the file
+at the same time either refreshed the row first, and the file is kept, or
+waits for that transaction and stores the file again.
+"""
+import hashlib
+import os
+from datetime import timedelta
+from itertools import islice
+
+from django.db import transaction
+from django.utils import timezone
+
+from .models import ImageRendition, StoredPhoto, UserHealthMetrics
+from .sharding import fan_out
+
+# Files used more recently than this are never collected
+DEFAULT_MIN_AGE = timedelta(hours=1)
+
+# File names checked against the database per query
+GC_BATCH_SIZE = 1000
+
+
+def photo_directory(field):
+    """Directory of a FileField's files, e.g. 'health_metrics'."""
+    return field.upload_to.rstrip('/')
+
+
+def content_name(content, directory):
+    """Storage name of content under its SHA-256, keeping its extension."""
+    digest = hashlib.sha256()
+    content.seek(0)
+    for chunk in content.chunks():
+        digest.update(chunk)
+    content.seek(0)
+    extension = os.path.splitext(content.name or '')[1].lower() or '.jpg'
+    hexdigest = digest.hexdigest()
+    return f'{directory}/{hexdigest[:2]}/{hexdigest}{extension}'
+
+
+def store_photo(content, directory, storage=None):
+    """Store content (a File) under its content hash, unless already there. Returns the storage name."""
+    storage = storage or UserHealthMetrics._meta.get_field('image').storage
+    name = content_name(content, directory)
+    # Mark the file as used before looking for it, so the collector keeps it (one upsert)
+    StoredPhoto.objects.bulk_create(
+        [StoredPhoto(name=name, size=content.size, last_used=timezone.now())],
+        update_conflicts=True,
+        unique_fields=['name'],
+        update_fields=['size', 'last_used'],
+    )
+    if not storage.exists(name):
+        saved = storage.save(name, content)
+        if saved != name:
+            # Someone stored the same bytes in the meantime
+            storage.delete(saved)
+    return name
+
+
+def walk(storage, directory):
+    """Yield the names of every file under directory, one directory listing at a time."""
+    try:
+        directories, files = storage.listdir(directory)
+    except FileNotFoundError:
+        return
+    for file_name in files:
+        yield f'{directory}/{file_name}'
+    for subdirectory in directories:
+        yield from walk(storage, f'{directory}/{subdirectory}')
+
+
+def referenced_names(names):
+    """The names that a photo or rendition row on any shard points at."""
+    def query(alias):
+        return (
+            set(UserHealthMetrics.objects.on_shard(alias).filter(image__in=names).values_list('image', flat=True))
+            | set(ImageRendition.objects.on_shard(alias).filter(image__in=names).values_list('image', flat=True))
+        )
+
+    return set().union(*fan_out(query))
+
+
+class GarbageStats:
+    """Counters of one collection run."""
+
+    def __init__(self):
+        self.scanned = 0
+        self.referenced = 0
+        self.recent = 0
+        self.deleted = 0
+        self.deleted_bytes = 0
+
+    def summary(self, dry_run=False):
+        verb = 'Would delete' if dry_run else 'Deleted'
+        return (
+            f'Scanned {self.scanned} files: {self.referenced} in use, {self.recent} too recent; '
+            f'{verb} {self.deleted} ({self.deleted_bytes / 1024 / 1024:.1f} MB)'
+        )
+
+
+def _delete(storage, name, cutoff):
+    """Delete an unreferenced file unless it was reused since cutoff. Returns True if deleted."""
+    with transaction.atomic():
+        tracked = StoredPhoto.objects.filter(name=name)
+        if tracked.exists() and not tracked.filter(last_used__lt=cutoff).delete()[0]:
+            return False
+        storage.delete(name)
+    return True
+
+
+def collect_garbage(min_age=DEFAULT_MIN_AGE, dry_run=False, on_delete=None, batch_size=GC_BATCH_SIZE):
+    """
+    Delete photo and rendition files that no row references and that were
+    not used within min_age. Files are listed and checked in batches, so
+    memory does not grow with the media tree. on_delete is called with each
+    deleted (or, with dry_run, deletable) name. Returns a GarbageStats.
+    """
+    field = UserHealthMetrics._meta.get_field('image')
+    storage = field.storage
+    cutoff = timezone.now() - min_age
+    stats = GarbageStats()
+
+    # Renditions live in a subdirectory of the photos
+    names = walk(storage, photo_directory(field))
+    while batch := list(islice(names, batch_size)):
+        stats.scanned += len(batch)
+        referenced = referenced_names(batch)
+        stats.referenced += len(referenced)
+        candidates = [name for name in batch if name not in referenced]
+        last_used = dict(StoredPhoto.objects.filter(name__in=candidates).values_list('name', 'last_used'))
+        for name in candidates:
+            used = last_used[name] if name in last_used else storage.get_modified_time(name)
+            if used >= cutoff:
+                stats.recent += 1
+                continue
+            size = storage.size(name)
+            if dry_run or _delete(storage, name, cutoff):
+                stats.deleted += 1
+                stats.deleted_bytes += size
+                if on_delete:
+                    on_delete(name)
+            else:
+                stats.recent += 1
+    return stats
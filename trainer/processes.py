@@ -0,0 +1,32 @@
+"""
+Process pools for the management commands that spread work over cores.
+
+Workers start with the platform's default method. Under spawn (the default on
+macOS and Windows) a worker is a fresh interpreter that has not set Django up,
+so the pool's initializer does, then applies the parent's values of the
+settings that may have been changed at run time (test databases, overridden
+settings).
+"""
+import multiprocessing
+
+import django
+from django.conf import settings
+from django.db import connections
+
+# Settings read by the workers' tasks
+INHERITED_SETTINGS = ('DATABASES', 'MEDIA_ROOT', 'TRAINER_METRICS_SHARDS', 'TRAINER_IMAGE_RENDITIONS_WEBP')
+
+
+def _init_worker(inherited):
+    # Before setup: defining the models already reads the database settings
+    for name, value in inherited.items():
+        setattr(settings, name, value)
+    django.setup()
+
+
+def worker_pool(processes):
+    """A multiprocessing Pool of processes workers that can use the ORM, whatever the start method."""
+    # Workers must not inherit the parent's open database connections
+    connections.close_all()
+    inherited = {name: getattr(settings, name) for name in INHERITED_SETTINGS if hasattr(settings, name)}
+    return multiprocessing.Pool(processes, initializer=_init_worker, initargs=(inherited,))
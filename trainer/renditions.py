@@ -0,0 +1,174 @@
+"""
+Multi-resolution renditions of progress photos.
+
+Each ``UserHealthMetrics.image`` is served in several sizes (thumbnail, card,
+full) as JPEG and, when enabled, WebP. Renditions are recorded in
+``ImageRendition`` and built on demand the first time a photo is displayed,
+so existing rows keep working. A rendition is tied to the photo it was built
+from and is rebuilt once the photo changes.
+"""
+import logging
+from io import BytesIO
+
+from django.conf import settings
+from django.core.files.base import ContentFile
+from django.db import IntegrityError
+from PIL import Image, features
+
+from .image_decode import decode_scaled
+from .models import ImageRendition
+from .photo_store import photo_directory, store_photo
+
+logger = logging.getLogger(__name__)
+
+# Longest edge in pixels for each rendition, largest first
+RENDITION_SIZES = {
+    ImageRendition.KIND_FULL: 800,
+    ImageRendition.KIND_CARD: 400,
+    ImageRendition.KIND_THUMBNAIL: 160,
+}
+
+FORMAT_OPTIONS = {
+    ImageRendition.FORMAT_JPEG: ('JPEG', 'jpg', {'quality': 85, 'optimize': True}),
+    ImageRendition.FORMAT_WEBP: ('WEBP', 'webp', {'quality': 80, 'method': 4}),
+}
+
+
+def rendition_formats():
+    """Return the formats renditions are built in."""
+    formats = [ImageRendition.FORMAT_JPEG]
+    if getattr(settings, 'TRAINER_IMAGE_RENDITIONS_WEBP', True) and features.check('webp'):
+        formats.append(ImageRendition.FORMAT_WEBP)
+    return formats
+
+
+def rendition_keys():
+    """Return the (kind, format) pairs every photo is rendered in."""
+    return [(kind, fmt) for kind in RENDITION_SIZES for fmt in rendition_formats()]
+
+
+class RenditionSet:
+    """Rendition URLs of one photo, shaped for ``<picture>``/``srcset`` markup."""
+
+    def __init__(self, renditions):
+        self._renditions = renditions
+
+    def _srcset(self, fmt):
+        entries = sorted(
+            (r for (kind, r_fmt), r in self._renditions.items() if r_fmt == fmt),
+            key=lambda r: r.width,
+        )
+        return ', '.join(f"{r.image.url} {r.width}w" for r in entries)
+
+    def _url(self, kind):
+        rendition = self._renditions.get((kind, ImageRendition.FORMAT_JPEG))
+        return rendition.image.url if rendition else ''
+
+    @property
+    def srcset(self):
+        return self._srcset(ImageRendition.FORMAT_JPEG)
+
+    @property
+    def webp_srcset(self):
+        return self._srcset(ImageRendition.FORMAT_WEBP)
+
+    @property
+    def thumbnail_url(self):
+        return self._url(ImageRendition.KIND_THUMBNAIL)
+
+    @property
+    def card_url(self):
+        return self._url(ImageRendition.KIND_CARD)
+
+    @property
+    def full_url(self):
+        return self._url(ImageRendition.KIND_FULL)
+
+
+def _current_renditions(metric):
+    """Return renditions built from the metric's current photo, keyed by (kind, format)."""
+    return {
+        (r.kind, r.format): r
+        for r in metric.renditions.all()
+        if r.source_name == metric.image.name
+    }
+
+
+def build_renditions(metric, existing=None):
+    """
+    Create any missing or stale renditions for a metric's photo.
+    Returns a dict of renditions keyed by (kind, format).
+    """
+    if existing is None:
+        existing = _current_renditions(metric)
+
+    missing = [key for key in rendition_keys() if key not in existing]
+    if not missing:
+        return existing
+
+    renditions = dict(existing)
+
+    with metric.image.open('rb') as source_file:
+        img = decode_source(source_file)
+    for kind, fmt, content, size in render_renditions(img, missing):
+        renditions[(kind, fmt)] = _store_rendition(metric, kind, fmt, content, size)
+
+    return renditions
+
+
+def decode_source(source_file):
+    """Decode a photo just large enough for the largest rendition."""
+    largest = max(RENDITION_SIZES.values())
+    return decode_scaled(source_file, (largest, largest))
+
+
+def render_renditions(img, wanted):
+    """
+    Yield (kind, format, ContentFile, size) for each wanted (kind, format)
+    pair. img is downsized in place, so pass a copy if it is needed after.
+    """
+    # Sizes are visited largest first so each step downsamples the previous result
+    for kind, max_size in RENDITION_SIZES.items():
+        img.thumbnail((max_size, max_size), Image.Resampling.LANCZOS)
+        for fmt in rendition_formats():
+            if (kind, fmt) not in wanted:
+                continue
+            pil_format, extension, save_options = FORMAT_OPTIONS[fmt]
+            output = BytesIO()
+            img.save(output, format=pil_format, **save_options)
+            yield kind, fmt, ContentFile(output.getvalue(), name=f"{kind}.{extension}"), img.size
+
+
+def _store_rendition(metric, kind, fmt, content, size):
+    rendition = ImageRendition.objects.on_shard_of(metric.pk).filter(metric=metric, kind=kind, format=fmt).first()
+    if rendition is None:
+        rendition = ImageRendition(metric=metric, kind=kind, format=fmt)
+
+    # Files are shared by identical renditions; replaced ones are left to the photo collector
+    rendition.image = store_photo(content, photo_directory(rendition.image.field))
+    rendition.width, rendition.height = size
+    rendition.source_name = metric.image.name
+    try:
+        rendition.save()
+    except IntegrityError:
+        # Another request built the same rendition concurrently; keep theirs
+        return ImageRendition.objects.on_shard_of(metric.pk).get(metric=metric, kind=kind, format=fmt)
+    return rendition
+
+
+def attach_renditions(metrics):
+    """
+    Attach a ``responsive`` RenditionSet to each metric with a ready photo,
+    building missing renditions on demand. Metrics should be fetched with
+    ``prefetch_related('renditions')`` to avoid a query per photo.
+    """
+    metrics = list(metrics)
+    for metric in metrics:
+        metric.responsive = None
+        if not metric.image_ready:
+            continue
+        try:
+            metric.responsive = RenditionSet(build_renditions(metric, _current_renditions(metric)))
+        except (OSError, ValueError):
+            logger.exception('Failed to build renditions for metric %s', metric.pk)
+    return metrics
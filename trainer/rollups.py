@@ -0,0 +1,245 @@
+"""
+Weekly and monthly rollups of UserHealthMetrics.
+
+New rows are folded into their week and month buckets with a single UPDATE
+each; a bucket that does not exist yet is computed from the source rows, so
+it also counts rows written before it. Updates and deletes recompute only
+the affected buckets from the source rows, since a minimum or maximum cannot
+be subtracted back out.
+Bulk paths that bypass signals should call ``rebuild_rollups`` for the
+users they touched. Rollups live on the same shard as the user's metrics.
+"""
+import calendar
+from datetime import timedelta
+
+from django.db import transaction
+from django.db.models import Count, DecimalField, F, IntegerField, Max, Min, Sum, Value
+from django.db.models.functions import Greatest, Least, TruncMonth, TruncWeek
+
+from .db_retry import retry_on_lock
+from .models import HealthMetricsRollup, UserHealthMetrics
+from .sharding import each_shard, fan_out, group_by_shard, shard_for_pk, shard_for_user
+
+PERIODS = [HealthMetricsRollup.PERIOD_WEEK, HealthMetricsRollup.PERIOD_MONTH]
+MEASUREMENTS = ['weight', 'thigh_length', 'hip_length']
+
+# Fields whose change affects a rollup
+ROLLUP_SOURCE_FIELDS = MEASUREMENTS + ['recorded_date', 'wakeup_datetime', 'sleeping_datetime']
+
+TRUNC_FUNCTIONS = {
+    HealthMetricsRollup.PERIOD_WEEK: TruncWeek,
+    HealthMetricsRollup.PERIOD_MONTH: TruncMonth,
+}
+
+REBUILD_BATCH_SIZE = 500
+
+
+def period_bounds(period, day):
+    """Return the first and last date of the week (Monday-based) or month containing day."""
+    if period == HealthMetricsRollup.PERIOD_WEEK:
+        start = day - timedelta(days=day.weekday())
+        return start, start + timedelta(days=6)
+    start = day.replace(day=1)
+    return start, day.replace(day=calendar.monthrange(day.year, day.month)[1])
+
+
+def _aggregates():
+    """Aggregate expressions producing every rollup column from UserHealthMetrics rows."""
+    aggregates = {'count': Count('id')}
+    for name in MEASUREMENTS:
+        aggregates[f'{name}_sum'] = Sum(name, output_field=DecimalField(max_digits=12, decimal_places=2))
+        aggregates[f'{name}_min'] = Min(name)
+        aggregates[f'{name}_max'] = Max(name)
+    aggregates['sleep_seconds_sum'] = Sum('sleep_duration_seconds')
+    aggregates['sleep_seconds_min'] = Min('sleep_duration_seconds')
+    aggregates['sleep_seconds_max'] = Max('sleep_duration_seconds')
+    return aggregates
+
+
+def _rollup_values(row):
+    """Convert one aggregate result into HealthMetricsRollup field values."""
+    values = {'count': row['count']}
+    for name in MEASUREMENTS:
+        values[f'{name}_sum'] = row[f'{name}_sum'] or 0
+        values[f'{name}_min'] = row[f'{name}_min']
+        values[f'{name}_max'] = row[f'{name}_max']
+    values['sleep_seconds_sum'] = row['sleep_seconds_sum'] or 0
+    values['sleep_seconds_min'] = row['sleep_seconds_min']
+    values['sleep_seconds_max'] = row['sleep_seconds_max']
+    return values
+
+
+def add_to_rollups(metric):
+    """Fold a newly created row into its week and month rollups."""
+    sleep_seconds = metric.sleep_duration_seconds
+    changes = {'count': F('count') + 1}
+    for name in MEASUREMENTS:
+        value = Value(getattr(metric, name), output_field=DecimalField(max_digits=5, decimal_places=2))
+        changes[f'{name}_sum'] = F(f'{name}_sum') + value
+        changes[f'{name}_min'] = Least(f'{name}_min', value)
+        changes[f'{name}_max'] = Greatest(f'{name}_max', value)
+    if sleep_seconds is not None:
+        value = Value(sleep_seconds, output_field=IntegerField())
+        changes['sleep_seconds_sum'] = F('sleep_seconds_sum') + value
+        changes['sleep_seconds_min'] = Least('sleep_seconds_min', value)
+        changes['sleep_seconds_max'] = Greatest('sleep_seconds_max', value)
+
+    shard = shard_for_pk(metric.pk)
+    rollups = HealthMetricsRollup.objects.on_shard(shard).filter(user_id=metric.user_id)
+    for period in PERIODS:
+        start, _ = period_bounds(period, metric.recorded_date)
+        if not rollups.filter(period=period, period_start=start).update(**changes):
+            # Not necessarily the first row of the period: count the others too
+            recompute_rollup(metric.user_id, period, start, shard)
+
+
+def recompute_rollup(user_id, period, start, shard=None):
+    """Recompute one bucket (on the user's shard) from its source rows, deleting it when it is empty."""
+    first, last = period_bounds(period, start)
+    row = UserHealthMetrics.objects.on_shard(shard).filter(
+        user_id=user_id, recorded_date__range=(first, last)
+    ).aggregate(**_aggregates())
+
+    rollups = HealthMetricsRollup.objects.on_shard(shard)
+    if not row['count']:
+        rollups.filter(user_id=user_id, period=period, period_start=first).delete()
+        return
+    rollups.update_or_create(
+        user_id=user_id, period=period, period_start=first, defaults=_rollup_values(row)
+    )
+
+
+def recompute_rollups_for_dates(user_id, dates):
+    """Recompute the week and month buckets containing any of the given dates."""
+    buckets = {
+        (period, period_bounds(period, day)[0])
+        for day in dates if day is not None
+        for period in PERIODS
+    }
+    shard = shard_for_user(user_id)
+    for period, start in sorted(buckets):
+        recompute_rollup(user_id, period, start, shard)
+
+
+def _computed_rollups(metrics, rollup_model, user_ids):
+    for period in PERIODS:
+        rows = (
+            metrics.filter(user_id__in=user_ids)
+            .annotate(bucket=TRUNC_FUNCTIONS[period]('recorded_date'))
+            .values('user_id', 'bucket')
+            .annotate(**_aggregates())
+            .order_by()
+        )
+        for row in rows.iterator():
+            yield rollup_model(
+                user_id=row['user_id'], period=period, period_start=row['bucket'], **_rollup_values(row)
+            )
+
+
+def expected_rollups(user_ids, shard=None):
+    """Yield freshly computed rollups for the given users of a shard, straight from UserHealthMetrics."""
+    return _computed_rollups(UserHealthMetrics.objects.on_shard(shard), HealthMetricsRollup, user_ids)
+
+
+def replace_rollups(metrics, rollups, user_ids):
+    """
+    Replace the rollups of user_ids in the rollups queryset with ones computed
+    from the metrics queryset, and return how many were written. Takes
+    querysets so data migrations can pass their historical models.
+    """
+    rollups.filter(user_id__in=user_ids).delete()
+    return len(rollups.bulk_create(_computed_rollups(metrics, rollups.model, user_ids), batch_size=1000))
+
+
+def _user_id_batches(user_ids=None, shard=None):
+    if user_ids is None:
+        user_ids = (
+            UserHealthMetrics.objects.on_shard(shard)
+            .values_list('user_id', flat=True).distinct().order_by('user_id')
+        )
+    batch = []
+    for user_id in user_ids:
+        batch.append(user_id)
+        if len(batch) >= REBUILD_BATCH_SIZE:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+
+def _rebuild_shard(shard, user_ids=None):
+    written = 0
+    if user_ids is None:
+        # Users without any metrics left should not keep stale rollups
+        HealthMetricsRollup.objects.on_shard(shard).exclude(
+            user_id__in=UserHealthMetrics.objects.on_shard(shard).values('user_id')
+        ).delete()
+    for batch in _user_id_batches(user_ids, shard):
+        written += _rebuild_batch(batch, shard)
+    return written
+
+
+@retry_on_lock
+def _rebuild_batch(user_ids, shard):
+    with transaction.atomic(using=shard):
+        return replace_rollups(
+            UserHealthMetrics.objects.on_shard(shard), HealthMetricsRollup.objects.on_shard(shard), user_ids
+        )
+
+
+def _shard_batches(user_ids):
+    """(shard, user ids) pairs covering the given users, or every user of every shard."""
+    if user_ids is None:
+        return [(shard, None) for shard in each_shard()]
+    return group_by_shard(user_ids).items()
+
+
+def rebuild_rollups(user_ids=None):
+    """
+    Replace the rollups of the given users (all users by default) with values
+    computed from UserHealthMetrics. Returns the number of rollups written.
+    A full rebuild runs on every shard in parallel.
+    """
+    if user_ids is None:
+        return sum(fan_out(_rebuild_shard))
+    return sum(_rebuild_shard(shard, ids) for shard, ids in _shard_batches(user_ids))
+
+
+ROLLUP_COMPARE_FIELDS = ['count'] + [
+    f'{name}_{suffix}'
+    for name in MEASUREMENTS + ['sleep_seconds']
+    for suffix in ('sum', 'min', 'max')
+]
+
+
+def find_rollup_drift(user_ids=None):
+    """
+    Compare stored rollups with freshly computed ones.
+    Yields (user_id, period, period_start, differences) for every mismatch,
+    where differences maps a field name to (stored, expected).
+    """
+    for shard, ids in _shard_batches(user_ids):
+        yield from _shard_drift(shard, ids)
+
+
+def _shard_drift(shard, user_ids):
+    for batch in _user_id_batches(user_ids, shard):
+        stored = {
+            (r.user_id, r.period, r.period_start): r
+            for r in HealthMetricsRollup.objects.on_shard(shard).filter(user_id__in=batch)
+        }
+        for expected in expected_rollups(batch, shard):
+            key = (expected.user_id, expected.period, expected.period_start)
+            actual = stored.pop(key, None)
+            if actual is None:
+                yield key + ({'missing': (None, expected.count)},)
+                continue
+            differences = {
+                field: (getattr(actual, field), getattr(expected, field))
+                for field in ROLLUP_COMPARE_FIELDS
+                if getattr(actual, field) != getattr(expected, field)
+            }
+            if differences:
+                yield key + (differences,)
+        for key, actual in stored.items():
+            yield key + ({'orphaned': (actual.count, None)},)
@@ -0,0 +1,91 @@
+"""
+Columnar time series of a member's health metrics for the dashboard charts.
+
+Rows are read with ``values_list`` and returned as one array per metric.
+Long ranges are downsampled to weekly or monthly averages read from the
+HealthMetricsRollup table.
+"""
+from .models import HealthMetricsRollup, UserHealthMetrics
+from .rollups import period_bounds
+
+RESOLUTION_DAY = 'day'
+RESOLUTION_WEEK = 'week'
+RESOLUTION_MONTH = 'month'
+RESOLUTION_AUTO = 'auto'
+RESOLUTIONS = [RESOLUTION_DAY, RESOLUTION_WEEK, RESOLUTION_MONTH, RESOLUTION_AUTO]
+
+# Ranges longer than this many days are downsampled when resolution is 'auto'
+AUTO_WEEK_AFTER_DAYS = 180
+AUTO_MONTH_AFTER_DAYS = 730
+
+# Longest window the days parameter may ask for (about ten years)
+MAX_DAYS = 3660
+
+
+def resolve_resolution(resolution, start_date, end_date):
+    """Pick a concrete resolution, downsampling long ranges when 'auto' is requested."""
+    if resolution != RESOLUTION_AUTO:
+        return resolution
+    days = (end_date - start_date).days
+    if days > AUTO_MONTH_AFTER_DAYS:
+        return RESOLUTION_MONTH
+    if days > AUTO_WEEK_AFTER_DAYS:
+        return RESOLUTION_WEEK
+    return RESOLUTION_DAY
+
+
+def _number(value, digits=2):
+    return None if value is None else round(float(value), digits)
+
+
+def _hours(seconds):
+    return None if seconds is None else round(seconds / 3600, 2)
+
+
+def metric_series(user, start_date, end_date, resolution=RESOLUTION_AUTO):
+    """
+    Return the user's metrics between start_date and end_date (inclusive) as
+    a dict of parallel arrays: dates, weight, sleep_hours, hip_length and
+    thigh_length.
+    """
+    resolution = resolve_resolution(resolution, start_date, end_date)
+    series = {
+        'resolution': resolution,
+        'start': start_date.isoformat(),
+        'end': end_date.isoformat(),
+        'dates': [],
+        'weight': [],
+        'sleep_hours': [],
+        'hip_length': [],
+        'thigh_length': [],
+    }
+
+    if resolution == RESOLUTION_DAY:
+        rows = UserHealthMetrics.objects.for_user(user).filter(
+            recorded_date__range=(start_date, end_date),
+        ).order_by('recorded_date').values_list(
+            'recorded_date', 'weight', 'sleep_duration_seconds', 'hip_length', 'thigh_length'
+        )
+        for day, weight, sleep, hip, thigh in rows:
+            series['dates'].append(day.isoformat())
+            series['weight'].append(_number(weight))
+            series['sleep_hours'].append(_hours(sleep))
+            series['hip_length'].append(_number(hip))
+            series['thigh_length'].append(_number(thigh))
+        return series
+
+    # Weekly and monthly points come from the precomputed rollups; the first
+    # and last period cover whole weeks/months around the requested range
+    rows = HealthMetricsRollup.objects.for_user(user).filter(
+        period=resolution,
+        period_start__range=(period_bounds(resolution, start_date)[0], end_date),
+    ).order_by('period_start').values_list(
+        'period_start', 'count', 'weight_sum', 'sleep_seconds_sum', 'hip_length_sum', 'thigh_length_sum'
+    )
+    for period_start, count, weight_sum, sleep_sum, hip_sum, thigh_sum in rows:
+        series['dates'].append(period_start.isoformat())
+        series['weight'].append(_number(weight_sum / count))
+        series['sleep_hours'].append(round(sleep_sum / count / 3600, 2))
+        series['hip_length'].append(_number(hip_sum / count))
+        series['thigh_length'].append(_number(thigh_sum / count))
+    return series
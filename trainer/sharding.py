@@ -0,0 +1,405 @@
+"""
+Sharding of the per-user metrics tables across several databases.
+
+With ``TRAINER_METRICS_SHARDS`` set to a list of DATABASES aliases, every
+member's UserHealthMetrics rows, their renditions and their rollups live on
+one of those databases; user accounts and everything else stay on
+``default``.
+
+- Placement: a UserShard row on ``default`` names the user's shard. New users
+  are spread by id when they are created. Users without a row (everyone who
+  existed before sharding was turned on) live on the first shard, which must
+  therefore be the database that held the metrics until then.
+- Routing: ``for_user()``, ``on_shard_of()`` and ``on_shard()`` on the
+  managers of the sharded models pick the shard of a query, and ShardRouter
+  routes saved, deleted and related instances the same way. Sharded tables
+  cannot be joined with auth_user.
+- Ids: each shard hands out primary keys from its own range of ID_RANGE ids
+  (seeded after ``migrate``), so ids stay unique across shards and an id
+  alone tells which shard holds the row.
+- Queries over many users run once per shard with fan_out(), in parallel.
+- Moves: move_user() marks the user as moving while it copies their rows.
+  New rows for the user (routed with ``shard_for_write()``) wait until the
+  move is over and then go to the new shard; saving a row loaded before the
+  move fails with MoveInProgress. Bulk tools (import_health_metrics,
+  populate_health_data) do not wait and should not run alongside a
+  rebalance.
+
+Without shards configured the helpers leave routing to the next router.
+"""
+import time
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+
+from django.conf import settings
+from django.contrib.auth.models import User
+from django.db import DEFAULT_DB_ALIAS, connections, transaction
+from django.utils import timezone
+
+# Ids handed out by one shard
+ID_RANGE = 10 ** 12
+
+SHARDED_MODELS = {'userhealthmetrics', 'imagerendition', 'healthmetricsrollup'}
+
+# How long a write waits for a move of its user to finish, and how often it looks
+MOVE_WAIT_SECONDS = 30
+MOVE_POLL_SECONDS = 0.1
+
+# Copies move_user() makes before giving up on a user whose rows keep changing
+MOVE_ATTEMPTS = 3
+
+
+class MoveInProgress(Exception):
+    """A write for a user that is being (or has just been) moved to another shard."""
+
+
+def metric_shards():
+    return list(getattr(settings, 'TRAINER_METRICS_SHARDS', []))
+
+
+def each_shard():
+    """The aliases a query over every user has to run on: the shards, or [None] (normal routing)."""
+    return metric_shards() or [None]
+
+
+def is_sharded(model):
+    """Whether model (a class or instance) is one of the tables sharded by user."""
+    return model._meta.app_label == 'trainer' and model._meta.model_name in SHARDED_MODELS
+
+
+def initial_shard(user_id):
+    """Shard of a new user."""
+    shards = metric_shards()
+    return shards[user_id % len(shards)]
+
+
+def place_new_users(user_ids):
+    """Spread users created just now over the shards (no-op without sharding)."""
+    from .models import UserShard
+
+    if metric_shards():
+        UserShard.objects.bulk_create(
+            [UserShard(user_id=user_id, shard=initial_shard(user_id)) for user_id in user_ids],
+            ignore_conflicts=True,
+        )
+
+
+def _placement(user_id):
+    from .models import UserShard
+
+    shard = UserShard.objects.filter(user_id=user_id).values_list('shard', flat=True).first()
+    return shard or metric_shards()[0]
+
+
+def shard_for_user(user):
+    """Alias of the shard holding the metrics of user (an instance or id), or None without sharding."""
+    if not metric_shards():
+        return None
+    if not hasattr(user, 'pk'):
+        return _placement(user)
+    # Looked up once per instance, e.g. once per request for request.user
+    shard = getattr(user, '_trainer_metrics_shard', None)
+    if shard is None:
+        shard = user._trainer_metrics_shard = _placement(user.pk)
+    return shard
+
+
+def shard_for_write(user):
+    """
+    Alias of the shard new metrics of user (an instance or id) are written to,
+    or None without sharding. Waits while the user is being moved, and reads
+    the placement afresh: the user may have moved since it was cached.
+    """
+    from .models import UserShard
+
+    shards = metric_shards()
+    if not shards:
+        return None
+    user_id = getattr(user, 'pk', user)
+    deadline = time.monotonic() + MOVE_WAIT_SECONDS
+    while True:
+        shard, moving = (
+            UserShard.objects.filter(user_id=user_id).values_list('shard', 'moving').first() or (shards[0], False)
+        )
+        if not moving:
+            break
+        if time.monotonic() >= deadline:
+            raise MoveInProgress(f'User {user_id} is being moved to another shard.')
+        time.sleep(MOVE_POLL_SECONDS)
+    if hasattr(user, 'pk'):
+        user._trainer_metrics_shard = shard
+    return shard
+
+
+def shards_for_users(user_ids):
+    """Map each user id to its shard alias (None without sharding) with one query."""
+    from .models import UserShard
+
+    shards = metric_shards()
+    user_ids = list(user_ids)
+    if not shards:
+        return dict.fromkeys(user_ids)
+    placements = dict(UserShard.objects.filter(user_id__in=user_ids).values_list('user_id', 'shard'))
+    return {user_id: placements.get(user_id, shards[0]) for user_id in user_ids}
+
+
+def group_by_shard(user_ids):
+    """Return {alias: [user ids]} for the given users."""
+    groups = defaultdict(list)
+    for user_id, alias in shards_for_users(user_ids).items():
+        groups[alias].append(user_id)
+    return dict(groups)
+
+
+def shard_for_pk(pk):
+    """Alias of the shard whose id range contains pk, or None without sharding."""
+    shards = metric_shards()
+    if not shards:
+        return None
+    index = int(pk) // ID_RANGE
+    if index >= len(shards):
+        raise ValueError(f'Id {pk} is outside every shard range.')
+    return shards[index]
+
+
+class ShardRouter:
+    """Route instances of the sharded models to their shard; anything else goes to the next router."""
+
+    def _db(self, model, **hints):
+        if model._meta.label_lower == 'trainer.usershard':
+            # Placement must never be read from a lagging replica
+            return DEFAULT_DB_ALIAS
+        if not is_sharded(model) or not metric_shards():
+            return None
+        instance = hints.get('instance')
+        if isinstance(instance, User):
+            # Related managers, e.g. user.health_rollups
+            return shard_for_user(instance)
+        if instance is None or not is_sharded(instance):
+            return None
+        if instance.pk is not None:
+            return shard_for_pk(instance.pk)
+        if getattr(instance, 'user_id', None) is not None:
+            return shard_for_user(instance.user_id)
+        if getattr(instance, 'metric_id', None) is not None:
+            return shard_for_pk(instance.metric_id)
+        return None
+
+    db_for_read = _db
+
+    def db_for_write(self, model, **hints):
+        instance = hints.get('instance')
+        user_id = getattr(instance, 'user_id', None)
+        if not metric_shards() or not is_sharded(model) or isinstance(instance, User) or user_id is None:
+            return self._db(model, **hints)
+        shard = shard_for_write(user_id)
+        if instance.pk is not None and shard_for_pk(instance.pk) != shard:
+            # Its copy on the new shard has another id: saving would recreate the row on the old one
+            raise MoveInProgress(f'User {user_id} has moved to another shard; reload the row.')
+        return shard
+
+    def allow_relation(self, obj1, obj2, **hints):
+        # Sharded rows point at users on the primary
+        if metric_shards() and (is_sharded(obj1) or is_sharded(obj2)):
+            return True
+        return None
+
+
+def _run_in_thread(query, alias):
+    try:
+        return query(alias)
+    finally:
+        # Each thread opened its own connections
+        connections.close_all()
+
+
+def fan_out(query, aliases=None):
+    """
+    Call query(alias) for every shard (each_shard() by default) and return the
+    results in shard order. Shards are queried in parallel threads, unless
+    there is only one or the caller has a transaction open on one of them
+    (another thread could not see its uncommitted writes).
+    """
+    aliases = each_shard() if aliases is None else list(aliases)
+    if len(aliases) < 2 or any(connections[alias or DEFAULT_DB_ALIAS].in_atomic_block for alias in aliases):
+        return [query(alias) for alias in aliases]
+    with ThreadPoolExecutor(max_workers=len(aliases)) as pool:
+        return list(pool.map(partial(_run_in_thread, query), aliases))
+
+
+def seed_id_ranges(alias):
+    """Make the sharded tables on alias hand out ids from its range. Never lowers a sequence."""
+    from .models import HealthMetricsRollup, ImageRendition, UserHealthMetrics
+
+    start = metric_shards().index(alias) * ID_RANGE
+    if not start:
+        return
+    connection = connections[alias]
+    quote = connection.ops.quote_name
+    with connection.cursor() as cursor:
+        for model in (UserHealthMetrics, ImageRendition, HealthMetricsRollup):
+            table = model._meta.db_table
+            if connection.vendor == 'sqlite':
+                cursor.execute('UPDATE sqlite_sequence SET seq = %s WHERE name = %s AND seq < %s', [start, table, start])
+                cursor.execute(
+                    'INSERT INTO sqlite_sequence (name, seq) SELECT %s, %s '
+                    'WHERE NOT EXISTS (SELECT 1 FROM sqlite_sequence WHERE name = %s)',
+                    [table, start, table],
+                )
+            elif connection.vendor == 'postgresql':
+                cursor.execute(
+                    f"SELECT setval(pg_get_serial_sequence(%s, 'id'), "
+                    f"GREATEST(%s, (SELECT COALESCE(MAX(id), 0) FROM {quote(table)})))",
+                    [table, start],
+                )
+            elif connection.vendor == 'mysql':
+                # Ignored by MySQL when lower than the current maximum
+                cursor.execute(f'ALTER TABLE {quote(table)} AUTO_INCREMENT = {start + 1}')
+            else:
+                raise NotImplementedError(f'Cannot seed id ranges on {connection.vendor}.')
+
+
+def delete_user_rows(alias, user_id):
+    """Delete a user's sharded rows on alias without the per-row signal handlers."""
+    from .models import HealthMetricsRollup, ImageRendition, UserHealthMetrics
+
+    connection = connections[alias]
+    quote = connection.ops.quote_name
+    metrics = quote(UserHealthMetrics._meta.db_table)
+    with transaction.atomic(using=alias), connection.cursor() as cursor:
+        cursor.execute(
+            f'DELETE FROM {quote(ImageRendition._meta.db_table)} '
+            f'WHERE {quote("metric_id")} IN (SELECT {quote("id")} FROM {metrics} WHERE {quote("user_id")} = %s)',
+            [user_id],
+        )
+        cursor.execute(f'DELETE FROM {quote(HealthMetricsRollup._meta.db_table)} WHERE {quote("user_id")} = %s', [user_id])
+        cursor.execute(f'DELETE FROM {metrics} WHERE {quote("user_id")} = %s', [user_id])
+
+
+def _copy_user_rows(user_id, source, target):
+    """
+    Copy a user's metrics, renditions and rollups from source to target in one
+    target transaction. Returns {source id: updated_at} of the copied metrics.
+    """
+    from .models import HealthMetricsRollup, ImageRendition, UserHealthMetrics
+
+    metrics = list(UserHealthMetrics.objects.using(source).filter(user_id=user_id).order_by('pk'))
+    renditions = list(ImageRendition.objects.using(source).filter(metric__user_id=user_id))
+    rollups = list(HealthMetricsRollup.objects.using(source).filter(user_id=user_id))
+
+    copied = {metric.pk: metric.updated_at for metric in metrics}
+    created = [row.created_at for row in metrics + renditions]
+    # New ids and cursors: make the pages' conditional GET validators change
+    now = timezone.now()
+    for row in metrics + rollups:
+        row.updated_at = now
+    for row in metrics + renditions + rollups:
+        row.pk = None
+    with transaction.atomic(using=target):
+        UserHealthMetrics.objects.using(target).bulk_create(metrics)
+        new_ids = dict(zip(copied, (metric.pk for metric in metrics)))
+        for rendition in renditions:
+            rendition.metric_id = new_ids[rendition.metric_id]
+        ImageRendition.objects.using(target).bulk_create(renditions)
+        HealthMetricsRollup.objects.using(target).bulk_create(rollups)
+        # bulk_create stamps auto_now_add fields with the current time
+        for row, created_at in zip(metrics + renditions, created):
+            row.created_at = created_at
+        UserHealthMetrics.objects.using(target).bulk_update(metrics, ['created_at'])
+        ImageRendition.objects.using(target).bulk_update(renditions, ['created_at'])
+    return copied
+
+
+def _set_moving(user_id, shard, moving):
+    from .models import UserShard
+
+    with transaction.atomic(using=DEFAULT_DB_ALIAS):
+        UserShard.objects.update_or_create(user_id=user_id, defaults={'shard': shard, 'moving': moving})
+
+
+def move_user(user_id, target):
+    """
+    Move a user's metrics, renditions and rollups to the target shard and
+    point the user at it. Returns the number of metrics moved. Rows get new
+    ids from the target's range; photo files are shared and stay in place.
+
+    The user is marked as moving for the duration, so new writes wait for the
+    move. A write that started before that is caught before the source rows
+    are deleted: they must still be the rows that were copied, or the copy is
+    thrown away and made again.
+    """
+    from .dashboard_cache import invalidate_users
+    from .models import UserHealthMetrics
+
+    if target not in metric_shards():
+        raise ValueError(f'{target!r} is not in TRAINER_METRICS_SHARDS.')
+    source = _placement(user_id)
+    if source == target:
+        return 0
+
+    _set_moving(user_id, source, True)
+    moved_to = source
+    try:
+        for _ in range(MOVE_ATTEMPTS):
+            copied = _copy_user_rows(user_id, source, target)
+            try:
+                with transaction.atomic(using=source):
+                    current = dict(
+                        UserHealthMetrics.objects.using(source).select_for_update()
+                        .filter(user_id=user_id).values_list('pk', 'updated_at')
+                    )
+                    if current != copied:
+                        # Written to since the copy was made
+                        delete_user_rows(target, user_id)
+                        continue
+                    delete_user_rows(source, user_id)
+                    # Inside the source transaction: if the user cannot be repointed, the source rows stay
+                    _set_moving(user_id, target, False)
+                    moved_to = target
+            except Exception:
+                if moved_to == source:
+                    # The user still lives on the source
+                    delete_user_rows(target, user_id)
+                # Otherwise the source could not commit the delete: its rows are left over, not lost
+                raise
+            break
+        else:
+            raise MoveInProgress(f'The metrics of user {user_id} kept changing during the move.')
+    finally:
+        if moved_to == source:
+            _set_moving(user_id, source, False)
+
+    invalidate_users([user_id])
+    return len(copied)
+
+
+def plan_rebalance(loads, tolerance=0.1):
+    """
+    Plan moves that even out the number of metric rows per shard.
+    loads maps each shard alias to {user_id: rows}. Returns a list of
+    (user_id, source, target), moving users from the fullest shard to the
+    emptiest while that brings them closer together, until every shard is
+    within tolerance of the average.
+    """
+    loads = {alias: dict(users) for alias, users in loads.items()}
+    totals = {alias: sum(users.values()) for alias, users in loads.items()}
+    average = sum(totals.values()) / len(totals) if totals else 0
+    moves = []
+    while True:
+        fullest = max(totals, key=totals.get)
+        emptiest = min(totals, key=totals.get)
+        gap = totals[fullest] - totals[emptiest]
+        if totals[fullest] - average <= tolerance * average or not gap:
+            break
+        # The largest user that fits in half the gap narrows it the most
+        candidates = [(rows, user_id) for user_id, rows in loads[fullest].items() if 0 < rows <= gap / 2]
+        if not candidates:
+            break
+        rows, user_id = max(candidates)
+        del loads[fullest][user_id]
+        loads[emptiest][user_id] = rows
+        totals[fullest] -= rows
+        totals[emptiest] += rows
+        moves.append((user_id, fullest, emptiest))
+    return moves
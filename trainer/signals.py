@@ -0,0 +1,83 @@
+from django.contrib.auth.models import User
+from django.db import DEFAULT_DB_ALIAS
+from django.db.models.signals import post_delete, post_migrate, post_save, pre_delete
+from django.dispatch import receiver
+
+from .dashboard_cache import invalidate_trainer_profile, invalidate_users
+from .models import PersonalTrainer, UserHealthMetrics
+from .trainer_search import invalidate_trainer_search
+from .rollups import ROLLUP_SOURCE_FIELDS, add_to_rollups, recompute_rollups_for_dates
+from .sharding import delete_user_rows, metric_shards, place_new_users, seed_id_ranges, shard_for_user
+
+
+@receiver(post_save, sender=UserHealthMetrics)
+def update_rollups_on_save(sender, instance, created, raw=False, **kwargs):
+    """Keep weekly and monthly rollups in step with saved health metrics."""
+    if raw:
+        return
+    if created:
+        add_to_rollups(instance)
+        return
+
+    loaded = getattr(instance, '_loaded_values', None)
+    if loaded is not None and all(
+        field not in loaded or loaded[field] == getattr(instance, field)
+        for field in ROLLUP_SOURCE_FIELDS
+    ):
+        # Only non-aggregated fields (e.g. the photo) changed
+        return
+    previous_date = loaded.get('recorded_date') if loaded else None
+    recompute_rollups_for_dates(instance.user_id, {instance.recorded_date, previous_date})
+
+
+@receiver(post_delete, sender=UserHealthMetrics)
+def update_rollups_on_delete(sender, instance, **kwargs):
+    """Drop a deleted row from its weekly and monthly rollups."""
+    loaded = getattr(instance, '_loaded_values', None) or {}
+    recompute_rollups_for_dates(
+        instance.user_id, {instance.recorded_date, loaded.get('recorded_date')}
+    )
+
+
+@receiver(post_save, sender=UserHealthMetrics)
+@receiver(post_delete, sender=UserHealthMetrics)
+def invalidate_dashboard_on_metrics_change(sender, instance, **kwargs):
+    """Drop the cached dashboard fragments of the metric's owner."""
+    # On the metric's shard, whose transaction holds the write
+    invalidate_users([instance.user_id], using=instance._state.db)
+
+
+@receiver(post_save, sender=PersonalTrainer)
+@receiver(post_delete, sender=PersonalTrainer)
+def invalidate_dashboard_on_trainer_change(sender, instance, **kwargs):
+    """Drop the cached trainer profile of the trainer's user."""
+    invalidate_trainer_profile(instance.user_id, using=instance._state.db)
+
+
+@receiver(post_save, sender=PersonalTrainer)
+@receiver(post_delete, sender=PersonalTrainer)
+def invalidate_trainer_search_on_change(sender, instance, **kwargs):
+    """Make every cached trainer search page stale."""
+    invalidate_trainer_search()
+
+
+@receiver(post_save, sender=User)
+def place_new_user_on_shard(sender, instance, created, raw=False, **kwargs):
+    """Pick the metrics shard of a new user."""
+    if created and not raw:
+        place_new_users([instance.pk])
+
+
+@receiver(pre_delete, sender=User)
+def delete_sharded_metrics(sender, instance, **kwargs):
+    """Delete the user's metrics on another shard; the cascade only reaches default."""
+    shard = shard_for_user(instance)
+    if shard is not None and shard != DEFAULT_DB_ALIAS:
+        delete_user_rows(shard, instance.pk)
+
+
+@receiver(post_migrate)
+def seed_shard_id_ranges(sender, using=DEFAULT_DB_ALIAS, **kwargs):
+    """Start the ids of a freshly migrated shard in its own range."""
+    if sender.label == 'trainer' and using in metric_shards():
+        seed_id_ranges(using)
@@ -1,3 +1,1803 @@
-from django.test import TestCase
+import importlib
+import io
+import json
+import multiprocessing
+import os
+import shutil
+import sqlite3
+import tempfile
+import threading
+import zipfile
+import zlib
+from unittest import mock
 
-# Create your tests here.
+from datetime import date, datetime, timedelta, timezone
+from decimal import Decimal
+
+from asgiref.sync import iscoroutinefunction, sync_to_async
+from django.apps import apps as django_apps
+from django.contrib.auth.models import User
+from django.contrib.sessions.models import Session
+from django.core.cache import cache
+from django.core.files.storage import default_storage
+from django.core.files.uploadedfile import SimpleUploadedFile
+from django.core.management import CommandError, call_command
+from django.db import OperationalError, connection, connections, router, transaction
+from django.http import HttpResponse
+from django.test import Client, RequestFactory, SimpleTestCase, TestCase, TransactionTestCase, override_settings
+from django.test.utils import CaptureQueriesContext
+from django.urls import reverse
+from django.utils import timezone as django_timezone
+from PIL import Image
+
+from .admin import CappedCountPaginator
+from .async_queries import gather_queries
+from .benchmarks import QueryCounter, compare_with_budgets, load_budgets, run_benchmarks, sample_photo, seed_fixture
+from .db_routing import (
+    PIN_COOKIE, ReplicaRoutingMiddleware, copy_sqlite_database, keep_routing, use_primary, use_replicas,
+)
+from .db_retry import FAILURES_METRIC, RETRIES_METRIC, retry_on_lock
+from .dashboard_cache import FRAGMENT_CHARTS, HITS_METRIC, MISSES_METRIC, cache_key
+from .exporters import stream_archive
+from .forms import HealthMetricsForm
+from .image_decode import BYTES_METRIC as DECODE_BYTES_METRIC, ORIENTATION_TAG, ImageTooLarge, decode_scaled
+from .image_processing import process_pending_image
+from .importers import HealthMetricsImporter, iter_rows
+from .metrics_upsert import CREATED, UNCHANGED, UPDATED, upsert_health_metrics
+from .models import HealthMetricsRollup, ImageRendition, PersonalTrainer, StoredPhoto, UserHealthMetrics, UserShard
+from .monitoring import RequestStats, registry
+from .photo_backfill import Checkpoint, backfill_photos, recompress_photo
+from .photo_store import _delete, collect_garbage, walk
+from .renditions import attach_renditions, build_renditions, rendition_keys
+from .rollups import find_rollup_drift
+from .sharding import (
+    ID_RANGE, MoveInProgress, _copy_user_rows, fan_out, initial_shard, move_user, plan_rebalance, seed_id_ranges,
+)
+from .uploads import MAX_PHOTO_BYTES, REJECTIONS_METRIC as UPLOAD_REJECTIONS_METRIC, webp_size
+
+TEST_MEDIA_ROOT = tempfile.mkdtemp()
+
+
+def tearDownModule():
+    shutil.rmtree(TEST_MEDIA_ROOT, ignore_errors=True)
+
+
+def metric_values(user, day=0, **values):
+    """
+    Field values of a UserHealthMetrics row of user on the day-th day of 2025:
+    an 8 hour night and fixed measurements, unless values say otherwise.
+    """
+    return {
+        'user': user,
+        'recorded_date': date(2025, 1, 1) + timedelta(days=day),
+        'sleeping_datetime': datetime(2025, 1, 1, 23, 0, tzinfo=timezone.utc),
+        'wakeup_datetime': datetime(2025, 1, 2, 7, 0, tzinfo=timezone.utc),
+        'weight': '70.00',
+        'thigh_length': '55.00',
+        'hip_length': '95.00',
+        **values,
+    }
+
+
+def create_metric(user, day=0, **values):
+    """Save a UserHealthMetrics row built from metric_values()."""
+    return UserHealthMetrics.objects.create(**metric_values(user, day, **values))
+
+
+@override_settings(MEDIA_ROOT=TEST_MEDIA_ROOT, TRAINER_ASYNC_IMAGE_PROCESSING=True)
+class BackgroundImageProcessingTests(TestCase):
+    def setUp(self):
+        self.user = User.objects.create_user('member')
+
+    def add_photo(self, content, day=0):
+        return create_metric(
+            self.user, day, image=SimpleUploadedFile('progress.jpg', content, content_type='image/jpeg')
+        )
+
+    def test_pending_photo_is_compressed_and_becomes_ready(self):
+        with mock.patch('trainer.image_processing.get_executor') as get_executor:
+            with self.captureOnCommitCallbacks(execute=True):
+                metric = self.add_photo(sample_photo((1200, 1600)).read())
+        # Queued for a worker once the transaction commits, stored raw meanwhile
+        get_executor.return_value.submit.assert_called_once_with(mock.ANY, metric.pk)
+        self.assertEqual(metric.image_status, UserHealthMetrics.IMAGE_STATUS_PENDING)
+        raw_name = metric.image.name
+        self.assertTrue(default_storage.exists(raw_name))
+
+        self.assertTrue(process_pending_image(metric.pk))
+        metric.refresh_from_db()
+        self.assertEqual(metric.image_status, UserHealthMetrics.IMAGE_STATUS_READY)
+        self.assertRegex(metric.image.name, r'^health_metrics/[0-9a-f]{2}/[0-9a-f]{64}\.jpg$')
+        self.assertFalse(default_storage.exists(raw_name))
+        with Image.open(metric.image) as img:
+            self.assertEqual(img.size, (600, 800))
+        self.assertEqual(ImageRendition.objects.filter(metric=metric).count(), len(rendition_keys()))
+
+        # Nothing left to do for a ready photo
+        self.assertFalse(process_pending_image(metric.pk))
+
+    def test_unreadable_photo_is_marked_failed(self):
+        broken = self.add_photo(b'not a photo')
+        pending = self.add_photo(sample_photo((400, 300)).read(), day=1)
+        with self.assertLogs('trainer.image_processing', 'ERROR'):
+            self.assertFalse(process_pending_image(broken.pk))
+        broken.refresh_from_db()
+        self.assertEqual(broken.image_status, UserHealthMetrics.IMAGE_STATUS_FAILED)
+
+        # The command picks up photos left pending, and failed ones only when asked to
+        out = io.StringIO()
+        call_command('process_pending_images', stdout=out)
+        self.assertIn('Processed 1 photos (0 skipped or failed)', out.getvalue())
+        self.assertEqual(
+            UserHealthMetrics.objects.get(pk=pending.pk).image_status, UserHealthMetrics.IMAGE_STATUS_READY
+        )
+        with self.assertLogs('trainer.image_processing', 'ERROR'):
+            call_command('process_pending_images', '--include-failed', stdout=out)
+        self.assertIn('Processed 0 photos (1 skipped or failed)', out.getvalue())
+
+
+@override_settings(MEDIA_ROOT=TEST_MEDIA_ROOT, TRAINER_ASYNC_IMAGE_PROCESSING=False)
+class RenditionTests(TestCase):
+    def setUp(self):
+        self.metric = create_metric(User.objects.create_user('member'), image=sample_photo((1200, 1600)))
+
+    def test_every_size_and_format_is_built_once_per_photo(self):
+        renditions = build_renditions(self.metric)
+        self.assertEqual(set(renditions), set(rendition_keys()))
+        sizes = {kind: (rendition.width, rendition.height) for (kind, _), rendition in renditions.items()}
+        self.assertEqual(sizes, {
+            ImageRendition.KIND_FULL: (600, 800),
+            ImageRendition.KIND_CARD: (300, 400),
+            ImageRendition.KIND_THUMBNAIL: (120, 160),
+        })
+        for rendition in renditions.values():
+            with Image.open(rendition.image) as img:
+                self.assertEqual(img.size, (rendition.width, rendition.height))
+
+        ids = set(ImageRendition.objects.values_list('pk', flat=True))
+        build_renditions(UserHealthMetrics.objects.get(pk=self.metric.pk))
+        self.assertEqual(set(ImageRendition.objects.values_list('pk', flat=True)), ids)
+
+        # A new photo replaces its renditions in place
+        self.metric.image = sample_photo((1600, 1200))
+        self.metric.save()
+        renditions = build_renditions(self.metric)
+        self.assertEqual(set(ImageRendition.objects.values_list('pk', flat=True)), ids)
+        full = renditions[(ImageRendition.KIND_FULL, ImageRendition.FORMAT_JPEG)]
+        self.assertEqual((full.width, full.height, full.source_name), (800, 600, self.metric.image.name))
+
+    def test_ready_photos_get_srcsets(self):
+        pending = create_metric(self.metric.user, day=1)
+        UserHealthMetrics.objects.filter(pk=pending.pk).update(
+            image='health_metrics/raw.jpg', image_status=UserHealthMetrics.IMAGE_STATUS_PENDING
+        )
+        metric, pending = attach_renditions(UserHealthMetrics.objects.prefetch_related('renditions').order_by('pk'))
+        self.assertIn(' 600w', metric.responsive.srcset)
+        self.assertIn(' 120w', metric.responsive.srcset)
+        self.assertTrue(metric.responsive.thumbnail_url.startswith('/media/health_metrics/renditions/'))
+        self.assertIsNone(pending.responsive)
+
+        # Built on the first display, then read from the prefetched rows
+        with self.assertNumQueries(2):
+            attach_renditions(UserHealthMetrics.objects.prefetch_related('renditions'))
+
+
+class MetricsSeriesTests(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.member = User.objects.create_user('member', password='pw')
+        cls.staff = User.objects.create_user('staff', password='pw', is_staff=True)
+        for day, weight in enumerate(['70.00', '71.00', '72.00']):
+            create_metric(cls.member, day, weight=weight)
+
+    def get(self, user=None, **params):
+        self.client.force_login(user or self.member)
+        return self.client.get(reverse('trainer:metrics_series'), params)
+
+    def test_daily_points_end_at_the_last_day_of_data(self):
+        series = self.get(days='2').json()
+        self.assertEqual(series['resolution'], 'day')
+        self.assertEqual((series['start'], series['end']), ('2025-01-02', '2025-01-03'))
+        self.assertEqual(series['dates'], ['2025-01-02', '2025-01-03'])
+        self.assertEqual(series['weight'], [71.0, 72.0])
+        self.assertEqual(series['sleep_hours'], [8.0, 8.0])
+        self.assertEqual(self.get(days='all').json()['dates'], ['2025-01-01', '2025-01-02', '2025-01-03'])
+
+    def test_long_ranges_are_averaged_from_the_rollups(self):
+        series = self.get(start='2023-01-01', end='2025-06-30').json()
+        self.assertEqual(series['resolution'], 'month')
+        self.assertEqual(series['dates'], ['2025-01-01'])
+        self.assertEqual(series['weight'], [71.0])
+        self.assertEqual(self.get(start='2025-01-01', end='2025-01-31', resolution='week').json()['dates'], [
+            '2024-12-30',
+        ])
+
+    def test_only_admins_see_other_users(self):
+        self.assertEqual(len(self.get(self.staff, user_id=self.member.pk).json()['dates']), 3)
+        self.assertEqual(self.get(self.staff).json()['dates'], [])
+        other = User.objects.create_user('other')
+        self.assertEqual(len(self.get(other, user_id=self.member.pk).json()['dates']), 0)
+
+    def test_invalid_queries_are_rejected(self):
+        cases = [
+            (self.member, {'resolution': 'year'}, 'Invalid resolution. Use one of: day, week, month, auto.'),
+            (self.member, {'start': '2025-13-01'}, 'Invalid date range.'),
+            (self.member, {'days': 'many'}, 'Invalid date range.'),
+            (self.member, {'days': '0'}, 'days must be between 1 and 3660, or all.'),
+            (self.member, {'days': '100000000'}, 'days must be between 1 and 3660, or all.'),
+            (self.member, {'start': '2025-02-01', 'end': '2025-01-01'}, 'start must not be after end.'),
+            (self.staff, {'user_id': 'abc'}, 'Invalid user.'),
+        ]
+        for user, params, error in cases:
+            with self.subTest(params=params):
+                response = self.get(user, **params)
+                self.assertEqual(response.status_code, 400)
+                self.assertEqual(response.json(), {'error': error})
+
+
+class RollupTests(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.member = User.objects.create_user('member')
+
+    def rollups(self):
+        rows = HealthMetricsRollup.objects.filter(user=self.member).values_list(
+            'period', 'period_start', 'count', 'weight_sum', 'weight_min', 'weight_max'
+        )
+        return {(period, start): tuple(values) for period, start, *values in rows}
+
+    def test_rollups_follow_creates_updates_and_deletes(self):
+        first = create_metric(self.member, recorded_date=date(2025, 1, 6), weight='70.00')
+        second = create_metric(self.member, recorded_date=date(2025, 1, 8), weight='74.00')
+        create_metric(self.member, recorded_date=date(2025, 2, 3), weight='80.00')
+        self.assertEqual(self.rollups(), {
+            ('week', date(2025, 1, 6)): (2, Decimal('144.00'), Decimal('70.00'), Decimal('74.00')),
+            ('week', date(2025, 2, 3)): (1, Decimal('80.00'), Decimal('80.00'), Decimal('80.00')),
+            ('month', date(2025, 1, 1)): (2, Decimal('144.00'), Decimal('70.00'), Decimal('74.00')),
+            ('month', date(2025, 2, 1)): (1, Decimal('80.00'), Decimal('80.00'), Decimal('80.00')),
+        })
+        rollup = HealthMetricsRollup.objects.get(user=self.member, period='week', period_start=date(2025, 1, 6))
+        self.assertEqual((rollup.sleep_seconds_sum, rollup.sleep_seconds_max), (16 * 3600, 8 * 3600))
+
+        # The maximum goes down with the row that held it
+        second.weight = '72.00'
+        second.save()
+        self.assertEqual(
+            self.rollups()[('week', date(2025, 1, 6))], (2, Decimal('142.00'), Decimal('70.00'), Decimal('72.00'))
+        )
+
+        # Moving a row to another day updates both weeks and both months
+        second.recorded_date = date(2025, 2, 4)
+        second.save()
+        rollups = self.rollups()
+        self.assertEqual(rollups[('week', date(2025, 1, 6))][0], 1)
+        self.assertEqual(rollups[('week', date(2025, 2, 3))][0], 2)
+        self.assertEqual(rollups[('month', date(2025, 1, 1))][0], 1)
+        self.assertEqual(rollups[('month', date(2025, 2, 1))][:2], (2, Decimal('152.00')))
+
+        # The last row of a bucket takes the bucket with it
+        first.delete()
+        self.assertEqual(set(self.rollups()), {('week', date(2025, 2, 3)), ('month', date(2025, 2, 1))})
+        self.assertEqual(list(find_rollup_drift()), [])
+
+    def test_check_reports_drift_until_rebuilt(self):
+        create_metric(self.member, recorded_date=date(2025, 1, 6), weight='70.00')
+        HealthMetricsRollup.objects.filter(period='week').update(count=5, weight_max='99.00')
+        out = io.StringIO()
+        with self.assertRaisesMessage(CommandError, '1 rollups have drifted'):
+            call_command('rebuild_rollups', '--check', stdout=out)
+        self.assertIn(
+            f'User {self.member.pk} week of 2025-01-06: '
+            'count: stored=5 expected=1, weight_max: stored=99.00 expected=70',
+            out.getvalue(),
+        )
+
+        call_command('rebuild_rollups', '--user', str(self.member.pk), stdout=out)
+        call_command('rebuild_rollups', '--check', stdout=out)
+        self.assertIn('Rollups are in sync with health metrics.', out.getvalue())
+
+    def test_first_rollup_of_a_period_counts_the_rows_already_there(self):
+        # Rows saved before the rollups existed
+        create_metric(self.member, recorded_date=date(2025, 1, 6), weight='70.00')
+        create_metric(self.member, recorded_date=date(2025, 1, 7), weight='72.00')
+        HealthMetricsRollup.objects.all().delete()
+
+        create_metric(self.member, recorded_date=date(2025, 1, 20), weight='74.00')
+        rollups = self.rollups()
+        self.assertEqual(
+            rollups[('month', date(2025, 1, 1))], (3, Decimal('216.00'), Decimal('70.00'), Decimal('74.00'))
+        )
+        self.assertEqual(rollups[('week', date(2025, 1, 20))][0], 1)
+        self.assertNotIn(('week', date(2025, 1, 6)), rollups)
+
+    def test_migration_builds_the_missing_rollups(self):
+        create_metric(self.member, recorded_date=date(2025, 1, 6), weight='70.00')
+        create_metric(self.member, recorded_date=date(2025, 2, 3), weight='80.00')
+        HealthMetricsRollup.objects.all().delete()
+
+        backfill = importlib.import_module('trainer.migrations.0018_backfill_health_rollups')
+        with mock.patch.object(backfill, 'REBUILD_BATCH_SIZE', 1):
+            backfill.backfill_rollups(django_apps, mock.Mock(connection=connection))
+        self.assertEqual(len(self.rollups()), 4)
+        self.assertEqual(list(find_rollup_drift()), [])
+
+
+class SleepDurationTests(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.member = User.objects.create_user('member')
+
+    def test_backfill_fills_missing_durations_in_batches(self):
+        nights = [
+            # Across midnight, after midnight, and a wakeup time on the same date (next morning)
+            (datetime(2025, 1, 1, 23, 0, tzinfo=timezone.utc), datetime(2025, 1, 2, 7, 0, tzinfo=timezone.utc)),
+            (datetime(2025, 1, 2, 0, 30, tzinfo=timezone.utc), datetime(2025, 1, 2, 6, 0, tzinfo=timezone.utc)),
+            (datetime(2025, 1, 3, 22, 0, tzinfo=timezone.utc), datetime(2025, 1, 3, 5, 15, tzinfo=timezone.utc)),
+        ]
+        metrics = [
+            create_metric(self.member, day, sleeping_datetime=sleep, wakeup_datetime=wakeup)
+            for day, (sleep, wakeup) in enumerate(nights)
+        ]
+        expected = [8 * 3600, 5 * 3600 + 1800, 7 * 3600 + 900]
+        self.assertEqual([metric.sleep_duration_seconds for metric in metrics], expected)
+        self.assertEqual(metrics[2].sleeped_time_formatted, '7h 15m')
+
+        UserHealthMetrics.objects.update(sleep_duration_seconds=None)
+        backfill = importlib.import_module('trainer.migrations.0011_backfill_sleep_duration_seconds')
+        with mock.patch.object(backfill, 'BATCH_SIZE', 2):
+            backfill.backfill_sleep_duration(django_apps, None)
+        self.assertEqual(
+            list(UserHealthMetrics.objects.order_by('pk').values_list('sleep_duration_seconds', flat=True)), expected
+        )
+
+    def test_changed_times_update_the_stored_duration(self):
+        metric = create_metric(self.member)
+        metric.wakeup_datetime = datetime(2025, 1, 2, 5, 0, tzinfo=timezone.utc)
+        metric.save()
+        self.assertEqual(UserHealthMetrics.objects.get(pk=metric.pk).sleep_duration_seconds, 6 * 3600)
+        self.assertEqual(UserHealthMetrics.objects.filter(sleep_duration_seconds__lt=7 * 3600).count(), 1)
+
+
+class HealthMetricsImportTests(TestCase):
+    HEADER = 'username,date,sleep_time,wakeup_time,weight,thigh_length,hip_length\n'
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.member = User.objects.create_user('member', password='pw')
+        cls.staff = User.objects.create_user('staff', password='pw', is_staff=True)
+
+    def upload(self, content, name='metrics.csv'):
+        self.client.force_login(self.staff)
+        response = self.client.post(
+            reverse('trainer:import_health_metrics'), {'file': SimpleUploadedFile(name, content)}
+        )
+        self.assertEqual(response.status_code, 200)
+        return response.context['result']
+
+    def test_valid_rows_are_imported_and_invalid_ones_rejected(self):
+        result = self.upload((
+            self.HEADER
+            + 'member,2025-01-01,22:30,06:30,70.5,55,95\n'
+            + 'member,2025-01-02,10:30 PM,7:00 AM,heavy,55,95\n'
+            + 'nobody,2025-01-03,22:30,06:30,70,55,95\n'
+        ).encode())
+        self.assertEqual((result.imported, result.rejected), (1, 2))
+        self.assertEqual([line_number for line_number, _ in result.rejects], [3, 4])
+        self.assertIn('weight', result.rejects[0][1])
+        self.assertEqual(result.rejects[1][1], {'username': ['Unknown user "nobody".']})
+
+        metric = UserHealthMetrics.objects.get(user=self.member)
+        self.assertEqual(metric.weight, Decimal('70.50'))
+        self.assertEqual(metric.sleep_duration_seconds, 8 * 3600)
+        self.assertEqual(HealthMetricsRollup.objects.filter(user=self.member).count(), 2)
+
+    def test_existing_days_are_updated_and_repeated_days_count_once(self):
+        def run(*lines):
+            content = '\n'.join(json.dumps(line) for line in lines).encode()
+            rows = iter_rows(io.BytesIO(content), 'ndjson')
+            return HealthMetricsImporter(user=self.member, batch_size=2).run(rows)
+
+        day = {'sleep_time': '22:00', 'wakeup_time': '06:00', 'thigh_length': '55', 'hip_length': '95'}
+        self.assertEqual(run({**day, 'date': '2025-01-01', 'weight': '70'}).imported, 1)
+        result = run(
+            {**day, 'date': '2025-01-01', 'weight': '71'},
+            {**day, 'date': '2025-01-01', 'weight': '72'},
+            {**day, 'date': '2025-01-02', 'weight': '73'},
+            'not an object',
+        )
+        self.assertEqual((result.imported, result.rejected), (2, 1))
+        self.assertEqual(result.rejects, [(4, {'row': ['Malformed row.']})])
+        self.assertEqual(
+            list(UserHealthMetrics.objects.order_by('recorded_date').values_list('weight', flat=True)),
+            [Decimal('72.00'), Decimal('73.00')],
+        )
+
+    def test_files_that_are_not_utf8_are_rejected_from_the_bad_line(self):
+        result = self.upload('username,date\n'.encode('utf-16'))
+        self.assertEqual((result.imported, result.rejected), (0, 1))
+        self.assertEqual(result.rejects, [(1, {'file': ['The file is not UTF-8 text.']})])
+
+        # The rows before the bad line are still imported
+        result = self.upload(
+            (self.HEADER + 'member,2025-01-01,22:30,06:30,70,55,95\n').encode() + b'member,2025-01-02,\xff\n'
+        )
+        self.assertEqual((result.imported, result.rejected), (1, 1))
+        self.assertEqual(result.rejects, [(3, {'file': ['The file is not UTF-8 text.']})])
+
+        result = self.upload((self.HEADER + 'member,' + 'x' * 200000 + '\n').encode())
+        self.assertEqual(result.rejects, [(2, {'file': ['Malformed CSV: field larger than field limit (131072).']})])
+
+
+@override_settings(MEDIA_ROOT=TEST_MEDIA_ROOT)
+class PopulateHealthDataTests(TransactionTestCase):
+    def generate(self, **options):
+        options = {'users': 3, 'days': 4, 'seed': 7, 'photo_ratio': 0.5, **options}
+        # One user per task, so every worker gets some
+        with mock.patch('trainer.management.commands.populate_health_data.USERS_PER_TASK', 1):
+            call_command('populate_health_data', stdout=io.StringIO(), **options)
+        return list(
+            UserHealthMetrics.objects.order_by('user__username', 'recorded_date').values_list(
+                'user__username', 'recorded_date', 'weight', 'sleep_duration_seconds', 'image'
+            )
+        )
+
+    def test_same_seed_gives_the_same_rows_whatever_the_workers(self):
+        serial = self.generate(workers=1)
+        self.assertEqual(len(serial), 12)
+        self.assertTrue(any(row[4] for row in serial))
+
+        UserHealthMetrics.objects.all().delete()
+        self.assertEqual(self.generate(workers=2), serial)
+
+        UserHealthMetrics.objects.all().delete()
+        self.assertNotEqual(self.generate(seed=8), serial)
+
+    def test_workers_set_django_up_under_spawn(self):
+        with mock.patch('trainer.processes.multiprocessing', multiprocessing.get_context('spawn')):
+            rows = self.generate(workers=2)
+        self.assertEqual(len(rows), 12)
+
+    def test_demo_user_keeps_its_name(self):
+        self.generate()
+        user = User.objects.get(username='user1')
+        self.assertEqual((user.first_name, user.last_name), ('John', 'Doe'))
+        self.assertTrue(User.objects.get(username='user2').check_password('123'))
+
+
+@override_settings(MEDIA_ROOT=TEST_MEDIA_ROOT)
+class ViewQueryBudgetTests(TestCase):
+    """The hot views must not issue more queries than benchmark_budgets.json allows."""
+
+    @classmethod
+    def setUpTestData(cls):
+        seed_fixture(users=60, days=30, photo_ratio=0.2)
+
+    def test_views_stay_within_query_budgets(self):
+        budgets = load_budgets()
+        for name, result in run_benchmarks(repeat=1).items():
+            with self.subTest(scenario=name):
+                self.assertLess(result['status'], 400)
+                self.assertLessEqual(result['queries'], budgets[name]['queries'])
+
+
+class CompareWithBudgetsTests(TestCase):
+    def test_reports_query_and_latency_overruns(self):
+        results = {
+            'dashboard': {'queries': 7, 'p50_ms': 10.0},
+            'health_metrics': {'queries': 3, 'p50_ms': 25.0},
+            'trainer_list': {'queries': 1, 'p50_ms': 1.0},
+        }
+        budgets = {
+            'dashboard': {'queries': 6, 'p50_ms': 40},
+            'health_metrics': {'queries': 3, 'p50_ms': 20},
+        }
+        self.assertEqual(
+            compare_with_budgets(results, budgets),
+            (['dashboard: 7 queries (budget 6)'], ['health_metrics: p50 25.0ms (budget 20ms)']),
+        )
+
+
+class RequestMetricsTests(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.member = User.objects.create_user('member', password='pw')
+        cls.staff = User.objects.create_user('staff', password='pw', is_staff=True)
+
+    def setUp(self):
+        registry.reset()
+
+    def test_records_latency_sql_and_template_time_per_view(self):
+        self.client.force_login(self.member)
+        self.client.get(reverse('trainer:health_metrics'))
+        self.client.get(reverse('trainer:health_metrics'))
+
+        stats = registry.snapshot()['trainer:health_metrics']
+        self.assertEqual(stats['count'], 2)
+        self.assertEqual(sum(stats['buckets']), 2)
+        self.assertEqual(stats['statuses'], {('GET', 200): 2})
+        self.assertGreater(stats['sql_queries'], 0)
+        self.assertGreater(stats['template_seconds'], 0)
+
+    def test_exposes_prometheus_text_to_staff(self):
+        self.client.force_login(self.member)
+        self.client.get(reverse('trainer:health_metrics'))
+
+        self.client.force_login(self.staff)
+        response = self.client.get(reverse('trainer:metrics'))
+        self.assertEqual(response.status_code, 200)
+        self.assertTrue(response['Content-Type'].startswith('text/plain; version=0.0.4'))
+        body = response.content.decode()
+        self.assertIn('trainer_request_duration_seconds_bucket{view="trainer:health_metrics",le="+Inf"} 1', body)
+        self.assertIn('trainer_requests_total{view="trainer:health_metrics",method="GET",status="200"} 1', body)
+        self.assertIn('trainer_sql_queries_total{view="trainer:health_metrics"}', body)
+
+    def test_remote_clients_must_be_staff(self):
+        self.client.force_login(self.member)
+        response = self.client.get(reverse('trainer:metrics'), REMOTE_ADDR='203.0.113.5')
+        self.assertEqual(response.status_code, 403)
+
+        self.client.force_login(self.staff)
+        response = self.client.get(reverse('trainer:metrics'), REMOTE_ADDR='203.0.113.5')
+        self.assertEqual(response.status_code, 200)
+
+    def test_scrapers_need_a_token_or_an_allowed_address(self):
+        url = reverse('trainer:metrics')
+        # Not even localhost by default: behind a proxy every request comes from there
+        self.assertEqual(self.client.get(url, REMOTE_ADDR='127.0.0.1').status_code, 403)
+
+        with override_settings(TRAINER_METRICS_TOKEN='s3cret'):
+            self.assertEqual(self.client.get(url, HTTP_AUTHORIZATION='Bearer s3cret').status_code, 200)
+            self.assertEqual(self.client.get(url, HTTP_AUTHORIZATION='Bearer guess').status_code, 403)
+        with override_settings(TRAINER_METRICS_ALLOWED_IPS=['10.0.0.9']):
+            self.assertEqual(self.client.get(url, REMOTE_ADDR='10.0.0.9').status_code, 200)
+            self.assertEqual(self.client.get(url, REMOTE_ADDR='10.0.0.10').status_code, 403)
+
+    def test_request_stats_count_queries_from_several_threads(self):
+        stats = RequestStats()
+
+        def run_queries():
+            for _ in range(1000):
+                stats(lambda *args: None, 'SELECT 1', (), False, {})
+
+        threads = [threading.Thread(target=run_queries) for _ in range(8)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(stats.sql_queries, 8000)
+
+
+class DashboardCacheTests(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.member = User.objects.create_user('member', password='pw')
+        cls.staff = User.objects.create_user('staff', password='pw', is_staff=True)
+        create_metric(cls.member)
+
+    def setUp(self):
+        cache.clear()
+        registry.reset()
+
+    def test_second_load_is_served_from_cache(self):
+        self.client.force_login(self.member)
+        self.client.get(reverse('trainer:dashboard'))
+        with self.assertNumQueries(3):
+            # Session, user and the conditional GET validators only
+            response = self.client.get(reverse('trainer:dashboard'))
+        self.assertContains(response, f'const seriesUserId = "{self.member.pk}"')
+        self.assertEqual(registry.counter_value(HITS_METRIC, entry=FRAGMENT_CHARTS), 1)
+        self.assertEqual(registry.counter_value(MISSES_METRIC, entry=FRAGMENT_CHARTS), 1)
+
+    def test_staff_viewing_a_member_gets_that_members_fragments(self):
+        self.client.force_login(self.staff)
+        own = self.client.get(reverse('trainer:dashboard'))
+        viewed = self.client.get(reverse('trainer:dashboard'), {'user_id': self.member.pk})
+
+        self.assertNotContains(own, 'id="weightChart"')
+        self.assertContains(viewed, f'const seriesUserId = "{self.member.pk}"')
+        self.assertIsNotNone(cache.get(cache_key(FRAGMENT_CHARTS, self.member.pk)))
+        self.assertIsNotNone(cache.get(cache_key(FRAGMENT_CHARTS, self.staff.pk)))
+
+    def test_saving_metrics_invalidates_only_the_owner(self):
+        self.client.force_login(self.member)
+        self.client.get(reverse('trainer:dashboard'))
+        self.client.force_login(self.staff)
+        self.assertNotContains(self.client.get(reverse('trainer:dashboard')), 'id="weightChart"')
+
+        with self.captureOnCommitCallbacks(execute=True):
+            create_metric(self.staff)
+
+        self.assertIsNone(cache.get(cache_key(FRAGMENT_CHARTS, self.staff.pk)))
+        self.assertIsNotNone(cache.get(cache_key(FRAGMENT_CHARTS, self.member.pk)))
+        self.assertContains(self.client.get(reverse('trainer:dashboard')), 'id="weightChart"')
+
+    def test_trainer_change_invalidates_trainer_profile(self):
+        self.client.force_login(self.member)
+        self.assertFalse(self.client.get(reverse('trainer:dashboard')).context['is_trainer'])
+
+        with self.captureOnCommitCallbacks(execute=True):
+            PersonalTrainer.objects.create(
+                user=self.member, specialization='Yoga', experience_years=3, hourly_rate=40, bio='Bio'
+            )
+
+        self.assertTrue(self.client.get(reverse('trainer:dashboard')).context['is_trainer'])
+
+
+class UserSearchTests(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.staff = User.objects.create_user('staff', password='pw', is_staff=True)
+        User.objects.create_user('jsmith', first_name='John', last_name='Smith')
+        User.objects.create_user('jdoe', first_name='Jane', last_name='Doe')
+        User.objects.create_user('mjones', first_name='Mary', last_name='Johnson')
+        User.objects.create_user('jgone', first_name='Jim', is_active=False)
+
+    def search(self, **params):
+        self.client.force_login(self.staff)
+        return self.client.get(reverse('trainer:user_search'), params).json()
+
+    def usernames(self, data):
+        return [result['username'] for result in data['results']]
+
+    def test_matches_prefix_of_username_first_or_last_name(self):
+        self.assertEqual(self.usernames(self.search(q='J')), ['jdoe', 'jsmith', 'mjones'])
+        self.assertEqual(self.usernames(self.search(q='smi')), ['jsmith'])
+        self.assertEqual(self.usernames(self.search(q='mary joh')), ['mjones'])
+        self.assertEqual(self.usernames(self.search(q='ohn')), [])
+
+    def test_paginates_without_counting(self):
+        self.client.force_login(self.staff)
+        with self.assertNumQueries(3):
+            # Session, user and the page itself
+            first = self.client.get(reverse('trainer:user_search'), {'q': 'j', 'page_size': 2}).json()
+        self.assertEqual(self.usernames(first), ['jdoe', 'jsmith'])
+        self.assertTrue(first['has_more'])
+        second = self.search(q='j', page_size=2, page=2)
+        self.assertEqual(self.usernames(second), ['mjones'])
+        self.assertFalse(second['has_more'])
+
+    def test_results_include_full_name(self):
+        self.assertEqual(
+            self.search(q='jsmith')['results'],
+            [{'id': User.objects.get(username='jsmith').pk, 'username': 'jsmith', 'full_name': 'John Smith'}],
+        )
+
+    def test_members_cannot_search(self):
+        self.client.force_login(User.objects.get(username='jdoe'))
+        self.assertEqual(self.client.get(reverse('trainer:user_search'), {'q': 'j'}).status_code, 403)
+
+    def test_admin_dashboard_does_not_list_users(self):
+        self.client.force_login(self.staff)
+        response = self.client.get(reverse('trainer:dashboard'))
+        self.assertContains(response, 'id="user-search"')
+        self.assertNotContains(response, 'jsmith')
+
+
+class HealthMetricsHistoryTests(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.member = User.objects.create_user('member', password='pw')
+        other = User.objects.create_user('other', password='pw')
+        for user, days in [(cls.member, 23), (other, 5)]:
+            for day in range(days):
+                create_metric(user, day)
+
+    def setUp(self):
+        self.client.force_login(self.member)
+
+    def get(self, **params):
+        return self.client.get(reverse('trainer:health_metrics'), params)
+
+    def dates(self, response):
+        return [row['recorded_date'].day for row in response.context['health_metrics']]
+
+    def test_walks_forward_and_back_with_cursors(self):
+        first = self.get(page_size=10)
+        self.assertEqual(self.dates(first), list(range(23, 13, -1)))
+        self.assertFalse(first.context['page'].has_previous)
+
+        second = self.get(page_size=10, after=first.context['page'].next_cursor)
+        self.assertEqual(self.dates(second), list(range(13, 3, -1)))
+
+        last = self.get(page_size=10, after=second.context['page'].next_cursor)
+        self.assertEqual(self.dates(last), [3, 2, 1])
+        self.assertFalse(last.context['page'].has_next)
+
+        back = self.get(page_size=10, before=last.context['page'].previous_cursor)
+        self.assertEqual(self.dates(back), list(range(13, 3, -1)))
+        back = self.get(page_size=10, before=back.context['page'].previous_cursor)
+        self.assertEqual(self.dates(back), list(range(23, 13, -1)))
+        self.assertFalse(back.context['page'].has_previous)
+
+    def test_later_pages_cost_the_same_as_the_first(self):
+        cursor = self.get(page_size=10).context['page'].next_cursor
+        with self.assertNumQueries(4):
+            # Session, user, the conditional GET validators and one seek into the (user, recorded_date) index
+            self.get(page_size=10, after=cursor)
+
+    def test_filters_by_date_range(self):
+        response = self.get(start='2025-01-05', end='2025-01-07')
+        self.assertEqual(self.dates(response), [7, 6, 5])
+        self.assertContains(response, 'value="2025-01-05"')
+
+    def test_invalid_cursor_and_page_size_fall_back_to_the_first_page(self):
+        self.assertEqual(self.dates(self.get(after='not-a-cursor'))[0], 23)
+        response = self.get(page_size=1000)
+        self.assertEqual(len(self.dates(response)), 23)
+        self.assertEqual(response.context['page_size'], 25)
+
+
+class HealthMetricsExportTests(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.member = User.objects.create_user('member', password='pw')
+        cls.other = User.objects.create_user('other', password='pw')
+        cls.staff = User.objects.create_user('staff', password='pw', is_staff=True)
+        for user, days in [(cls.member, 3), (cls.other, 2)]:
+            for day in range(days):
+                create_metric(
+                    user, day, wakeup_datetime=datetime(2025, 1, 1, 6, 30, tzinfo=timezone.utc), weight='70.50'
+                )
+
+    def export(self, **params):
+        response = self.client.get(reverse('trainer:export_health_metrics'), params)
+        self.assertTrue(response.streaming)
+        return b''.join(response.streaming_content).decode()
+
+    def test_streams_csv_with_sleep_duration(self):
+        self.client.force_login(self.member)
+        lines = self.export().splitlines()
+        self.assertEqual(
+            lines[:2],
+            [
+                'username,date,sleep_time,wakeup_time,weight,thigh_length,hip_length,sleep_duration_seconds',
+                'member,2025-01-01,23:00,06:30,70.50,55.00,95.00,27000',
+            ],
+        )
+        self.assertEqual(len(lines), 4)
+
+    def test_streams_ndjson_with_photo_urls(self):
+        self.client.force_login(self.member)
+        rows = [json.loads(line) for line in self.export(format='ndjson', photos='1').splitlines()]
+        self.assertEqual([row['date'] for row in rows], ['2025-01-01', '2025-01-02', '2025-01-03'])
+        self.assertEqual(rows[0]['photo_url'], '')
+
+    def test_members_only_export_their_own_history(self):
+        self.client.force_login(self.member)
+        self.assertNotIn('other,', self.export(user_id=self.other.pk))
+
+        self.client.force_login(self.staff)
+        self.assertIn('other,2025-01-02', self.export(user_id=self.other.pk))
+
+    def test_staff_archive_has_one_file_per_user(self):
+        self.client.force_login(self.staff)
+        response = self.client.get(reverse('trainer:export_all_health_metrics'))
+        archive = zipfile.ZipFile(io.BytesIO(b''.join(response.streaming_content)))
+        self.assertEqual(archive.namelist(), ['member.csv', 'other.csv'])
+        self.assertEqual(len(archive.read('other.csv').decode().splitlines()), 3)
+
+        self.client.force_login(self.member)
+        self.assertEqual(self.client.get(reverse('trainer:export_all_health_metrics')).status_code, 302)
+
+
+class HealthMetricsAdminChangelistTests(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.admin = User.objects.create_superuser('admin', 'admin@example.com', 'pw')
+        members = [User.objects.create_user(f'member{i}') for i in range(12)]
+        UserHealthMetrics.objects.bulk_create(
+            UserHealthMetrics(**metric_values(
+                user, recorded_date=date(2024, 11, 1) + timedelta(days=day), sleep_duration_seconds=8 * 3600
+            ))
+            for user in members
+            for day in range(100)
+        )
+        cls.member = members[0]
+
+    def setUp(self):
+        self.client.force_login(self.admin)
+
+    def changelist(self, **params):
+        return self.client.get(reverse('admin:trainer_userhealthmetrics_changelist'), params)
+
+    def test_query_count_does_not_depend_on_page_or_filters(self):
+        self.changelist()
+        # Session, user, capped count, page rows (users joined) and two date
+        # bounds, plus the selected user's label when filtering by user
+        cases = [
+            ({}, 6),
+            ({'p': '5'}, 6),
+            ({'recorded_date__year': '2025', 'recorded_date__month': '1'}, 6),
+            ({'q': 'member1'}, 6),
+            ({'user__id__exact': str(self.member.pk)}, 7),
+            ({'user__id__exact': str(self.member.pk), 'p': '3'}, 7),
+        ]
+        for params, queries in cases:
+            with self.subTest(params=params), self.assertNumQueries(queries):
+                response = self.changelist(**params)
+                self.assertEqual(response.status_code, 200)
+
+    def test_user_filter_uses_autocomplete_instead_of_listing_users(self):
+        response = self.changelist()
+        self.assertContains(response, 'id="user-autocomplete-filter"')
+        sidebar = response.content.decode().split('id="changelist-filter"')[1].split('</nav>')[0]
+        self.assertNotIn('member11', sidebar)
+
+        response = self.changelist(user__id__exact=str(self.member.pk))
+        self.assertEqual({metric.user_id for metric in response.context['cl'].result_list}, {self.member.pk})
+
+    def test_large_counts_are_capped(self):
+        response = self.changelist()
+        cl = response.context['cl']
+        self.assertIsNone(cl.full_result_count)
+        self.assertEqual(cl.result_count, 1200)
+        self.assertFalse(cl.paginator.count_capped)
+
+        with mock.patch.object(CappedCountPaginator, 'max_pages', 2):
+            response = self.changelist()
+        self.assertTrue(response.context['cl'].paginator.count_capped)
+        self.assertContains(response, 'More than 200')
+
+    def test_date_hierarchy_offers_periods_between_bounds(self):
+        response = self.changelist()
+        self.assertContains(response, '?recorded_date__year=2024')
+        self.assertContains(response, '?recorded_date__year=2025')
+
+        response = self.changelist(recorded_date__year='2024')
+        self.assertContains(response, 'November 2024')
+        self.assertContains(response, 'December 2024')
+        self.assertNotContains(response, 'October 2024')
+
+
+class TrainerSearchTests(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        for index in range(15):
+            user = User.objects.create_user(f'coach{index}', first_name=f'Coach{index}', last_name='Smith')
+            PersonalTrainer.objects.create(
+                user=user,
+                specialization='Yoga' if index % 3 == 0 else 'Strength',
+                experience_years=index,
+                hourly_rate=20 + index * 5,
+                bio='Bio',
+                is_available=index != 14,
+            )
+
+    def setUp(self):
+        cache.clear()
+
+    def trainer_names(self, response):
+        return [trainer['user__first_name'] for trainer in response.context['trainers']]
+
+    def test_filters_and_sorting(self):
+        response = self.client.get(reverse('trainer:trainer_list'), {'specialization': 'Yoga', 'sort': '-rate'})
+        self.assertEqual(self.trainer_names(response), ['Coach12', 'Coach9', 'Coach6', 'Coach3', 'Coach0'])
+
+        response = self.client.get(
+            reverse('trainer:trainer_list'),
+            {'min_rate': '40', 'max_rate': '60', 'min_experience': '5', 'sort': 'experience'},
+        )
+        self.assertEqual(self.trainer_names(response), ['Coach8', 'Coach7', 'Coach6', 'Coach5'])
+
+    def test_invalid_filters_are_ignored(self):
+        response = self.client.get(reverse('trainer:trainer_list'), {'min_rate': 'cheap', 'sort': 'random'})
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.context['results']['count'], 14)
+
+    def test_pagination(self):
+        response = self.client.get(reverse('trainer:trainer_list'))
+        self.assertEqual(len(response.context['trainers']), 12)
+        self.assertEqual(response.context['results']['num_pages'], 2)
+        self.assertContains(response, '?page=2')
+
+        response = self.client.get(reverse('trainer:trainer_list'), {'page': '2'})
+        self.assertEqual(self.trainer_names(response), ['Coach12', 'Coach13'])
+
+    def test_repeated_search_is_served_from_cache(self):
+        params = {'specialization': 'Strength'}
+        self.client.get(reverse('trainer:trainer_list'), params)
+        with self.assertNumQueries(0):
+            response = self.client.get(reverse('trainer:trainer_list'), params)
+        self.assertEqual(response.context['results']['count'], 9)
+
+    def test_page_numbers_are_cached_as_the_page_shown(self):
+        self.client.get(reverse('trainer:trainer_list'), {'page': '2'})
+        self.client.get(reverse('trainer:trainer_list'))
+        for page, shown in [('999', 2), ('-1', 2), ('abc', 1), ('01', 1)]:
+            with self.subTest(page=page), self.assertNumQueries(0):
+                response = self.client.get(reverse('trainer:trainer_list'), {'page': page})
+                self.assertEqual(response.context['results']['number'], shown)
+
+    def test_trainer_change_invalidates_cached_pages(self):
+        self.client.get(reverse('trainer:trainer_list'))
+        trainer = PersonalTrainer.objects.get(user__username='coach0')
+        with self.captureOnCommitCallbacks(execute=True):
+            trainer.is_available = False
+            trainer.save()
+
+        response = self.client.get(reverse('trainer:trainer_list'))
+        self.assertEqual(response.context['results']['count'], 13)
+        self.assertNotIn('Coach0', self.trainer_names(response))
+
+
+class ConditionalGetTests(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.member = User.objects.create_user('member', password='pw', first_name='Mia')
+        cls.metric = create_metric(cls.member)
+        coach = User.objects.create_user('coach', first_name='Carl', last_name='Coach')
+        cls.trainer = PersonalTrainer.objects.create(
+            user=coach, specialization='Yoga', experience_years=3, hourly_rate=40, bio='Bio'
+        )
+
+    def setUp(self):
+        cache.clear()
+        self.client.force_login(self.member)
+
+    def revalidate(self, url, response, **params):
+        return self.client.get(url, params, HTTP_IF_NONE_MATCH=response['ETag'])
+
+    def test_unchanged_pages_are_not_modified_without_rendering(self):
+        pages = [
+            (reverse('trainer:dashboard'), 'trainer/dashboard.html', 3),
+            (reverse('trainer:health_metrics'), 'trainer/health_metrics.html', 3),
+            (reverse('trainer:trainer_profile', args=[self.trainer.pk]), 'trainer/trainer_profile.html', 3),
+        ]
+        for url, template, queries in pages:
+            with self.subTest(url=url):
+                response = self.client.get(url)
+                self.assertEqual(response.status_code, 200)
+                self.assertIn('private', response['Cache-Control'])
+                self.assertIn('no-cache', response['Cache-Control'])
+                self.assertTrue(response.has_header('Last-Modified'))
+
+                # Session, user and one validator query
+                with self.assertTemplateNotUsed(template), self.assertNumQueries(queries):
+                    revalidated = self.revalidate(url, response)
+                self.assertEqual(revalidated.status_code, 304)
+                self.assertEqual(revalidated.content, b'')
+
+    def test_last_modified_revalidation(self):
+        url = reverse('trainer:health_metrics')
+        response = self.client.get(url)
+        revalidated = self.client.get(url, HTTP_IF_MODIFIED_SINCE=response['Last-Modified'])
+        self.assertEqual(revalidated.status_code, 304)
+
+    def test_changes_produce_a_new_page(self):
+        url = reverse('trainer:health_metrics')
+        response = self.client.get(url)
+
+        self.metric.weight = '71.00'
+        self.metric.save()
+        changed = self.revalidate(url, response)
+        self.assertEqual(changed.status_code, 200)
+        self.assertNotEqual(changed['ETag'], response['ETag'])
+
+        # Deleting a row does not move max(updated_at); the count catches it
+        create_metric(self.member, day=1).delete()
+        self.assertEqual(self.revalidate(url, changed).status_code, 304)
+        self.metric.delete()
+        self.assertEqual(self.revalidate(url, changed).status_code, 200)
+
+    def test_validators_depend_on_the_viewer(self):
+        url = reverse('trainer:trainer_profile', args=[self.trainer.pk])
+        response = self.client.get(url)
+        self.client.logout()
+        self.assertEqual(self.revalidate(url, response).status_code, 200)
+
+        url = reverse('trainer:trainer_profile', args=[self.trainer.pk + 1])
+        self.assertEqual(self.client.get(url).status_code, 404)
+
+    def test_pending_messages_skip_validation(self):
+        url = reverse('trainer:health_metrics')
+        response = self.client.get(url)
+        with mock.patch('trainer.conditional.get_messages', return_value=['Saved.']):
+            self.assertEqual(self.revalidate(url, response).status_code, 200)
+
+    def test_cacheable_responses_are_compressed(self):
+        for url in [reverse('trainer:dashboard'), reverse('trainer:health_metrics'), reverse('trainer:trainer_list')]:
+            with self.subTest(url=url):
+                response = self.client.get(url, HTTP_ACCEPT_ENCODING='gzip')
+                self.assertEqual(response['Content-Encoding'], 'gzip')
+                self.assertIn('Accept-Encoding', response['Vary'])
+
+
+@override_settings(TRAINER_READ_REPLICAS=['replica'])
+class ReadReplicaRoutingTests(SimpleTestCase):
+    def read_db(self):
+        return router.db_for_read(UserHealthMetrics)
+
+    def test_reads_go_to_replicas_only_when_allowed(self):
+        self.assertEqual(self.read_db(), 'default')
+        with use_replicas():
+            self.assertEqual(self.read_db(), 'replica')
+            with use_primary():
+                self.assertEqual(self.read_db(), 'default')
+            with mock.patch.object(connections['default'], 'in_atomic_block', True):
+                self.assertEqual(self.read_db(), 'default')
+            self.assertEqual(router.db_for_read(Session), 'default')
+        with override_settings(TRAINER_READ_REPLICAS=[]), use_replicas():
+            self.assertEqual(self.read_db(), 'default')
+
+    def test_writes_and_migrations_stay_on_the_primary(self):
+        metric = UserHealthMetrics()
+        metric._state.db = 'replica'
+        self.assertEqual(router.db_for_write(UserHealthMetrics, instance=metric), 'default')
+        self.assertFalse(router.allow_migrate('replica', 'trainer'))
+        self.assertTrue(router.allow_migrate('default', 'trainer'))
+
+    def test_middleware_pins_unsafe_requests_and_what_follows(self):
+        factory = RequestFactory()
+        middleware = ReplicaRoutingMiddleware(lambda request: HttpResponse(self.read_db()))
+
+        response = middleware(factory.get('/dashboard/'))
+        self.assertEqual(response.content, b'replica')
+        self.assertNotIn(PIN_COOKIE, response.cookies)
+
+        response = middleware(factory.post('/add-health-metrics/'))
+        self.assertEqual(response.content, b'default')
+        self.assertEqual(response.cookies[PIN_COOKIE]['max-age'], 5)
+
+        request = factory.get('/dashboard/')
+        request.COOKIES[PIN_COOKIE] = '1'
+        self.assertEqual(middleware(request).content, b'default')
+
+    def test_streamed_bodies_keep_the_request_routing(self):
+        with use_replicas():
+            body = keep_routing(self.read_db() for _ in range(2))
+        self.assertEqual(self.read_db(), 'default')
+        self.assertEqual(list(body), ['replica', 'replica'])
+
+
+class CopySqliteDatabaseTests(TransactionTestCase):
+    # The backup API cannot read a database with an open write transaction
+    def test_copy_is_a_readable_snapshot_of_the_primary(self):
+        User.objects.create_user('replicated')
+        with tempfile.NamedTemporaryFile(suffix='.sqlite3') as target:
+            copy_sqlite_database('default', target.name)
+            replica = sqlite3.connect(target.name)
+            try:
+                rows = replica.execute('SELECT username FROM auth_user').fetchall()
+            finally:
+                replica.close()
+        self.assertEqual(rows, [('replicated',)])
+
+
+class PlanRebalanceTests(SimpleTestCase):
+    def test_moves_users_from_the_fullest_to_the_emptiest_shard(self):
+        loads = {'a': {1: 50, 2: 30, 3: 20}, 'b': {4: 10}}
+        self.assertEqual(plan_rebalance(loads), [(2, 'a', 'b')])
+
+    def test_balanced_shards_need_no_moves(self):
+        self.assertEqual(plan_rebalance({'a': {1: 10}, 'b': {2: 11}}), [])
+        # A single user larger than the gap cannot be split
+        self.assertEqual(plan_rebalance({'a': {1: 100}, 'b': {}}), [])
+
+
+@override_settings(TRAINER_METRICS_SHARDS=['default', 'shard2'], MEDIA_ROOT=TEST_MEDIA_ROOT)
+class MetricsShardingTests(TransactionTestCase):
+    databases = {'default', 'shard2'}
+
+    def setUp(self):
+        # Test databases are migrated before the shards are configured
+        seed_id_ranges('shard2')
+        cache.clear()
+        self.first = User.objects.create_user('first', password='pw')
+        self.second = User.objects.create_user('second', password='pw')
+        UserShard.objects.filter(user=self.first).update(shard='default')
+        UserShard.objects.filter(user=self.second).update(shard='shard2')
+
+    def test_new_users_are_spread_over_the_shards(self):
+        user = User.objects.create_user('third')
+        self.assertEqual(UserShard.objects.get(user=user).shard, initial_shard(user.pk))
+
+    def test_metrics_are_written_to_and_read_from_the_users_shard(self):
+        metric = create_metric(self.second, weight='81.50')
+        self.assertGreaterEqual(metric.pk, ID_RANGE)
+        self.assertFalse(UserHealthMetrics.objects.using('default').exists())
+        self.assertEqual(HealthMetricsRollup.objects.using('shard2').filter(user=self.second).count(), 2)
+
+        metric.weight = '80.00'
+        metric.save()
+        self.assertEqual(UserHealthMetrics.objects.for_user(self.second).get().weight, 80)
+
+        self.client.force_login(self.second)
+        self.assertContains(self.client.get(reverse('trainer:health_metrics')), '80.00')
+        response = self.client.post(reverse('trainer:add_health_metrics'), {
+            'date': '2025-01-02',
+            'sleep_hour': '11', 'sleep_minute': '00', 'sleep_ampm': 'PM',
+            'wakeup_hour': '7', 'wakeup_minute': '00', 'wakeup_ampm': 'AM',
+            'weight': '79.00', 'thigh_length': '55.00', 'hip_length': '95.00',
+        })
+        self.assertEqual(response.status_code, 302)
+        self.assertEqual(UserHealthMetrics.objects.using('shard2').count(), 2)
+
+    def test_fan_out_and_archive_cover_every_shard(self):
+        create_metric(self.first)
+        create_metric(self.second)
+        self.assertEqual(fan_out(lambda alias: UserHealthMetrics.objects.using(alias).count()), [1, 1])
+        archive = zipfile.ZipFile(io.BytesIO(b''.join(stream_archive('csv'))))
+        self.assertEqual(archive.namelist(), ['first.csv', 'second.csv'])
+
+    def test_dashboard_cache_is_dropped_when_the_shard_commits(self):
+        key = cache_key(FRAGMENT_CHARTS, self.second.pk)
+        cache.set(key, 'stale')
+        with transaction.atomic(using='shard2'):
+            create_metric(self.second)
+            # A request now would still read the committed rows
+            self.assertEqual(cache.get(key), 'stale')
+        self.assertIsNone(cache.get(key))
+
+    def test_move_user_copies_rows_and_repoints_the_user(self):
+        for day in range(3):
+            create_metric(self.first, day)
+        self.assertEqual(move_user(self.first.pk, 'shard2'), 3)
+
+        self.assertEqual(UserShard.objects.get(user=self.first).shard, 'shard2')
+        self.assertFalse(UserHealthMetrics.objects.using('default').exists())
+        self.assertFalse(HealthMetricsRollup.objects.using('default').exists())
+        self.assertEqual(UserHealthMetrics.objects.for_user(self.first.pk).count(), 3)
+        self.assertEqual(list(find_rollup_drift([self.first.pk])), [])
+
+    def test_failed_move_leaves_the_user_on_the_source(self):
+        for day in range(3):
+            create_metric(self.first, day)
+        locked = OperationalError('database is locked')
+        with mock.patch.object(connections['shard2'], 'commit', side_effect=locked):
+            with self.assertRaises(OperationalError):
+                move_user(self.first.pk, 'shard2')
+
+        self.assertEqual(UserShard.objects.values_list('shard', 'moving').get(user=self.first), ('default', False))
+        self.assertEqual(UserHealthMetrics.objects.for_user(self.first.pk).count(), 3)
+        self.assertFalse(UserHealthMetrics.objects.using('shard2').exists())
+
+    def test_writes_wait_for_a_move_and_follow_the_user(self):
+        UserShard.objects.filter(user=self.first).update(moving=True)
+
+        def move_done(seconds):
+            UserShard.objects.filter(user=self.first).update(shard='shard2', moving=False)
+
+        values = metric_values(self.first)
+        del values['user']
+        with mock.patch('trainer.sharding.time.sleep', side_effect=move_done) as sleep:
+            metric, outcome = upsert_health_metrics(self.first, values.pop('recorded_date'), values)
+        sleep.assert_called_once()
+        self.assertEqual(outcome, CREATED)
+        self.assertTrue(UserHealthMetrics.objects.using('shard2').filter(pk=metric.pk).exists())
+
+        UserShard.objects.filter(user=self.first).update(moving=True)
+        with mock.patch('trainer.sharding.MOVE_WAIT_SECONDS', 0), self.assertRaises(MoveInProgress):
+            create_metric(self.first, day=1)
+
+    def test_rows_loaded_before_a_move_cannot_be_saved_after_it(self):
+        metric = create_metric(self.first)
+        move_user(self.first.pk, 'shard2')
+        metric.weight = '71.00'
+        with self.assertRaises(MoveInProgress):
+            metric.save()
+        self.assertFalse(UserHealthMetrics.objects.using('default').exists())
+
+    def test_rows_written_during_the_copy_are_moved_too(self):
+        create_metric(self.first)
+
+        def copy_then_write(user_id, source, target):
+            copied = _copy_user_rows(user_id, source, target)
+            if copy_then_write.writes:
+                # A request that picked the source shard just before the move began
+                copy_then_write.writes -= 1
+                UserHealthMetrics.objects.using(source).create(**metric_values(self.first, day=8))
+            return copied
+
+        copy_then_write.writes = 1
+        with mock.patch('trainer.sharding._copy_user_rows', side_effect=copy_then_write) as copies:
+            self.assertEqual(move_user(self.first.pk, 'shard2'), 2)
+        self.assertEqual(copies.call_count, 2)
+        self.assertFalse(UserHealthMetrics.objects.using('default').exists())
+        self.assertEqual(UserHealthMetrics.objects.using('shard2').filter(user=self.first).count(), 2)
+        self.assertEqual(UserShard.objects.values_list('shard', 'moving').get(user=self.first), ('shard2', False))
+
+    def test_rebalance_command_evens_out_the_shards(self):
+        for user in [self.first, User.objects.create_user('third')]:
+            UserShard.objects.filter(user=user).update(shard='default')
+            for day in range(4):
+                create_metric(user, day)
+        call_command('rebalance_shards', '--even', stdout=io.StringIO())
+        self.assertEqual(fan_out(lambda alias: UserHealthMetrics.objects.using(alias).count()), [4, 4])
+
+    def test_deleting_a_user_deletes_their_sharded_rows(self):
+        create_metric(self.second)
+        self.second.delete()
+        self.assertFalse(UserHealthMetrics.objects.using('shard2').exists())
+        self.assertFalse(HealthMetricsRollup.objects.using('shard2').exists())
+
+    def test_admin_shows_one_shard_at_a_time(self):
+        create_metric(self.first)
+        metric = create_metric(self.second)
+        self.client.force_login(User.objects.create_superuser('admin', 'admin@example.com', 'pw'))
+        url = reverse('admin:trainer_userhealthmetrics_changelist')
+
+        response = self.client.get(url)
+        self.assertEqual([row.user for row in response.context['cl'].result_list], [self.first])
+        response = self.client.get(url, {'shard': 'shard2', 'q': 'sec'})
+        self.assertEqual([row.user for row in response.context['cl'].result_list], [self.second])
+        response = self.client.get(url, {'user__id__exact': self.second.pk})
+        self.assertEqual(response.context['cl'].result_count, 1)
+
+        response = self.client.get(reverse('admin:trainer_userhealthmetrics_change', args=[metric.pk]))
+        self.assertEqual(response.status_code, 200)
+
+
+class RetryOnLockTests(SimpleTestCase):
+    def flaky(self, failures, error='database is locked'):
+        calls = []
+
+        def write():
+            calls.append(1)
+            if len(calls) <= failures:
+                raise OperationalError(error)
+            return len(calls)
+
+        return write, calls
+
+    @mock.patch('trainer.db_retry.time.sleep')
+    def test_retries_lock_errors_with_growing_pauses(self, sleep):
+        write, calls = self.flaky(2)
+        retries = registry.counter_value(RETRIES_METRIC, operation=write.__qualname__)
+        self.assertEqual(retry_on_lock(write)(), 3)
+        self.assertEqual(registry.counter_value(RETRIES_METRIC, operation=write.__qualname__), retries + 2)
+        first, second = (call.args[0] for call in sleep.call_args_list)
+        self.assertLess(first, 0.051)
+        self.assertGreater(second, 0.049)
+
+    @mock.patch('trainer.db_retry.time.sleep')
+    def test_gives_up_after_the_configured_retries(self, sleep):
+        write, calls = self.flaky(10)
+        with override_settings(TRAINER_WRITE_RETRIES=3), self.assertRaises(OperationalError):
+            retry_on_lock(write)()
+        self.assertEqual(len(calls), 4)
+        self.assertEqual(registry.counter_value(FAILURES_METRIC, operation=write.__qualname__), 1)
+
+    @mock.patch('trainer.db_retry.time.sleep')
+    def test_other_errors_and_open_transactions_are_not_retried(self, sleep):
+        write, calls = self.flaky(1, error='no such table: trainer_userhealthmetrics')
+        with self.assertRaises(OperationalError):
+            retry_on_lock(write)()
+
+        write, calls = self.flaky(1)
+        with mock.patch('trainer.db_retry._in_transaction', return_value=True), self.assertRaises(OperationalError):
+            retry_on_lock(write)()
+        self.assertEqual(len(calls), 1)
+        sleep.assert_not_called()
+
+
+class SqliteProductionProfileTests(TransactionTestCase):
+    """A burst of concurrent check-ins and dashboard reads loses and fails no writes."""
+    members = 8
+    days = 10
+    readers = 4
+
+    def test_connections_use_wal_and_immediate_transactions(self):
+        with connection.cursor() as cursor:
+            cursor.execute('PRAGMA journal_mode')
+            self.assertEqual(cursor.fetchone()[0], 'wal')
+            cursor.execute('PRAGMA busy_timeout')
+            self.assertEqual(cursor.fetchone()[0], 5000)
+        self.assertEqual(connection.transaction_mode, 'IMMEDIATE')
+
+    def run_in_threads(self, jobs):
+        barrier = threading.Barrier(len(jobs))
+        errors = []
+
+        def run(job):
+            try:
+                barrier.wait()
+                job()
+            except Exception as e:
+                errors.append(e)
+            finally:
+                connections.close_all()
+
+        threads = [threading.Thread(target=run, args=[job]) for job in jobs]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        return errors
+
+    def test_concurrent_check_ins_are_all_saved(self):
+        statuses = []
+        clients = []
+        for index in range(self.members):
+            client = Client()
+            client.force_login(User.objects.create_user(f'member{index}'))
+            clients.append(client)
+
+        def check_in(client):
+            def job():
+                for day in range(self.days):
+                    response = client.post(reverse('trainer:add_health_metrics'), {
+                        'date': (date(2025, 1, 1) + timedelta(days=day)).isoformat(),
+                        'sleep_hour': '11', 'sleep_minute': '00', 'sleep_ampm': 'PM',
+                        'wakeup_hour': '7', 'wakeup_minute': '00', 'wakeup_ampm': 'AM',
+                        'weight': f'{70 + day}.00', 'thigh_length': '55.00', 'hip_length': '95.00',
+                    })
+                    statuses.append(response.status_code)
+            return job
+
+        def read_dashboard(client):
+            def job():
+                for _ in range(self.days):
+                    statuses.append(client.get(reverse('trainer:dashboard')).status_code)
+            return job
+
+        failures = registry.counter_value(FAILURES_METRIC, operation='QuerySet.update_or_create')
+        errors = self.run_in_threads(
+            [check_in(client) for client in clients] + [read_dashboard(client) for client in clients[:self.readers]]
+        )
+
+        self.assertEqual(errors, [])
+        self.assertEqual(sorted(set(statuses)), [200, 302])
+        self.assertEqual(statuses.count(302), self.members * self.days)
+        self.assertEqual(UserHealthMetrics.objects.count(), self.members * self.days)
+        self.assertEqual(list(find_rollup_drift()), [])
+        self.assertEqual(registry.counter_value(FAILURES_METRIC, operation='QuerySet.update_or_create'), failures)
+
+
+@override_settings(MEDIA_ROOT=TEST_MEDIA_ROOT, TRAINER_ASYNC_IMAGE_PROCESSING=False)
+class PhotoStoreTests(TestCase):
+    def setUp(self):
+        # The collector looks at every stored photo: start without other tests' files
+        shutil.rmtree(os.path.join(TEST_MEDIA_ROOT, 'health_metrics'), ignore_errors=True)
+        self.user = User.objects.create_user('member')
+
+    def upload(self, name='photo.jpg', size=(1200, 1600)):
+        return SimpleUploadedFile(name, sample_photo(size).read(), content_type='image/jpeg')
+
+    def files(self):
+        return sorted(walk(default_storage, 'health_metrics'))
+
+    def test_identical_photos_share_one_file(self):
+        first = create_metric(self.user, image=self.upload('a.jpg'))
+        second = create_metric(self.user, day=1, image=self.upload('b.jpg'))
+        self.assertEqual(first.image.name, second.image.name)
+        self.assertRegex(first.image.name, r'^health_metrics/([0-9a-f]{2})/\1[0-9a-f]{62}\.jpg$')
+        self.assertEqual(self.files(), [first.image.name])
+        self.assertEqual(StoredPhoto.objects.count(), 1)
+
+        build_renditions(first)
+        build_renditions(second)
+        self.assertEqual(
+            sorted(ImageRendition.objects.filter(metric=first).values_list('image', flat=True)),
+            sorted(ImageRendition.objects.filter(metric=second).values_list('image', flat=True)),
+        )
+
+    def test_collector_deletes_only_old_unreferenced_files(self):
+        metric = create_metric(self.user, image=self.upload())
+        replaced = metric.image.name
+        metric.image = self.upload(size=(1600, 1200))
+        metric.save()
+        build_renditions(metric)
+        # A leftover from before content addressing, and an upload in progress
+        legacy = default_storage.save('health_metrics/old_compressed.jpg', io.BytesIO(b'old'))
+        os.utime(default_storage.path(legacy), (0, 0))
+        in_progress = default_storage.save('health_metrics/raw.jpg', io.BytesIO(b'raw'))
+
+        stats = collect_garbage()
+        self.assertEqual((stats.deleted, stats.recent), (1, 2))
+        self.assertNotIn(legacy, self.files())
+
+        stats = collect_garbage(min_age=timedelta(0), dry_run=True)
+        self.assertEqual(stats.deleted, 2)
+        self.assertIn(replaced, self.files())
+
+        collect_garbage(min_age=timedelta(0))
+        kept = self.files()
+        self.assertNotIn(replaced, kept)
+        self.assertNotIn(in_progress, kept)
+        self.assertIn(metric.image.name, kept)
+        self.assertEqual(len(kept), 1 + ImageRendition.objects.count())
+        self.assertFalse(StoredPhoto.objects.filter(name=replaced).exists())
+
+    def test_files_reused_during_collection_are_kept(self):
+        cutoff = django_timezone.now()
+        metric = create_metric(self.user, image=self.upload())
+        self.assertFalse(_delete(default_storage, metric.image.name, cutoff))
+        self.assertIn(metric.image.name, self.files())
+
+    def test_command_dry_run_lists_files_without_deleting(self):
+        orphan = default_storage.save('health_metrics/orphan.jpg', io.BytesIO(b'orphan'))
+        out = io.StringIO()
+        call_command('collect_photo_garbage', '--dry-run', '--min-age', '0', stdout=out)
+        self.assertIn(orphan, out.getvalue())
+        self.assertIn('Would delete 1', out.getvalue())
+        self.assertEqual(self.files(), [orphan])
+
+
+class ImageDecodeTests(TestCase):
+    def jpeg(self, size, orientation=None):
+        output = io.BytesIO()
+        exif = Image.Exif()
+        if orientation:
+            exif[ORIENTATION_TAG] = orientation
+        Image.new('RGB', size, (180, 120, 90)).save(output, format='JPEG', quality=90, exif=exif)
+        output.seek(0)
+        return output
+
+    def test_jpeg_is_decoded_near_the_target_size(self):
+        before = registry.counter_value(DECODE_BYTES_METRIC)
+        img = decode_scaled(self.jpeg((4000, 3000)), (800, 800))
+        self.assertEqual(img.size, (800, 600))
+        self.assertEqual(img.mode, 'RGB')
+        # Draft mode decodes at 1/4 scale (1000x750), not the full 12 megapixels
+        self.assertEqual(registry.counter_value(DECODE_BYTES_METRIC) - before, 1000 * 750 * 4)
+
+    def test_exif_orientation_is_applied(self):
+        img = decode_scaled(self.jpeg((1600, 1200), orientation=6), (800, 400))
+        self.assertEqual(img.size, (300, 400))
+
+    @override_settings(TRAINER_IMAGE_MAX_PIXELS=1_000_000)
+    def test_images_over_the_pixel_ceiling_are_refused(self):
+        with self.assertRaises(ImageTooLarge):
+            decode_scaled(self.jpeg((2000, 1000)), (800, 800))
+
+        form = HealthMetricsForm(
+            data={
+                'date': '2025-01-01',
+                'sleep_hour': '10', 'sleep_minute': '30', 'sleep_ampm': 'PM',
+                'wakeup_hour': '6', 'wakeup_minute': '45', 'wakeup_ampm': 'AM',
+                'weight': '72.50', 'thigh_length': '56.00', 'hip_length': '94.00',
+            },
+            files={'image': SimpleUploadedFile('big.jpg', self.jpeg((2000, 1000)).read(), content_type='image/jpeg')},
+        )
+        self.assertIn('megapixels', form.errors['image'][0])
+
+
+@override_settings(MEDIA_ROOT=TEST_MEDIA_ROOT, TRAINER_ASYNC_IMAGE_PROCESSING=False)
+class PhotoUploadHandlerTests(TestCase):
+    def setUp(self):
+        self.user = User.objects.create_user('member', password='secret')
+        self.client.force_login(self.user)
+
+    def post(self, content, name='progress.jpg', client=None):
+        return (client or self.client).post(reverse('trainer:add_health_metrics'), {
+            'date': '2025-01-01',
+            'sleep_hour': '10', 'sleep_minute': '30', 'sleep_ampm': 'PM',
+            'wakeup_hour': '6', 'wakeup_minute': '45', 'wakeup_ampm': 'AM',
+            'weight': '72.50', 'thigh_length': '56.00', 'hip_length': '94.00',
+            'image': SimpleUploadedFile(name, content, content_type='image/jpeg'),
+        })
+
+    def rejections(self, reason):
+        return registry.counter_value(UPLOAD_REJECTIONS_METRIC, reason=reason)
+
+    def assertRefused(self, response, message):
+        self.assertEqual(response.status_code, 200)
+        self.assertIn(message, response.context['form'].errors['image'][0])
+        self.assertFalse(UserHealthMetrics.objects.exists())
+
+    def test_valid_photo_is_stored(self):
+        response = self.post(sample_photo((1200, 1600)).read())
+        self.assertEqual(response.status_code, 302)
+        self.assertTrue(UserHealthMetrics.objects.get(user=self.user).image)
+
+    def test_oversized_file_is_dropped_at_the_limit(self):
+        before = self.rejections('too_large')
+        response = self.post(sample_photo((400, 300)).read() + b'\0' * MAX_PHOTO_BYTES)
+        self.assertRefused(response, 'Image file too large')
+        self.assertEqual(self.rejections('too_large') - before, 1)
+
+    def test_content_is_sniffed_instead_of_trusting_the_content_type(self):
+        before = self.rejections('type')
+        response = self.post(b'%PDF-1.7\n' + b'x' * 1000, name='progress.jpg')
+        self.assertRefused(response, 'Invalid image format')
+        self.assertEqual(self.rejections('type') - before, 1)
+
+    def test_decompression_bomb_is_refused_from_its_header(self):
+        # A PNG header claiming 8000x8000 pixels, with no image data behind it
+        ihdr = (8000).to_bytes(4, 'big') * 2 + bytes([8, 2, 0, 0, 0])
+        chunk = b'IHDR' + ihdr
+        png = b'\x89PNG\r\n\x1a\n' + len(ihdr).to_bytes(4, 'big') + chunk + zlib.crc32(chunk).to_bytes(4, 'big')
+        before = self.rejections('pixels')
+        with override_settings(TRAINER_IMAGE_MAX_PIXELS=50_000_000):
+            response = self.post(png + (1000).to_bytes(4, 'big') + b'IDAT' + b'\0' * 1004, name='progress.png')
+        self.assertRefused(response, 'megapixels')
+        self.assertEqual(self.rejections('pixels') - before, 1)
+
+    def test_csrf_is_still_enforced(self):
+        client = Client(enforce_csrf_checks=True)
+        client.force_login(self.user)
+        self.assertEqual(self.post(sample_photo((400, 300)).read(), client=client).status_code, 403)
+
+    def test_webp_size_is_read_from_the_first_chunk(self):
+        for options in ({'lossless': True}, {'quality': 80}):
+            output = io.BytesIO()
+            Image.new('RGB', (300, 200), (10, 20, 30)).save(output, format='WEBP', **options)
+            self.assertEqual(webp_size(output.getvalue()[:64]), (300, 200))
+
+
+@override_settings(MEDIA_ROOT=TEST_MEDIA_ROOT, TRAINER_ASYNC_IMAGE_PROCESSING=False)
+class UpsertHealthMetricsTests(TestCase):
+    def setUp(self):
+        self.user = User.objects.create_user('member')
+
+    def values(self, weight='72.50', **extra):
+        return {
+            'sleeping_datetime': datetime(2025, 1, 1, 22, 30, tzinfo=timezone.utc),
+            'wakeup_datetime': datetime(2025, 1, 2, 6, 45, tzinfo=timezone.utc),
+            'weight': Decimal(weight),
+            'thigh_length': Decimal('56.00'),
+            'hip_length': Decimal('94.00'),
+            **extra,
+        }
+
+    def upsert(self, day=1, queries=None, **values):
+        counter = QueryCounter()
+        with connection.execute_wrapper(counter):
+            metric, outcome = upsert_health_metrics(self.user, date(2025, 1, day), self.values(**values))
+        if queries is not None:
+            self.assertEqual(len(counter), queries)
+        return metric, outcome
+
+    def test_create_update_and_unchanged_resubmit(self):
+        # One upsert, then a week and a month rollup to create from the period's rows
+        # (update finds none, aggregate, lookup, insert)
+        metric, outcome = self.upsert(queries=9)
+        self.assertEqual(outcome, CREATED)
+        stored = UserHealthMetrics.objects.get()
+        self.assertEqual(stored.pk, metric.pk)
+        self.assertEqual(stored.sleep_duration_seconds, 8 * 3600 + 15 * 60)
+        self.assertEqual(stored.created_at, stored.updated_at)
+
+        # Another day of the same week and month: the rollups are updated in place
+        self.assertEqual(self.upsert(day=2, queries=3)[1], CREATED)
+
+        # Unchanged resubmission: one statement that writes nothing
+        self.assertEqual(self.upsert(queries=1)[1], UNCHANGED)
+        self.assertEqual(UserHealthMetrics.objects.get(pk=metric.pk).updated_at, stored.updated_at)
+
+        # A changed measurement: the upsert, then both rollups recomputed
+        self.assertEqual(self.upsert(weight='71.00', queries=7)[1], UPDATED)
+        updated = UserHealthMetrics.objects.get(pk=metric.pk)
+        self.assertEqual(updated.weight, Decimal('71.00'))
+        self.assertEqual(updated.created_at, stored.created_at)
+        self.assertGreater(updated.updated_at, stored.updated_at)
+        self.assertEqual(list(find_rollup_drift([self.user.pk])), [])
+
+    def test_new_photo_alone_skips_the_rollups(self):
+        self.upsert()
+        photo = SimpleUploadedFile('progress.jpg', sample_photo((1200, 1600)).read(), content_type='image/jpeg')
+        # Photo record, the upsert (nothing else changed) and the photo update
+        metric, outcome = self.upsert(queries=3, image=photo)
+        self.assertEqual(outcome, UPDATED)
+        stored = UserHealthMetrics.objects.get()
+        self.assertEqual(stored.image.name, metric.image.name)
+        self.assertEqual(stored.image_status, UserHealthMetrics.IMAGE_STATUS_READY)
+
+        # Resubmitting without a photo keeps it
+        self.assertEqual(self.upsert(queries=1)[1], UNCHANGED)
+        self.assertEqual(UserHealthMetrics.objects.get().image.name, stored.image.name)
+        self.assertEqual(list(find_rollup_drift([self.user.pk])), [])
+
+    def test_saving_a_loaded_row_does_not_read_it_again(self):
+        photo = SimpleUploadedFile('progress.jpg', sample_photo((1200, 1600)).read(), content_type='image/jpeg')
+        self.upsert(image=photo)
+        metric = UserHealthMetrics.objects.get()
+        metric.weight = Decimal('70.00')
+        with CaptureQueriesContext(connection) as queries, mock.patch.object(
+            UserHealthMetrics, 'prepare_image'
+        ) as prepare_image:
+            metric.save()
+        # The photo did not change: no reload of the row and no image work
+        prepare_image.assert_not_called()
+        self.assertFalse([
+            query for query in queries.captured_queries
+            if query['sql'].startswith('SELECT "trainer_userhealthmetrics"."id"')
+        ])
+
+
+class RecompressPhotosMixin:
+    def setUp(self):
+        self.checkpoint = os.path.join(TEST_MEDIA_ROOT, 'recompress.checkpoint.json')
+        self.user = User.objects.create_user('member')
+
+    def tearDown(self):
+        if os.path.exists(self.checkpoint):
+            os.remove(self.checkpoint)
+
+    def add_raw_photo(self, day):
+        """A metric whose photo was stored as uploaded, like rows from before compression."""
+        output = io.BytesIO()
+        Image.frombytes('RGB', (1200, 900), os.urandom(1200 * 900 * 3)).save(output, format='PNG')
+        name = default_storage.save('health_metrics/screenshot.png', io.BytesIO(output.getvalue()))
+        metric = create_metric(self.user, day)
+        UserHealthMetrics.objects.filter(pk=metric.pk).update(image=name)
+        return metric.pk, name
+
+    def recompress(self, *args, workers=1):
+        out = io.StringIO()
+        call_command(
+            'recompress_photos', '--workers', str(workers), '--max-rate', '0', '--checkpoint', self.checkpoint,
+            *args, stdout=out,
+        )
+        return out.getvalue()
+
+
+@override_settings(MEDIA_ROOT=TEST_MEDIA_ROOT, TRAINER_ASYNC_IMAGE_PROCESSING=False)
+class RecompressPhotosTests(RecompressPhotosMixin, TestCase):
+
+    def test_photos_are_recompressed_with_renditions(self):
+        rows = [self.add_raw_photo(day) for day in range(3)]
+        output = self.recompress('--batch-size', '2')
+        self.assertIn('3 photos', output)
+        self.assertIn('3 recompressed', output)
+        for pk, original in rows:
+            metric = UserHealthMetrics.objects.get(pk=pk)
+            self.assertRegex(metric.image.name, r'^health_metrics/[0-9a-f]{2}/[0-9a-f]{64}\.jpg$')
+            self.assertLess(metric.image.size, default_storage.size(original))
+            with Image.open(metric.image) as img:
+                self.assertEqual(img.size, (800, 600))
+            renditions = ImageRendition.objects.filter(metric=metric)
+            self.assertEqual(renditions.count(), len(rendition_keys()))
+            self.assertEqual({rendition.source_name for rendition in renditions}, {metric.image.name})
+
+        # Everything is checkpointed: a second run has nothing left to do
+        names = list(UserHealthMetrics.objects.order_by('pk').values_list('image', flat=True))
+        with mock.patch('trainer.photo_backfill.recompress_photo') as recompress_photo:
+            self.assertIn('Resuming after 3 photos', self.recompress())
+        recompress_photo.assert_not_called()
+        self.assertEqual(list(UserHealthMetrics.objects.order_by('pk').values_list('image', flat=True)), names)
+
+        # Started over, photos it already wrote are not recompressed again
+        with mock.patch('trainer.photo_backfill.recompress_photo') as recompress_photo:
+            self.assertIn('0 photos (0.0/s): 0 recompressed, 3 skipped', self.recompress('--restart'))
+        recompress_photo.assert_not_called()
+        self.assertEqual(list(UserHealthMetrics.objects.order_by('pk').values_list('image', flat=True)), names)
+
+    def test_resumes_after_the_checkpoint(self):
+        first, first_name = self.add_raw_photo(0)
+        second, _ = self.add_raw_photo(1)
+        with open(self.checkpoint, 'w') as f:
+            json.dump({
+                'settings': {'quality': 85, 'max_size': 800},
+                'last_pks': {'default': first},
+                'stats': {'processed': 1},
+            }, f)
+        output = self.recompress()
+        self.assertIn('Resuming after 1 photos', output)
+        self.assertEqual(UserHealthMetrics.objects.get(pk=first).image.name, first_name)
+        self.assertNotEqual(UserHealthMetrics.objects.get(pk=second).image.name.split('.')[-1], 'png')
+        with open(self.checkpoint) as f:
+            self.assertEqual(json.load(f)['last_pks'], {'default': second})
+
+        # Other settings start over
+        self.assertIn('2 photos', self.recompress('--quality', '70'))
+
+    def test_checkpoint_directory_is_created(self):
+        # Like the default var/ directory of a fresh checkout
+        self.checkpoint = os.path.join(TEST_MEDIA_ROOT, 'var', 'recompress.checkpoint.json')
+        self.add_raw_photo(0)
+        self.recompress()
+        with open(self.checkpoint) as f:
+            self.assertEqual(json.load(f)['stats']['processed'], 1)
+
+    def test_rows_changed_meanwhile_keep_their_photo_and_renditions(self):
+        pk, _ = self.add_raw_photo(0)
+        newer = ImageRendition.objects.create(
+            metric_id=pk, kind=ImageRendition.KIND_THUMBNAIL, format=ImageRendition.FORMAT_JPEG, width=1, height=1,
+            image='health_metrics/renditions/new.jpg',
+            source_name='health_metrics/new.jpg',
+        )
+
+        def upload_meanwhile(task):
+            result = recompress_photo(task)
+            UserHealthMetrics.objects.filter(pk=pk).update(image='health_metrics/new.jpg')
+            return result
+
+        with mock.patch('trainer.photo_backfill.recompress_photo', upload_meanwhile):
+            stats = backfill_photos(Checkpoint(None, {}), max_rate=0)
+        self.assertEqual((stats.processed, stats.replaced), (1, 0))
+        self.assertEqual(UserHealthMetrics.objects.get(pk=pk).image.name, 'health_metrics/new.jpg')
+        self.assertEqual(list(ImageRendition.objects.filter(metric_id=pk)), [newer])
+        self.assertEqual(ImageRendition.objects.get(pk=newer.pk).image.name, 'health_metrics/renditions/new.jpg')
+
+
+@override_settings(MEDIA_ROOT=TEST_MEDIA_ROOT, TRAINER_ASYNC_IMAGE_PROCESSING=False)
+class RecompressPhotosWorkerTests(RecompressPhotosMixin, TransactionTestCase):
+    def test_worker_pool_and_unreadable_photos(self):
+        pk, _ = self.add_raw_photo(0)
+        broken = create_metric(self.user, day=1)
+        UserHealthMetrics.objects.filter(pk=broken.pk).update(image='health_metrics/missing.jpg')
+        # Spawned workers start without Django set up (the default on macOS and Windows)
+        with mock.patch('trainer.processes.multiprocessing', multiprocessing.get_context('spawn')):
+            output = self.recompress(workers=2)
+        self.assertIn('2 photos', output)
+        self.assertIn('1 recompressed, 0 skipped, 1 failed', output)
+        self.assertTrue(ImageRendition.objects.filter(metric_id=pk).exists())
+        self.assertEqual(UserHealthMetrics.objects.get(pk=broken.pk).image.name, 'health_metrics/missing.jpg')
+
+
+@override_settings(ROOT_URLCONF='gym_trainer_project.asgi_urls')
+class AsyncViewsTests(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.member = User.objects.create_user('member', password='pw', first_name='Mia')
+        cls.admin = User.objects.create_user('admin', password='pw', is_staff=True)
+        for day in range(3):
+            create_metric(cls.member, day)
+        coach = User.objects.create_user('coach', first_name='Carl', last_name='Coach')
+        cls.trainer = PersonalTrainer.objects.create(
+            user=coach, specialization='Yoga', experience_years=3, hourly_rate=40, bio='Bio'
+        )
+
+    def setUp(self):
+        cache.clear()
+        registry.reset()
+
+    @override_settings(ROOT_URLCONF='gym_trainer_project.urls')
+    def sync_get(self, user, url):
+        self.client.force_login(user)
+        return self.client.get(url)
+
+    async def test_read_views_are_async_and_answer_like_the_sync_ones(self):
+        pages = [
+            (self.member, reverse('trainer:dashboard'), 'Welcome, member'),
+            (self.admin, f"{reverse('trainer:dashboard')}?user_id={self.member.pk}", 'member'),
+            (self.member, reverse('trainer:health_metrics'), 'Jan. 3, 2025'),
+            (self.member, reverse('trainer:trainer_list'), 'Carl'),
+            (self.member, reverse('trainer:trainer_profile', args=[self.trainer.pk]), 'Carl'),
+        ]
+        for user, url, text in pages:
+            with self.subTest(url=url):
+                await self.async_client.aforce_login(user)
+                response = await self.async_client.get(url)
+                self.assertTrue(iscoroutinefunction(response.resolver_match.func))
+                self.assertContains(response, text)
+
+        missing = await self.async_client.get(reverse('trainer:trainer_profile', args=[self.trainer.pk + 100]))
+        self.assertEqual(missing.status_code, 404)
+
+        # The JSON APIs return the same data as the sync views
+        await self.async_client.aforce_login(self.admin)
+        for url in [
+            f"{reverse('trainer:metrics_series')}?user_id={self.member.pk}&days=all",
+            f"{reverse('trainer:metrics_series')}?resolution=year",
+            f"{reverse('trainer:metrics_series')}?days=100000000",
+            f"{reverse('trainer:user_search')}?q=me",
+        ]:
+            with self.subTest(url=url):
+                response = await self.async_client.get(url)
+                expected = await sync_to_async(self.sync_get)(self.admin, url)
+                self.assertEqual(response.status_code, expected.status_code)
+                self.assertEqual(response.json(), expected.json())
+
+    async def test_dashboard_revalidation_and_query_count(self):
+        await self.async_client.aforce_login(self.member)
+        url = reverse('trainer:dashboard')
+        await sync_to_async(self.sync_get)(self.member, url)
+        registry.reset()
+        await sync_to_async(self.sync_get)(self.member, url)
+        sync_stats = registry.snapshot()['trainer:dashboard']
+        registry.reset()
+
+        # Counted on the request's thread and on the ones gather_queries() uses
+        response = await self.async_client.get(url)
+        self.assertEqual(response.status_code, 200)
+        stats = registry.snapshot()['trainer:dashboard']
+        self.assertEqual(stats['sql_queries'], sync_stats['sql_queries'])
+        self.assertGreater(stats['template_seconds'], 0)
+
+        revalidated = await self.async_client.get(url, headers={'If-None-Match': response['ETag']})
+        self.assertEqual(revalidated.status_code, 304)
+        self.assertEqual(registry.snapshot()['trainer:dashboard']['statuses'], {('GET', 200): 1, ('GET', 304): 1})
+
+
+class GatherQueriesTests(SimpleTestCase):
+    async def test_queries_run_at_the_same_time(self):
+        # Only returns if both calls are waiting together
+        barrier = threading.Barrier(2, timeout=5)
+        self.assertEqual(sorted(await gather_queries(barrier.wait, barrier.wait)), [0, 1])
+
+    async def test_queries_run_on_the_request_thread_inside_a_transaction(self):
+        with mock.patch('trainer.async_queries._in_transaction', return_value=True):
+            threads = await gather_queries(threading.get_ident, threading.get_ident)
+        self.assertEqual(threads[0], threads[1])
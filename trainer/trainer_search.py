@@ -0,0 +1,163 @@
+"""
+Filtered, sorted and paginated search over available personal trainers.
+
+Result pages are plain dicts read with ``values()`` (the user's names come
+from the same joined query) and cached for a short time in the cache named
+by ``TRAINER_SEARCH_CACHE``. Every key contains a version number that the
+PersonalTrainer signal handlers bump, so any change to a trainer makes all
+cached pages stale at once without having to know their keys. The number of
+matches is cached on its own, so a page is cached under the page number it
+shows, whatever the ``page`` parameter said.
+"""
+import hashlib
+import json
+import math
+
+from django.conf import settings
+from django.core.cache import caches
+from django.db import transaction
+
+from .models import PersonalTrainer
+from .monitoring import registry
+
+SORT_RATE = 'rate'
+SORT_RATE_DESC = '-rate'
+SORT_EXPERIENCE = 'experience'
+SORT_NEWEST = 'newest'
+SORTS = {
+    SORT_RATE: ('hourly_rate', 'id'),
+    SORT_RATE_DESC: ('-hourly_rate', 'id'),
+    SORT_EXPERIENCE: ('-experience_years', 'id'),
+    SORT_NEWEST: ('-created_at', '-id'),
+}
+SORT_CHOICES = [
+    (SORT_RATE, 'Lowest rate'),
+    (SORT_RATE_DESC, 'Highest rate'),
+    (SORT_EXPERIENCE, 'Most experienced'),
+    (SORT_NEWEST, 'Newest'),
+]
+DEFAULT_SORT = SORT_RATE
+
+TRAINERS_PER_PAGE = 12
+
+FIELDS = [
+    'id',
+    'specialization',
+    'experience_years',
+    'hourly_rate',
+    'bio',
+    'user__first_name',
+    'user__last_name',
+]
+
+VERSION_KEY = 'trainer:trainers:version'
+
+HITS_METRIC = 'trainer_search_cache_hits_total'
+MISSES_METRIC = 'trainer_search_cache_misses_total'
+
+
+def get_cache():
+    return caches[getattr(settings, 'TRAINER_SEARCH_CACHE', 'default')]
+
+
+def cache_timeout():
+    return getattr(settings, 'TRAINER_SEARCH_CACHE_TIMEOUT', 60)
+
+
+def _version(cache):
+    version = cache.get(VERSION_KEY)
+    if version is None:
+        cache.add(VERSION_KEY, 1, None)
+        version = cache.get(VERSION_KEY, 1)
+    return version
+
+
+def _cached(name, params, compute):
+    cache = get_cache()
+    digest = hashlib.md5(json.dumps(params, sort_keys=True, default=str).encode()).hexdigest()
+    key = f'trainer:trainers:{_version(cache)}:{name}:{digest}'
+    value = cache.get(key)
+    if value is None:
+        registry.increment(MISSES_METRIC, 'Trainer search cache misses.', entry=name)
+        value = compute()
+        cache.set(key, value, cache_timeout())
+    else:
+        registry.increment(HITS_METRIC, 'Trainer search cache hits.', entry=name)
+    return value
+
+
+def invalidate_trainer_search():
+    """Make every cached result page stale once the current transaction commits."""
+
+    def bump():
+        cache = get_cache()
+        try:
+            cache.incr(VERSION_KEY)
+        except ValueError:
+            # No version yet: nothing has been cached under it
+            cache.add(VERSION_KEY, 1, None)
+
+    transaction.on_commit(bump)
+
+
+def specializations():
+    """Distinct specializations of available trainers, for the filter dropdown."""
+    return _cached('specializations', {}, lambda: list(
+        PersonalTrainer.objects.filter(is_available=True)
+        .order_by('specialization')
+        .values_list('specialization', flat=True)
+        .distinct()
+    ))
+
+
+def _page_number(page, num_pages):
+    """The page Paginator.get_page() shows for page: the first if not a number, the last if out of range."""
+    try:
+        number = int(page)
+    except (TypeError, ValueError):
+        return 1
+    return number if 1 <= number <= num_pages else num_pages
+
+
+def search_trainers(specialization=None, min_rate=None, max_rate=None, min_experience=None,
+                    sort=DEFAULT_SORT, page=1):
+    """
+    Return a dict with one page of available trainers ('trainers', a list of
+    dicts with FIELDS) and the pagination state ('number', 'num_pages', 'count').
+    Out-of-range page numbers return the last page.
+    """
+    filters = {
+        'specialization': specialization,
+        'min_rate': min_rate,
+        'max_rate': max_rate,
+        'min_experience': min_experience,
+    }
+
+    def matching():
+        trainers = PersonalTrainer.objects.filter(is_available=True)
+        if specialization:
+            trainers = trainers.filter(specialization=specialization)
+        if min_rate is not None:
+            trainers = trainers.filter(hourly_rate__gte=min_rate)
+        if max_rate is not None:
+            trainers = trainers.filter(hourly_rate__lte=max_rate)
+        if min_experience is not None:
+            trainers = trainers.filter(experience_years__gte=min_experience)
+        return trainers
+
+    # Counted first, so the page is keyed by the number shown and not by whatever ?page= said
+    count = _cached('count', filters, lambda: matching().count())
+    num_pages = max(1, math.ceil(count / TRAINERS_PER_PAGE))
+    number = _page_number(page, num_pages)
+
+    def compute():
+        trainers = matching().order_by(*SORTS.get(sort, SORTS[DEFAULT_SORT])).values(*FIELDS)
+        offset = (number - 1) * TRAINERS_PER_PAGE
+        return {
+            'trainers': list(trainers[offset:offset + TRAINERS_PER_PAGE]),
+            'number': number,
+            'num_pages': num_pages,
+            'count': count,
+        }
+
+    return _cached('page', {**filters, 'sort': sort, 'page': number}, compute)
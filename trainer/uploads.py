@@ -0,0 +1,145 @@
+"""
+Streaming checks of progress photo uploads.
+
+PhotoUploadHandler sits in front of Django's upload handlers and looks at
+the photo while it is received, instead of after the whole file has been
+buffered to memory or a temporary file:
+
+- the type is sniffed from the first bytes (JPEG, PNG, GIF or WebP),
+  whatever content type the client claims;
+- the dimensions are read from the header as soon as it has arrived, and
+  images over ``TRAINER_IMAGE_MAX_PIXELS`` are refused before anything is
+  decoded;
+- the file is dropped as soon as it passes MAX_PHOTO_BYTES.
+
+A refused file is skipped: the rest of it is read and discarded without
+being stored, and the form reports the reason. Install the handler before
+the request body is parsed, which means before CsrfViewMiddleware reads
+``request.POST`` (see Django's docs on modifying upload handlers on the fly).
+"""
+from io import BytesIO
+
+from django.core.files.uploadhandler import FileUploadHandler, SkipFile
+from PIL import Image, UnidentifiedImageError
+
+from .image_decode import ImageTooLarge, check_pixels
+from .monitoring import registry
+
+REJECTIONS_METRIC = 'trainer_upload_rejections_total'
+
+MAX_PHOTO_BYTES = 5 * 1024 * 1024
+
+# Headers (EXIF, ICC profiles) larger than this are treated as not an image
+MAX_HEADER_BYTES = 256 * 1024
+
+SIGNATURES = {
+    'jpeg': (b'\xff\xd8\xff',),
+    'png': (b'\x89PNG\r\n\x1a\n',),
+    'gif': (b'GIF87a', b'GIF89a'),
+}
+
+
+def sniff_type(data):
+    """Image type from the magic bytes at the start of data, or None."""
+    for image_type, signatures in SIGNATURES.items():
+        if data.startswith(signatures):
+            return image_type
+    if data[:4] == b'RIFF' and data[8:12] == b'WEBP':
+        return 'webp'
+    return None
+
+
+def webp_size(header):
+    """Canvas size from the first chunk of a WebP file (Pillow needs the whole file), or None."""
+    chunk = header[12:16]
+    if chunk == b'VP8X' and len(header) >= 30:
+        return 1 + int.from_bytes(header[24:27], 'little'), 1 + int.from_bytes(header[27:30], 'little')
+    if chunk == b'VP8 ' and len(header) >= 30:
+        return int.from_bytes(header[26:28], 'little') & 0x3fff, int.from_bytes(header[28:30], 'little') & 0x3fff
+    if chunk == b'VP8L' and len(header) >= 25:
+        bits = int.from_bytes(header[21:25], 'little')
+        return (bits & 0x3fff) + 1, (bits >> 14 & 0x3fff) + 1
+    return None
+
+
+def header_size(header, image_type):
+    """
+    Image size read from the bytes received so far, or None while they do
+    not cover the header yet. Nothing is decoded. Raises ImageTooLarge for
+    sizes Pillow itself refuses to open.
+    """
+    if image_type == 'webp':
+        return webp_size(header)
+    try:
+        with Image.open(BytesIO(header)) as img:
+            return img.size
+    except Image.DecompressionBombError as e:
+        raise ImageTooLarge(str(e))
+    except (UnidentifiedImageError, OSError, SyntaxError, EOFError):
+        # Pillow raises any of these on a truncated header
+        return None
+
+
+class PhotoUploadHandler(FileUploadHandler):
+    """
+    Check the files of the given form fields while they stream in; other
+    fields pass through untouched. Reasons for refused files are collected
+    in ``errors``, keyed by field name.
+    """
+
+    def __init__(self, request=None, fields=('image',), max_bytes=MAX_PHOTO_BYTES):
+        super().__init__(request)
+        self.fields = fields
+        self.max_bytes = max_bytes
+        self.errors = {}
+        self.checking = False
+
+    def new_file(self, field_name, *args, **kwargs):
+        super().new_file(field_name, *args, **kwargs)
+        self.checking = field_name in self.fields
+        self.header = b''
+        self.header_checked = False
+
+    def reject(self, reason, message):
+        """Refuse the file and skip the rest of it."""
+        registry.increment(REJECTIONS_METRIC, 'Photo uploads refused while streaming, by reason.', reason=reason)
+        self.errors[self.field_name] = message
+        self.checking = False
+        raise SkipFile(message)
+
+    def receive_data_chunk(self, raw_data, start):
+        if not self.checking:
+            return raw_data
+        if start + len(raw_data) > self.max_bytes:
+            self.reject(
+                'too_large',
+                f'Image file too large. Maximum size is {self.max_bytes / (1024 * 1024):g}MB.',
+            )
+        if not self.header_checked:
+            self.check_header(raw_data)
+        return raw_data
+
+    def check_header(self, raw_data):
+        self.header += raw_data
+        if len(self.header) < 12:
+            return
+        image_type = sniff_type(self.header)
+        if image_type is None:
+            self.reject('type', 'Invalid image format. Please upload JPEG, PNG, GIF, or WebP images only.')
+        try:
+            size = header_size(self.header, image_type)
+            if size is not None:
+                check_pixels(size)
+        except ImageTooLarge as e:
+            self.reject('pixels', str(e))
+        if size is None:
+            if len(self.header) >= MAX_HEADER_BYTES:
+                self.reject('header', 'The image could not be read.')
+            return
+        self.header_checked = True
+        self.header = b''
+
+    def file_complete(self, file_size):
+        # The next handler stores the file. One that ended inside its header
+        # is reported by the form's ImageField as not an image.
+        return None
@@ -3,13 +3,25 @@ from . import views
 
 app_name = 'trainer'
 
-urlpatterns = [
-    path('', views.index, name='index'),
-    path('login/', views.user_login, name='login'),
-    path('logout/', views.user_logout, name='logout'),
-    path('dashboard/', views.dashboard, name='dashboard'),
-    path('health-metrics/', views.health_metrics, name='health_metrics'),
-    path('add-health-metrics/', views.add_health_metrics, name='add_health_metrics'),
-    path('trainers/', views.trainer_list, name='trainer_list'),
-    path('trainer/<int:trainer_id>/', views.trainer_profile, name='trainer_profile'),
-]
\ No newline at end of file
+
+def trainer_urlpatterns(read_views):
+    """The app's URLs, with the read views taken from read_views (views, or async_views under ASGI)."""
+    return [
+        path('', views.index, name='index'),
+        path('login/', views.user_login, name='login'),
+        path('logout/', views.user_logout, name='logout'),
+        path('dashboard/', read_views.dashboard, name='dashboard'),
+        path('health-metrics/', read_views.health_metrics, name='health_metrics'),
+        path('add-health-metrics/', views.add_health_metrics, name='add_health_metrics'),
+        path('api/metrics/series/', read_views.metrics_series, name='metrics_series'),
+        path('api/users/search/', read_views.user_search, name='user_search'),
+        path('export-health-metrics/', views.export_health_metrics, name='export_health_metrics'),
+        path('export-health-metrics/all/', views.export_all_health_metrics, name='export_all_health_metrics'),
+        path('import-health-metrics/', views.import_health_metrics, name='import_health_metrics'),
+        path('metrics', views.metrics, name='metrics'),
+        path('trainers/', read_views.trainer_list, name='trainer_list'),
+        path('trainer/<int:trainer_id>/', read_views.trainer_profile, name='trainer_profile'),
+    ]
+
+
+urlpatterns = trainer_urlpatterns(views)
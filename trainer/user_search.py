@@ -0,0 +1,42 @@
+"""
+Prefix search over users for the admin user picker on the dashboard.
+
+Every term of the query must be a case-insensitive prefix of the username,
+first name or last name. Those columns have prefix indexes (migration 0012),
+so a search reads only matching rows however many users there are. Pages are
+fetched with one extra row to tell whether there is a next page, without a
+COUNT query.
+"""
+from django.contrib.auth.models import User
+from django.db.models import Q
+
+SEARCH_PAGE_SIZE = 20
+MAX_SEARCH_PAGE_SIZE = 50
+MAX_TERMS = 3
+
+
+def search_users(query, page=1, page_size=SEARCH_PAGE_SIZE):
+    """Return (list of user dicts, has_more) for one page of active users matching query."""
+    users = User.objects.filter(is_active=True)
+    for term in query.split()[:MAX_TERMS]:
+        users = users.filter(
+            Q(username__istartswith=term)
+            | Q(first_name__istartswith=term)
+            | Q(last_name__istartswith=term)
+        )
+
+    offset = (page - 1) * page_size
+    rows = list(
+        users.order_by('username').values_list('id', 'username', 'first_name', 'last_name')[
+            offset:offset + page_size + 1
+        ]
+    )
+    results = [
+        {
+            'id': user_id,
+            'username': username,
+            'full_name': f'{first_name} {last_name}'.strip(),
+        }
+        for user_id, username, first_name, last_name in rows[:page_size]
+    ]
+    return results, len(rows) > page_size
@@ -1,11 +1,32 @@
 from django.shortcuts import render, redirect
-from django.http import HttpResponse
+from django.template.loader import render_to_string
+from django.conf import settings
+from datetime import date, timedelta
+from functools import partial
+from django.db.models import Max, Min
+from django.http import HttpResponse, JsonResponse, StreamingHttpResponse
 from django.contrib.auth import authenticate, login, logout
+from django.contrib.admin.views.decorators import staff_member_required
 from django.contrib.auth.decorators import login_required
+from django.views.decorators.csrf import csrf_exempt, csrf_protect
+from django.views.decorators.gzip import gzip_page
 from django.contrib.auth.models import User
 from django.contrib import messages
 from .models import PersonalTrainer, UserHealthMetrics
-from .forms import HealthMetricsForm
+from .conditional import conditional_page, dashboard_validators, health_metrics_validators, trainer_profile_validators
+from .db_routing import keep_routing
+from .dashboard_cache import FRAGMENT_CHARTS, FRAGMENT_PHOTOS, cached_fragment, cached_trainer_profile
+from .exporters import CONTENT_TYPES, stream_archive, stream_user_export
+from .forms import HealthMetricsForm, HealthMetricsImportForm, TrainerSearchForm
+from .importers import FORMAT_CSV, FORMATS, HealthMetricsImporter, detect_format, iter_rows
+from .metrics_upsert import CREATED, upsert_health_metrics
+from .monitoring import CONTENT_TYPE, registry, scraper_allowed
+from .pagination import DEFAULT_PAGE_SIZE, PAGE_SIZES, keyset_page
+from .renditions import attach_renditions
+from .series import MAX_DAYS as MAX_SERIES_DAYS, RESOLUTION_AUTO, RESOLUTIONS, metric_series
+from .trainer_search import DEFAULT_SORT, search_trainers, specializations
+from .uploads import PhotoUploadHandler
+from .user_search import MAX_SEARCH_PAGE_SIZE, SEARCH_PAGE_SIZE, search_users
 
 # Create your views here.
 def index(request):
@@ -37,95 +58,327 @@ def user_logout(request):
     messages.success(request, 'You have been logged out successfully.')
     return redirect('trainer:login')
 
-@login_required
-def dashboard(request):
-    context = {}
-    
-    # Check if user is admin (superuser or staff)
+def dashboard_user(request):
+    """
+    The user whose dashboard is shown and the one an admin selected with
+    ?user_id= (None when viewing their own).
+    """
     is_admin = request.user.is_superuser or request.user.is_staff
-    context['is_admin'] = is_admin
-    
-    # Determine which user's data to display
     if is_admin and request.GET.get('user_id'):
         try:
-            selected_user_id = int(request.GET.get('user_id'))
-            selected_user = User.objects.get(id=selected_user_id)
-            viewing_user = selected_user
-            context['selected_user'] = selected_user
+            selected_user = User.objects.get(id=int(request.GET.get('user_id')))
+            return selected_user, selected_user
         except (ValueError, User.DoesNotExist):
-            viewing_user = request.user
             messages.error(request, 'Invalid user selected. Showing your own data.')
-    else:
-        viewing_user = request.user
-    
-    # Get user's health metrics for the graph (last 10 entries)
-    health_metrics = UserHealthMetrics.objects.filter(user=viewing_user).order_by('-recorded_date')[:10]
-    context['health_metrics'] = health_metrics
-    context['viewing_user'] = viewing_user
-    
+    return request.user, None
+
+
+# The fragments below only depend on the viewed user and are cached per user
+def render_dashboard_charts(viewing_user):
+    # Chart data is fetched lazily from metrics_series; only check whether there is any
+    return render_to_string('trainer/dashboard_charts.html', {
+        'viewing_user': viewing_user,
+        'has_metrics': UserHealthMetrics.objects.for_user(viewing_user).exists(),
+    })
+
+
+def render_dashboard_photos(viewing_user):
     # Get last 5 images based on date (only entries with images)
-    recent_images = UserHealthMetrics.objects.filter(
-        user=viewing_user,
+    recent_images = UserHealthMetrics.objects.for_user(viewing_user).filter(
         image__isnull=False
-    ).exclude(image='').order_by('-recorded_date')[:5]
-    context['recent_images'] = recent_images
-    
-    # If admin, get all users for the dropdown
-    if is_admin:
-        all_users = User.objects.filter(is_active=True).order_by('username')
-        context['all_users'] = all_users
-    
-    # Check if user is a personal trainer
-    try:
-        trainer_profile = PersonalTrainer.objects.get(user=request.user)
-        context['is_trainer'] = True
+    ).exclude(image='').order_by('-recorded_date').prefetch_related('renditions')[:5]
+    return render_to_string('trainer/dashboard_photos.html', {
+        'recent_images': attach_renditions(recent_images),
+    })
+
+
+def dashboard_context(request, viewing_user, selected_user, charts_fragment, photos_fragment, trainer_profile):
+    context = {
+        # Check if user is admin (superuser or staff)
+        'is_admin': request.user.is_superuser or request.user.is_staff,
+        'viewing_user': viewing_user,
+        'charts_fragment': charts_fragment,
+        'photos_fragment': photos_fragment,
+        # Check if user is a personal trainer
+        'is_trainer': trainer_profile is not None,
+    }
+    if selected_user is not None:
+        context['selected_user'] = selected_user
+    if trainer_profile is not None:
         context['trainer_profile'] = trainer_profile
-    except PersonalTrainer.DoesNotExist:
-        context['is_trainer'] = False
-    
+    return context
+
+
+@login_required
+@gzip_page
+@conditional_page(dashboard_validators)
+def dashboard(request):
+    viewing_user, selected_user = dashboard_user(request)
+    context = dashboard_context(
+        request,
+        viewing_user,
+        selected_user,
+        cached_fragment(FRAGMENT_CHARTS, viewing_user.pk, partial(render_dashboard_charts, viewing_user)),
+        cached_fragment(FRAGMENT_PHOTOS, viewing_user.pk, partial(render_dashboard_photos, viewing_user)),
+        cached_trainer_profile(request.user),
+    )
     return render(request, 'trainer/dashboard.html', context)
 
+
+def series_params(request):
+    """
+    (resolution, start_date, end_date, days) from the query of
+    metrics_series; days is None for 'all'. Raises ValueError with the
+    message to show.
+    """
+    resolution = request.GET.get('resolution', RESOLUTION_AUTO)
+    if resolution not in RESOLUTIONS:
+        raise ValueError(f'Invalid resolution. Use one of: {", ".join(RESOLUTIONS)}.')
+    try:
+        start_date = date.fromisoformat(request.GET['start']) if request.GET.get('start') else None
+        end_date = date.fromisoformat(request.GET['end']) if request.GET.get('end') else None
+        days = request.GET.get('days', '30')
+        days = None if days == 'all' else int(days)
+    except ValueError:
+        raise ValueError('Invalid date range.')
+    if days is not None and not 1 <= days <= MAX_SERIES_DAYS:
+        raise ValueError(f'days must be between 1 and {MAX_SERIES_DAYS}, or all.')
+    return resolution, start_date, end_date, days
+
+
+def series_window(bounds, start_date, end_date, days):
+    """Fill in a missing start or end from the first and last dates of the user's data (bounds)."""
+    # Default the window to the user's own data rather than today's date
+    if bounds['last'] is None:
+        today = date.today()
+        return today, today
+    end_date = end_date or bounds['last']
+    if start_date is None:
+        start_date = bounds['first'] if days is None else max(bounds['first'], end_date - timedelta(days=days - 1))
+    return start_date, end_date
+
+
 @login_required
+@gzip_page
+def metrics_series(request):
+    """
+    Return chart data as columnar JSON.
+    Query parameters: user_id (admins only), start and end (YYYY-MM-DD),
+    days (window ending at end, or 'all') and resolution (day, week, month, auto).
+    """
+    viewing_user = request.user
+    is_admin = request.user.is_superuser or request.user.is_staff
+    if is_admin and request.GET.get('user_id'):
+        try:
+            viewing_user = User.objects.get(id=int(request.GET.get('user_id')))
+        except (ValueError, User.DoesNotExist):
+            return JsonResponse({'error': 'Invalid user.'}, status=400)
+
+    try:
+        resolution, start_date, end_date, days = series_params(request)
+    except ValueError as e:
+        return JsonResponse({'error': str(e)}, status=400)
+
+    if start_date is None or end_date is None:
+        bounds = UserHealthMetrics.objects.for_user(viewing_user).aggregate(
+            first=Min('recorded_date'), last=Max('recorded_date')
+        )
+        start_date, end_date = series_window(bounds, start_date, end_date, days)
+
+    if start_date > end_date:
+        return JsonResponse({'error': 'start must not be after end.'}, status=400)
+
+    return JsonResponse(metric_series(viewing_user, start_date, end_date, resolution))
+
+def user_search_params(request):
+    """(q, page, page_size) from the query of user_search. Raises ValueError."""
+    page = max(1, int(request.GET.get('page', 1)))
+    page_size = min(MAX_SEARCH_PAGE_SIZE, max(1, int(request.GET.get('page_size', SEARCH_PAGE_SIZE))))
+    return request.GET.get('q', '').strip(), page, page_size
+
+
+@login_required
+@gzip_page
+def user_search(request):
+    """
+    Return one page of active users whose username, first or last name starts
+    with every term of q, for the dashboard user picker. Admins only.
+    Query parameters: q, page (from 1) and page_size.
+    """
+    if not (request.user.is_superuser or request.user.is_staff):
+        return JsonResponse({'error': 'Forbidden.'}, status=403)
+
+    try:
+        query, page, page_size = user_search_params(request)
+    except ValueError:
+        return JsonResponse({'error': 'Invalid page.'}, status=400)
+
+    results, has_more = search_users(query, page, page_size)
+    return JsonResponse({'results': results, 'page': page, 'has_more': has_more})
+
+def health_metrics_context(request):
+    """The page of the member's history asked for, and its filters."""
+    metrics = UserHealthMetrics.objects.for_user(request.user)
+    try:
+        page_size = int(request.GET.get('page_size', DEFAULT_PAGE_SIZE))
+        if page_size not in PAGE_SIZES:
+            raise ValueError
+        start_date = date.fromisoformat(request.GET['start']) if request.GET.get('start') else None
+        end_date = date.fromisoformat(request.GET['end']) if request.GET.get('end') else None
+    except ValueError:
+        messages.error(request, 'Invalid filter. Showing all your metrics.')
+        page_size, start_date, end_date = DEFAULT_PAGE_SIZE, None, None
+    if start_date:
+        metrics = metrics.filter(recorded_date__gte=start_date)
+    if end_date:
+        metrics = metrics.filter(recorded_date__lte=end_date)
+
+    # Only the columns the table renders
+    metrics = metrics.values(
+        'id', 'recorded_date', 'weight', 'thigh_length', 'hip_length', 'wakeup_datetime', 'sleeping_datetime'
+    )
+    page = keyset_page(
+        metrics,
+        after=request.GET.get('after'),
+        before=request.GET.get('before'),
+        page_size=page_size,
+    )
+    return {
+        'health_metrics': page.rows,
+        'page': page,
+        'page_size': page_size,
+        'page_sizes': PAGE_SIZES,
+        'start_date': start_date,
+        'end_date': end_date,
+    }
+
+@login_required
+@gzip_page
+@conditional_page(health_metrics_validators)
 def health_metrics(request):
-    metrics = UserHealthMetrics.objects.filter(user=request.user).order_by('-recorded_date')[:10]
-    return render(request, 'trainer/health_metrics.html', {'health_metrics': metrics})
+    """
+    The member's full history, newest first, paginated with cursors.
+    Query parameters: after / before (cursors), page_size, start and end (YYYY-MM-DD).
+    """
+    return render(request, 'trainer/health_metrics.html', health_metrics_context(request))
 
+@login_required
+def export_health_metrics(request):
+    """
+    Stream a member's complete history as a download.
+    Query parameters: format (csv or ndjson), photos=1 to add photo URLs and
+    user_id (admins only).
+    """
+    viewing_user = request.user
+    is_admin = request.user.is_superuser or request.user.is_staff
+    if is_admin and request.GET.get('user_id'):
+        try:
+            viewing_user = User.objects.get(id=int(request.GET.get('user_id')))
+        except (ValueError, User.DoesNotExist):
+            return HttpResponse('Invalid user.', status=400)
+
+    file_format = request.GET.get('format', FORMAT_CSV)
+    if file_format not in FORMATS:
+        return HttpResponse(f'Invalid format. Use one of: {", ".join(FORMATS)}.', status=400)
+
+    response = StreamingHttpResponse(
+        # The body is read after the routing middleware has returned
+        keep_routing(stream_user_export(
+            viewing_user,
+            file_format,
+            include_photos=request.GET.get('photos') == '1',
+            photo_url=request.build_absolute_uri,
+        )),
+        content_type=CONTENT_TYPES[file_format],
+    )
+    response['Content-Disposition'] = f'attachment; filename="health-metrics-{viewing_user.username}.{file_format}"'
+    return response
+
+@staff_member_required
+def export_all_health_metrics(request):
+    """Stream every user's history as one ZIP archive with a file per user."""
+    file_format = request.GET.get('format', FORMAT_CSV)
+    if file_format not in FORMATS:
+        return HttpResponse(f'Invalid format. Use one of: {", ".join(FORMATS)}.', status=400)
+
+    response = StreamingHttpResponse(
+        keep_routing(stream_archive(
+            file_format,
+            include_photos=request.GET.get('photos') == '1',
+            photo_url=request.build_absolute_uri,
+        )),
+        content_type='application/zip',
+    )
+    response['Content-Disposition'] = f'attachment; filename="health-metrics-{date.today().isoformat()}.zip"'
+    return response
+
+def trainer_list_context(request):
+    form = TrainerSearchForm(request.GET or None, specializations=specializations())
+    filters = form.cleaned_data if form.is_valid() else {}
+    results = search_trainers(
+        specialization=filters.get('specialization') or None,
+        min_rate=filters.get('min_rate'),
+        max_rate=filters.get('max_rate'),
+        min_experience=filters.get('min_experience'),
+        sort=filters.get('sort') or DEFAULT_SORT,
+        page=request.GET.get('page', 1),
+    )
+    return {
+        'form': form,
+        'trainers': results['trainers'],
+        'results': results,
+    }
+
+@gzip_page
 def trainer_list(request):
-    trainers = PersonalTrainer.objects.filter(is_available=True)
-    return render(request, 'trainer/trainer_list.html', {'trainers': trainers})
+    """
+    Available trainers, filtered, sorted and paginated.
+    Query parameters: specialization, min_rate, max_rate, min_experience, sort and page.
+    """
+    return render(request, 'trainer/trainer_list.html', trainer_list_context(request))
 
+@gzip_page
+@conditional_page(trainer_profile_validators)
 def trainer_profile(request, trainer_id):
     try:
-        trainer = PersonalTrainer.objects.get(id=trainer_id)
+        trainer = PersonalTrainer.objects.select_related('user').get(id=trainer_id)
         return render(request, 'trainer/trainer_profile.html', {'trainer': trainer})
     except PersonalTrainer.DoesNotExist:
         return HttpResponse("Trainer not found.", status=404)
 
 @login_required
+@csrf_exempt
 def add_health_metrics(request):
+    # Check the photo while it streams in: the body must not have been parsed yet,
+    # so CSRF is checked by the inner view instead of the middleware
+    photo_uploads = PhotoUploadHandler(request)
+    request.upload_handlers.insert(0, photo_uploads)
+    return _add_health_metrics(request, photo_uploads)
+
+
+@csrf_protect
+def _add_health_metrics(request, photo_uploads):
     if request.method == 'POST':
-        form = HealthMetricsForm(request.POST, request.FILES)
+        form = HealthMetricsForm(request.POST, request.FILES, upload_errors=photo_uploads.errors)
         if form.is_valid():
             # Get the form data
             health_metric = form.save(commit=False)
-            health_metric.user = request.user
             selected_date = form.cleaned_data['date']
             
-            # Use update_or_create to handle both new and existing entries
-            defaults = {
+            # One INSERT ... ON CONFLICT writes only what changed (see trainer/metrics_upsert.py)
+            values = {
                 'wakeup_datetime': health_metric.wakeup_datetime,
                 'sleeping_datetime': health_metric.sleeping_datetime,
                 'weight': health_metric.weight,
                 'thigh_length': health_metric.thigh_length,
                 'hip_length': health_metric.hip_length,
-                'image': health_metric.image,
             }
+            if form.cleaned_data.get('image'):
+                # Only a newly uploaded photo replaces the stored one
+                values['image'] = form.cleaned_data['image']
             
-            obj, created = UserHealthMetrics.objects.update_or_create(
-                user=request.user,
-                recorded_date=selected_date,
-                defaults=defaults
-            )
+            _, outcome = upsert_health_metrics(request.user, selected_date, values)
+            created = outcome == CREATED
             
             if created:
                 messages.success(request, f'Health metrics for {selected_date} added successfully!')
@@ -137,3 +390,30 @@ def add_health_metrics(request):
         form = HealthMetricsForm()
     
     return render(request, 'trainer/add_health_metrics.html', {'form': form})
+
+
+@staff_member_required
+def import_health_metrics(request):
+    result = None
+    if request.method == 'POST':
+        form = HealthMetricsImportForm(request.POST, request.FILES)
+        if form.is_valid():
+            upload = form.cleaned_data['file']
+            file_format = form.cleaned_data['format'] or detect_format(upload.name)
+            # Rows are streamed from the uploaded file, never read into memory at once
+            result = HealthMetricsImporter().run(iter_rows(upload.file, file_format))
+            if result.rejected:
+                messages.warning(request, result.summary())
+            else:
+                messages.success(request, result.summary())
+    else:
+        form = HealthMetricsImportForm()
+
+    return render(request, 'trainer/import_health_metrics.html', {'form': form, 'result': result})
+
+
+def metrics(request):
+    """Request metrics in Prometheus text format, for staff users and configured scrapers only."""
+    if not request.user.is_staff and not scraper_allowed(request):
+        return HttpResponse('Forbidden.', status=403)
+    return HttpResponse(registry.render(), content_type=CONTENT_TYPE)